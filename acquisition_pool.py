@@ -0,0 +1,220 @@
+import time
+import queue
+import logging
+import itertools
+import threading
+import collections
+import multiprocessing
+
+import hp4195a as hp
+import multi_logging as ml
+
+
+TaggedSweep = collections.namedtuple('TaggedSweep',
+    ['instrument', 'host', 'port', 'gpib_addr', 'timestamp', 'success',
+     'mag_data', 'phase_data', 'freq_data', 'error'])
+
+
+class Controller(object):
+    '''
+    One Prologix controller and the hp4195a worker process that owns its
+    connection. All instruments on the controller's bus go through the same
+    worker, so their transactions never overlap.
+    '''
+    def __init__(self, host, port, logging_queue, data_format, **options):
+        self.host = host
+        self.port = port
+        self.instruments = collections.OrderedDict()
+        self.logging_queue = logging_queue
+        self.data_format = data_format
+        # further keyword arguments for the hp4195a worker
+        self.options = options
+        self.command_queue = multiprocessing.Queue()
+        self.message_queue = multiprocessing.Queue()
+        self.data_queue = multiprocessing.Queue()
+        self.ids = itertools.count(1)
+        self.worker = None
+        self.thread = None
+
+    def start(self):
+        self.worker = hp.hp4195a(self.command_queue, self.message_queue,
+                                 self.data_queue, self.logging_queue,
+                                 data_format=self.data_format,
+                                 host=self.host, port=self.port,
+                                 gpib_addr=list(self.instruments.values()),
+                                 **self.options)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def request(self, command, *args, timeout=60):
+        '''
+        Sends a request to the worker and blocks until its reply arrives.
+        Returns (success, payload).
+        '''
+        request_id = next(self.ids)
+        self.command_queue.put((request_id, command, args))
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.command_queue.put((None, 'cancel', (request_id,)))
+                return False, 'Timed out'
+            try:
+                reply_id, success, payload = self.message_queue.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if reply_id == request_id:
+                return success, payload
+
+    def stop(self, timeout=10):
+        '''
+        Disconnects and shuts the worker down. The worker is only terminated
+        if it has not exited within the timeout, as killing it while it
+        writes to the shared logging queue leaves the queue locked.
+        '''
+        if self.worker is None or not self.worker.is_alive():
+            return
+        self.request('disconnect', timeout=timeout)
+        self.request('shutdown', timeout=timeout)
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            logging.getLogger(__name__).warning('Terminating the worker for {}:{}'.format(self.host, self.port))
+            self.worker.terminate()
+            self.worker.join()
+
+
+class AcquisitionPool(object):
+    '''
+    This class runs sweeps on several analysers at once. Instruments are
+    grouped by the controller they are attached to and each controller gets
+    its own hp4195a worker process and scheduling thread. Controllers sweep
+    in parallel, instruments sharing a controller take turns with ++addr
+    switching. Every sweep is put on one results queue as a TaggedSweep
+    naming the instrument it came from.
+
+        pool = AcquisitionPool()
+        pool.add_instrument('bench-1', 'gpib-01', 1234, 11)
+        pool.add_instrument('bench-2', 'gpib-01', 1234, 12)
+        pool.add_instrument('bench-3', 'gpib-02', 1234, 11)
+        pool.start()
+        pool.run(sweeps=10)
+        sweep = pool.results.get()
+    '''
+    def __init__(self, logging_queue=None, data_format=hp.ASCII_FORMAT):
+        self.logger = logging.getLogger(__name__)
+        self.controllers = collections.OrderedDict()
+        self.results = queue.Queue()
+        self.stop_event = threading.Event()
+        self.data_format = data_format
+        self.logger_thread = None
+        if logging_queue is None:
+            logging_queue = multiprocessing.Queue()
+            self.logger_thread = threading.Thread(target=ml.logger_thread,
+                                                  args=(logging_queue,))
+            self.logger_thread.daemon = True
+            self.logger_thread.start()
+        self.logging_queue = logging_queue
+
+    def add_instrument(self, name, host, port=hp.DEFAULT_PORT, gpib_addr=11):
+        key = (host, int(port))
+        if key not in self.controllers:
+            self.controllers[key] = Controller(host, int(port), self.logging_queue,
+                                               self.data_format)
+        controller = self.controllers[key]
+        if controller.worker is not None:
+            raise RuntimeError('Instruments must be added before the pool is started')
+        controller.instruments[name] = gpib_addr
+
+    def start(self):
+        '''
+        Starts one worker per controller and connects them in parallel.
+        Returns the names of the controllers that failed to connect.
+        '''
+        for controller in self.controllers.values():
+            controller.start()
+        failed = []
+        replies = self.map(lambda c: c.request('connect'))
+        for controller, (success, payload) in zip(self.controllers.values(), replies):
+            if not success:
+                self.logger.warning('Could not connect to {}:{}: {}'.format(controller.host, controller.port, payload))
+                failed.append('{}:{}'.format(controller.host, controller.port))
+        return failed
+
+    def map(self, func):
+        '''
+        Calls func on every controller in its own thread and returns the
+        results in controller order.
+        '''
+        results = [None] * len(self.controllers)
+
+        def call(index, controller):
+            results[index] = func(controller)
+
+        threads = [threading.Thread(target=call, args=(i, c))
+                   for i, c in enumerate(self.controllers.values())]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def sweep(self, controller, name, gpib_addr):
+        success, payload = controller.request('start_acquisition', gpib_addr)
+        timestamp = time.time()
+        if success:
+            sequence, mag_data, phase_data, freq_data = payload
+            sweep = TaggedSweep(name, controller.host, controller.port, gpib_addr,
+                                timestamp, True, mag_data, phase_data, freq_data, None)
+        else:
+            sweep = TaggedSweep(name, controller.host, controller.port, gpib_addr,
+                                timestamp, False, None, None, None, payload)
+        self.results.put(sweep)
+        return sweep
+
+    def schedule(self, controller, sweeps, deadline):
+        '''
+        Sweeps the instruments of one controller in turn until each has done
+        the requested number of sweeps, the deadline passes or stop is called.
+        '''
+        count = 0
+        while not self.stop_event.is_set():
+            if sweeps is not None and count >= sweeps:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            for name, gpib_addr in controller.instruments.items():
+                if self.stop_event.is_set():
+                    break
+                self.sweep(controller, name, gpib_addr)
+            count += 1
+
+    def run(self, sweeps=None, duration=None, block=True):
+        '''
+        Runs the scheduler on every controller in parallel for the given
+        number of sweeps per instrument and/or duration in seconds. With
+        block=False it returns straight away and results keep arriving on
+        the results queue until the run ends or stop is called.
+        '''
+        self.stop_event.clear()
+        deadline = None if duration is None else time.monotonic() + duration
+        threads = []
+        for controller in self.controllers.values():
+            thread = threading.Thread(target=self.schedule,
+                                      args=(controller, sweeps, deadline))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        if block:
+            for thread in threads:
+                thread.join()
+        return threads
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        self.stop()
+        self.map(lambda c: c.stop())
+        if self.logger_thread is not None:
+            self.logging_queue.put(None)
+            self.logger_thread.join()
@@ -0,0 +1,296 @@
+'''
+Trace analysis on batches of sweeps. Every function takes magnitude (dB),
+phase (degrees) and frequency (Hz) data either as 1-D arrays for a single
+sweep or as 2-D arrays with one row per sweep sharing one frequency axis,
+and works on all the sweeps at once without Python loops over points.
+'''
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from export import as_sweeps
+
+
+def running_average(data, count):
+    '''
+    Returns the mean of each sweep and the count - 1 sweeps before it, the
+    first sweeps are averaged over as many as are available.
+    '''
+    data = as_sweeps(data)
+    total = np.cumsum(data, axis=0)
+    total[count:] = total[count:] - total[:-count]
+    n = np.minimum(np.arange(1, len(data) + 1), count)
+    return total / n[:, np.newaxis]
+
+
+def exponential_average(data, count, initial=None, start=0):
+    '''
+    Returns the exponential average after each sweep, the way the analyser
+    averages: each new sweep is weighted 1/n for the first count sweeps and
+    1/count after that. initial and start continue an earlier average that
+    had already taken start sweeps.
+    '''
+    data = as_sweeps(data)
+    count = max(int(count), 1)
+    averages = np.empty(data.shape)
+    previous = data[0] if initial is None else np.asarray(initial, dtype=float)
+    # while fewer than count sweeps have been taken the average is the
+    # cumulative mean
+    warm = min(max(count - start, 0), len(data))
+    if warm:
+        n = np.arange(start + 1, start + warm + 1)
+        averages[:warm] = (start * previous + np.cumsum(data[:warm], axis=0)) / n[:, np.newaxis]
+        previous = averages[warm - 1]
+    if warm == len(data):
+        return averages
+    if count == 1:
+        averages[warm:] = data[warm:]
+        return averages
+    # after that each average is decay ** k times the one before the block
+    # plus a geometrically weighted cumulative sum of the new sweeps. The
+    # blocks are short enough that decay ** -k stays well within range.
+    decay = 1 - 1 / count
+    block = max(1, int(30 / -np.log(decay)))
+    k = np.arange(1, block + 1)[:, np.newaxis]
+    growth = decay ** -k / count
+    shrink = decay ** k
+    for first in range(warm, len(data), block):
+        out = averages[first:first + block]
+        n = len(out)
+        np.multiply(data[first:first + n], growth[:n], out=out)
+        np.cumsum(out, axis=0, out=out)
+        out += previous
+        out *= shrink[:n]
+        previous = out[-1]
+    return averages
+
+
+def smooth(data, width):
+    '''
+    Smooths each sweep with a centred moving average over width points,
+    the window is narrowed at the ends of the sweep.
+    '''
+    data = as_sweeps(data)
+    if width <= 1:
+        return data.copy()
+    half = int(width) // 2
+    total = np.concatenate((np.zeros((len(data), 1)), np.cumsum(data, axis=1)), axis=1)
+    index = np.arange(data.shape[1])
+    low = np.maximum(index - half, 0)
+    high = np.minimum(index + half + 1, data.shape[1])
+    return (total[:, high] - total[:, low]) / (high - low)
+
+
+def unwrap_phase(phase_data):
+    '''
+    Removes the 360 degree jumps from each sweep.
+    '''
+    return np.degrees(np.unwrap(np.radians(as_sweeps(phase_data)), axis=1))
+
+
+def group_delay(freq_data, phase_data):
+    '''
+    Returns the group delay in seconds, minus the derivative of the
+    unwrapped phase with respect to angular frequency.
+    '''
+    phase = np.radians(unwrap_phase(phase_data))
+    omega = 2 * np.pi * np.asarray(freq_data, dtype=float)
+    return -np.gradient(phase, omega, axis=1)
+
+
+def prominences(data, window=11):
+    '''
+    Returns how far each point rises above the lowest point within window
+    points either side of it.
+    '''
+    data = as_sweeps(data)
+    window = int(window)
+    padded = np.pad(data, ((0, 0), (window, window)), mode='edge')
+    return data - sliding_window_view(padded, 2 * window + 1, axis=1).min(axis=-1)
+
+
+def peak_mask(data, prominence=3, window=11):
+    '''
+    Returns a boolean array marking the local maxima that rise at least
+    prominence above the lowest point within window points either side.
+    '''
+    data = as_sweeps(data)
+    inner = data[:, 1:-1]
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[:, 1:-1] = (inner > data[:, :-2]) & (inner >= data[:, 2:])
+    return mask & (prominences(data, window) >= prominence)
+
+
+def find_features(mag_data, phase_data=None, prominence=3, window=11):
+    '''
+    Returns the indices of the peaks and notches of a single sweep that
+    stand out by at least prominence dB, most prominent first, followed by
+    the points where the phase crosses zero (steepest first) if the phase
+    is given.
+    '''
+    mag_data = as_sweeps(mag_data)[0]
+    peaks = np.flatnonzero(peak_mask(mag_data, prominence, window)[0])
+    notches = np.flatnonzero(peak_mask(-mag_data, prominence, window)[0])
+    heights = np.concatenate((prominences(mag_data, window)[0][peaks],
+                              prominences(-mag_data, window)[0][notches]))
+    features = np.concatenate((peaks, notches))[np.argsort(-heights, kind='stable')]
+    if phase_data is None:
+        return features
+    phase = as_sweeps(phase_data)[0]
+    step = np.diff(phase)
+    # a sign change with a small step is a zero crossing, a large step is
+    # the phase wrapping at +-180 degrees
+    crossings = np.flatnonzero((np.sign(phase[:-1]) != np.sign(phase[1:])) & (np.abs(step) < 180))
+    crossings = crossings[np.argsort(-np.abs(step[crossings]), kind='stable')]
+    return np.concatenate((features, crossings[~np.isin(crossings, features)]))
+
+
+def segment_spans(freq_data, features, width=3, max_segments=4):
+    '''
+    Returns the (start, stop) frequencies of up to max_segments spans
+    reaching width points either side of the features, in frequency order.
+    Features are taken in the order given and spans that overlap are
+    merged.
+    '''
+    freq_data = np.asarray(freq_data, dtype=float)
+    last = len(freq_data) - 1
+    spans = []
+    for index in features:
+        low, high = max(index - width, 0), min(index + width, last)
+        for i, (start, stop) in enumerate(spans):
+            if low <= stop and high >= start:
+                spans[i] = (min(start, low), max(stop, high))
+                break
+        else:
+            if len(spans) == max_segments:
+                continue
+            spans.append((low, high))
+    return [(freq_data[low], freq_data[high]) for low, high in sorted(spans)]
+
+
+def stitch(coarse, segments):
+    '''
+    Combines a coarse (mag, phase, freq) sweep with finer sweeps of narrow
+    spans into one trace sorted by frequency. The coarse points that fall
+    within a segment are replaced by the segment. Returns (mag, phase, freq).
+    '''
+    mag_data, phase_data, freq_data = (np.asarray(a, dtype=float) for a in coarse)
+    keep = np.ones(len(freq_data), dtype=bool)
+    for segment in segments:
+        keep &= (freq_data < segment[2][0]) | (freq_data > segment[2][-1])
+    parts = [(mag_data[keep], phase_data[keep], freq_data[keep])] + list(segments)
+    mag_data, phase_data, freq_data = (np.concatenate(a) for a in zip(*parts))
+    order = np.argsort(freq_data, kind='stable')
+    return mag_data[order], phase_data[order], freq_data[order]
+
+
+def crossing(freq_data, data, below, first, last):
+    '''
+    Interpolates the frequency at which each sweep crosses its threshold
+    between point first (below it) and point last, NaN where there is no
+    crossing.
+    '''
+    rows = np.arange(len(data))
+    valid = (first >= 0) & (first < data.shape[1]) & (last >= 0) & (last < data.shape[1])
+    first = np.clip(first, 0, data.shape[1] - 1)
+    last = np.clip(last, 0, data.shape[1] - 1)
+    y0 = data[rows, first]
+    y1 = data[rows, last]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(y1 != y0, (below - y0) / (y1 - y0), 0)
+    freq = freq_data[first] + fraction * (freq_data[last] - freq_data[first])
+    return np.where(valid, freq, np.nan)
+
+
+def resonance(freq_data, mag_data, drop=3, notch=False):
+    '''
+    Finds the highest peak of each sweep (the deepest dip with notch=True)
+    and the points drop dB down either side of it. Returns a dict of arrays
+    with one value per sweep: index, frequency and magnitude of the peak,
+    lower and upper frequency, bandwidth and Q. Edges that do not fall
+    within the sweep are NaN, and so are the bandwidth and Q that depend
+    on them.
+    '''
+    freq_data = np.asarray(freq_data, dtype=float)
+    mag_data = as_sweeps(mag_data)
+    data = -mag_data if notch else mag_data
+    rows = np.arange(len(data))
+    index = np.argmax(data, axis=1)
+    peak = data[rows, index]
+    threshold = peak - drop
+    below = data < threshold[:, np.newaxis]
+    points = np.arange(data.shape[1])
+
+    left = np.where(below & (points < index[:, np.newaxis]), points, -1).max(axis=1)
+    right = np.where(below & (points > index[:, np.newaxis]), points, data.shape[1]).min(axis=1)
+    lower = crossing(freq_data, data, threshold, left, left + 1)
+    upper = crossing(freq_data, data, threshold, right, right - 1)
+    lower = np.where(left >= 0, lower, np.nan)
+    upper = np.where(right < data.shape[1], upper, np.nan)
+    bandwidth = upper - lower
+    centre = freq_data[index]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = centre / bandwidth
+    return {'index': index,
+            'frequency': centre,
+            'magnitude': mag_data[rows, index],
+            'lower': lower,
+            'upper': upper,
+            'bandwidth': bandwidth,
+            'q': q}
+
+
+class TraceProcessor(object):
+    '''
+    This class applies averaging, smoothing and phase unwrapping to a stream
+    of sweeps as they arrive, for the display or a headless run. Averaging
+    restarts when the frequency axis changes or reset is called.
+
+        processor = TraceProcessor(average=16, smooth=5, unwrap=True)
+        mag, phase = processor.process(mag, phase, freq)
+    '''
+    def __init__(self, average=0, running=False, smooth=0, unwrap=False):
+        self.average = average
+        self.running = running
+        self.smooth = smooth
+        self.unwrap = unwrap
+        self.reset()
+
+    @property
+    def enabled(self):
+        return self.average > 1 or self.smooth > 1 or self.unwrap
+
+    def reset(self):
+        self.freq_data = None
+        self.count = 0
+        self.mag_average = None
+        self.phase_average = None
+        self.mag_window = []
+        self.phase_window = []
+
+    def process(self, mag_data, phase_data, freq_data):
+        '''
+        Adds a sweep and returns the processed (mag, phase) traces.
+        '''
+        mag_data = np.asarray(mag_data, dtype=float)
+        phase_data = np.asarray(phase_data, dtype=float)
+        if self.unwrap:
+            phase_data = unwrap_phase(phase_data)[0]
+        if self.average > 1:
+            if self.freq_data is None or not np.array_equal(freq_data, self.freq_data):
+                self.reset()
+                self.freq_data = np.array(freq_data, dtype=float)
+            mag_data, phase_data = self.add_to_average(mag_data, phase_data)
+        if self.smooth > 1:
+            mag_data = smooth(mag_data, self.smooth)[0]
+            phase_data = smooth(phase_data, self.smooth)[0]
+        return mag_data, phase_data
+
+    def add_to_average(self, mag_data, phase_data):
+        if self.running:
+            self.mag_window = (self.mag_window + [mag_data])[-self.average:]
+            self.phase_window = (self.phase_window + [phase_data])[-self.average:]
+            return np.mean(self.mag_window, axis=0), np.mean(self.phase_window, axis=0)
+        self.mag_average = exponential_average(mag_data, self.average, self.mag_average, self.count)[0]
+        self.phase_average = exponential_average(phase_data, self.average, self.phase_average, self.count)[0]
+        self.count += 1
+        return self.mag_average, self.phase_average
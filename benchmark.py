@@ -0,0 +1,322 @@
+'''
+Benchmarks for each stage of a sweep: query round trips, trace transfer and
+parsing, the queue hop between processes, plot redraws, file export and the
+application start up. Sweeps are also replayed from a recorded session, which
+times the driver without the link. The instrument is replaced by the local simulator so
+no hardware is needed.
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline baseline.json --tolerance 0.25
+'''
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import statistics
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+
+import hp4195a as hp
+from hp4195a_simulator import Simulator
+from shared_trace import SharedTraceChannel
+
+
+POINT_COUNTS = (51, 201, 401)
+PERSIST_DEPTHS = (0, 10, 50)
+DATA_FORMATS = ('FMT1', 'FMT2', 'FMT3')
+
+
+def time_calls(func, repeat):
+    '''
+    Calls func repeat times and returns the duration of each call in seconds.
+    '''
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def summarise(durations):
+    return {'n': len(durations),
+            'min': min(durations),
+            'median': statistics.median(durations),
+            'mean': statistics.mean(durations),
+            'stdev': statistics.stdev(durations) if len(durations) > 1 else 0.0}
+
+
+def connect_driver(sim, data_format, **options):
+    queues = [multiprocessing.Queue() for _ in range(4)]
+    driver = hp.hp4195a(*queues, data_format=data_format,
+                        host=sim.address[0], port=sim.address[1], **options)
+    driver.logger = logging.getLogger(hp.__name__)
+    driver.telnet_connect()
+    request_id, success, payload = driver.message_queue.get(timeout=5)
+    if not success:
+        raise RuntimeError('Could not connect to the simulator')
+    return driver
+
+
+def bench_queries(sim, repeat):
+    driver = connect_driver(sim, 'FMT1')
+    results = {}
+    for command in ('++ver', 'ID?'):
+        results[command] = summarise(time_calls(lambda: driver.send_query(command), repeat))
+    driver.transport.close()
+    return results
+
+
+def bench_acquisition(sim, repeat):
+    '''
+    Times a full A?, B?, X? acquisition for each data format and point count,
+    and the parse step on its own for a pre-recorded response.
+    '''
+    results = {}
+    for data_format in DATA_FORMATS:
+        driver = connect_driver(sim, data_format)
+        for points in POINT_COUNTS:
+            sim.state.points = points
+
+            def acquire():
+                driver.acquire_mag_data()
+                driver.acquire_phase_data()
+                driver.acquire_freq_data()
+
+            key = '{}/{}'.format(data_format, points)
+            results['acquire/' + key] = summarise(time_calls(acquire, repeat))
+
+            raw = sim.state.encode(sim.state.freq_data())
+            if data_format in hp.BINARY_FORMATS:
+                block = raw[4:-2]
+                parse = lambda: hp.parse_binary_trace(block, data_format)
+            else:
+                text = raw.decode('ascii').rstrip()
+                parse = lambda: hp.parse_ascii_trace(text)
+            results['parse/' + key] = summarise(time_calls(parse, repeat))
+        driver.transport.close()
+    return results
+
+
+def bench_replay(sim, repeat):
+    '''
+    Records full sweeps from the simulator for each data format and replays
+    them as fast as possible, the difference is the time spent on the link.
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for data_format in DATA_FORMATS:
+            session = os.path.join(directory, data_format + '.gpib')
+            driver = connect_driver(sim, data_format, record_path=session)
+            results['live/' + data_format] = summarise(time_calls(driver.acquire_sweep, repeat))
+            driver.transport.close()
+            driver = connect_driver(sim, data_format, replay_path=session)
+            results['replay/' + data_format] = summarise(time_calls(driver.acquire_sweep, repeat))
+            driver.transport.close()
+    return results
+
+
+def queue_producer(queue, points, repeat, channel=None):
+    data = np.random.default_rng(0).standard_normal((3, points))
+    for _ in range(repeat):
+        sent = time.perf_counter()
+        if channel is None:
+            queue.put((sent, data[0], data[1], data[2]))
+        else:
+            channel.write(data[0], data[1], data[2])
+            queue.put((sent, None, None, None))
+
+
+def bench_queue_hop(repeat, shared=False):
+    '''
+    Measures the latency of sending one sweep from a child process to this
+    one, the same hop as from hp4195a to MainWindow, either pickled through
+    the data queue or through the shared trace channel.
+    '''
+    results = {}
+    for points in POINT_COUNTS:
+        queue = multiprocessing.Queue()
+        channel = SharedTraceChannel(max_points=points) if shared else None
+        producer = multiprocessing.Process(target=queue_producer,
+                                           args=(queue, points, repeat, channel))
+        producer.start()
+        durations = []
+        for _ in range(repeat):
+            sent, mag_data, phase_data, freq_data = queue.get()
+            if channel is not None:
+                channel.read()
+            durations.append(time.perf_counter() - sent)
+        producer.join()
+        if channel is not None:
+            channel.close()
+        results[str(points)] = summarise(durations)
+    return results
+
+
+def bench_plot(repeat):
+    '''
+    Times PlotCanvas.plot for each point count and persistence depth. Needs
+    PyQt5, the offscreen platform is used when no display is set.
+    '''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from PyQt5 import QtWidgets
+        from main_window import PlotCanvas
+    except ImportError as e:
+        return {'skipped': str(e)}
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+    results = {}
+    rng = np.random.default_rng(0)
+    for points in POINT_COUNTS:
+        for depth in PERSIST_DEPTHS:
+            queue = multiprocessing.Queue()
+            canvas = PlotCanvas(data_queue=queue)
+            freq = np.geomspace(1e3, 1e7, points)
+            canvas.persist = depth > 0
+            for _ in range(depth):
+                canvas.set_data(rng.standard_normal(points), rng.standard_normal(points), freq)
+                canvas.plot()
+            results['{}/{}'.format(points, depth)] = summarise(time_calls(canvas.plot, repeat))
+            canvas.close()
+    app.processEvents()
+    return results
+
+
+def bench_save(repeat):
+    '''
+    Times MainWindow.save_file on a stand-in window holding one trace, so the
+    Qt widgets do not need to be created.
+    '''
+    try:
+        from main_window import MainWindow
+    except ImportError as e:
+        return {'skipped': str(e)}
+
+    class Graph(object):
+        pass
+
+    class Window(object):
+        logger = logging.getLogger('benchmark')
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for points in POINT_COUNTS:
+            window = Window()
+            window.graph = Graph()
+            window.graph.freq_data = np.geomspace(1e3, 1e7, points)
+            window.graph.mag_data = np.random.default_rng(0).standard_normal(points)
+            window.graph.phase_data = np.random.default_rng(1).standard_normal(points)
+            path = os.path.join(directory, 'trace_{}'.format(points))
+            save = lambda: MainWindow.save_file(window, path)
+            results[str(points)] = summarise(time_calls(save, repeat))
+    return results
+
+
+def bench_startup(repeat):
+    '''
+    Times a cold import of the driver, as done by a spawned device process,
+    and the launch of the reader up to its first event loop pass, using the
+    timings the reader reports itself. Each run is a fresh interpreter, so
+    the repeat count is capped.
+    '''
+    repeat = min(repeat, 5)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen', HP4195A_STARTUP_EXIT='1')
+    results = {}
+
+    driver_import = lambda: subprocess.run([sys.executable, '-c', 'import hp4195a'],
+                                           cwd=directory, check=True)
+    results['driver_import'] = summarise(time_calls(driver_import, repeat))
+
+    timings = []
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, 'hp4195a_reader.py'], cwd=directory,
+                                 env=env, stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL, universal_newlines=True, timeout=60)
+        lines = [line for line in process.stdout.splitlines() if line.startswith('{')]
+        if process.returncode != 0 or not lines:
+            return dict(results, reader='skipped: reader exited with {}'.format(process.returncode))
+        timings.append(json.loads(lines[-1]))
+    for name in ('imports', 'window', 'ready'):
+        results['reader_' + name] = summarise([t[name] for t in timings])
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns a list of (stage, case, baseline, current) for every case whose
+    median got slower than the baseline by more than the tolerance.
+    '''
+    regressions = []
+    for stage, cases in results['stages'].items():
+        for case, current in cases.items():
+            previous = baseline.get('stages', {}).get(stage, {}).get(case)
+            if not isinstance(current, dict) or not isinstance(previous, dict):
+                continue
+            if current['median'] > previous['median'] * (1 + tolerance):
+                regressions.append((stage, case, previous['median'], current['median']))
+    return regressions
+
+
+def run(repeat):
+    results = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'platform': platform.platform(),
+                        'repeat': repeat},
+               'stages': {}}
+    stages = results['stages']
+    with Simulator(port=0, seed=0) as sim:
+        stages['send_query'] = bench_queries(sim, repeat)
+        stages['acquisition'] = bench_acquisition(sim, repeat)
+        stages['replay'] = bench_replay(sim, repeat)
+    stages['queue_hop'] = bench_queue_hop(repeat)
+    stages['shared_hop'] = bench_queue_hop(repeat, shared=True)
+    stages['plot'] = bench_plot(repeat)
+    stages['save_file'] = bench_save(repeat)
+    stages['startup'] = bench_startup(repeat)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HP4195A reader benchmarks')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='file the results are written to')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slow down of the median before failing')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for stage, cases in results['stages'].items():
+        for case, summary in cases.items():
+            if isinstance(summary, dict):
+                print('{:<12} {:<24} {:10.3f} ms'.format(stage, case, summary['median'] * 1e3))
+            else:
+                print('{:<12} {:<24} {}'.format(stage, case, summary))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for stage, case, previous, current in regressions:
+            print('REGRESSION {} {}: {:.3f} ms -> {:.3f} ms'.format(stage, case, previous * 1e3, current * 1e3))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
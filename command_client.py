@@ -0,0 +1,118 @@
+import time
+import queue
+import logging
+import itertools
+from PyQt5 import QtCore
+from metrics import Metrics
+
+
+class Request(object):
+    def __init__(self, request_id, command, args, callback, deadline):
+        self.request_id = request_id
+        self.command = command
+        self.args = args
+        self.callback = callback
+        self.deadline = deadline
+        self.submitted = time.perf_counter()
+
+
+class CommandClient(QtCore.QObject):
+    '''
+    This class sends requests to the device process without blocking the Qt
+    event loop. Each request is put on the command queue as a (request_id,
+    command, args) tuple and its callback is called with (success, payload)
+    once the matching reply arrives on the message queue. Replies are picked
+    up by a timer while requests are in flight, so several can be queued at
+    once, and requests can time out or be cancelled.
+    '''
+    def __init__(self, command_queue, message_queue, poll_interval=20, parent=None,
+                 metrics=None):
+        super(CommandClient, self).__init__(parent)
+        self.command_queue = command_queue
+        self.message_queue = message_queue
+        self.logger = logging.getLogger(__name__)
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(poll_interval)
+        self.timer.timeout.connect(self.poll)
+
+    def submit(self, command, *args, callback=None, timeout=None):
+        '''
+        Queues a command for the device process and returns its request ID.
+        '''
+        request_id = next(self.ids)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.pending[request_id] = Request(request_id, command, args, callback, deadline)
+        self.command_queue.put((request_id, command, args))
+        self.logger.info('Submitted \"{}\" ({})'.format(command, request_id))
+        if not self.timer.isActive():
+            self.timer.start()
+        return request_id
+
+    def busy(self, command=None):
+        return any(command is None or r.command == command for r in self.pending.values())
+
+    def cancel(self, request_id, reason='Cancelled'):
+        '''
+        Forgets a request and calls its callback with a failure. The device
+        process drops it if it has not started on it yet, a reply that still
+        arrives is ignored.
+        '''
+        request = self.pending.pop(request_id, None)
+        if request is None:
+            return
+        self.command_queue.put((None, 'cancel', (request_id,)))
+        self.logger.info('{} \"{}\" ({})'.format(reason, request.command, request_id))
+        self.metrics.count('requests_cancelled')
+        self.finish(request, False, reason)
+
+    def cancel_all(self):
+        for request_id in list(self.pending):
+            self.cancel(request_id)
+
+    def poll(self):
+        while True:
+            try:
+                message = self.message_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.dispatch(message)
+
+        now = time.monotonic()
+        for request in list(self.pending.values()):
+            if request.deadline is not None and now > request.deadline:
+                self.cancel(request.request_id, reason='Timed out')
+
+        if not self.pending:
+            self.timer.stop()
+
+    def wait(self, request_id, timeout=None):
+        '''
+        Blocks until the reply to request_id arrives, for use when the event
+        loop is shutting down. Returns False if it timed out.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while request_id in self.pending:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                self.dispatch(self.message_queue.get(timeout=remaining))
+            except queue.Empty:
+                return False
+        return True
+
+    def dispatch(self, message):
+        request_id, success, payload = message
+        request = self.pending.pop(request_id, None)
+        if request is None:
+            self.logger.info('Ignoring reply to request {}'.format(request_id))
+            return
+        self.metrics.observe('request.' + request.command, time.perf_counter() - request.submitted)
+        self.finish(request, success, payload)
+
+    def finish(self, request, success, payload):
+        if request.callback is not None:
+            request.callback(success, payload)
@@ -0,0 +1,97 @@
+import time
+import random
+
+
+class ConnectionManager(object):
+    '''
+    This class keeps track of the link to the controller for the worker
+    process: whether it should be up, when it last carried a reply, when an
+    idle link is due for a health check and when to try to reconnect a
+    dropped one. Reconnects back off exponentially from min_backoff to
+    max_backoff seconds, with some jitter so that workers sharing a
+    controller do not retry in step. The first attempt after a drop is
+    made straight away.
+
+    It also caches the outcome of the handshake for each host and port, so
+    a reconnect can skip the identity queries that already succeeded.
+    '''
+    def __init__(self, health_interval=10, min_backoff=1, max_backoff=60):
+        self.health_interval = health_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.wanted = False
+        self.up = False
+        self.attempts = 0
+        self.next_attempt = None
+        self.last_activity = 0
+        self.handshakes = {}
+
+    @property
+    def reconnecting(self):
+        return self.wanted and not self.up
+
+    def established(self):
+        self.wanted = True
+        self.up = True
+        self.attempts = 0
+        self.next_attempt = None
+        self.activity()
+
+    def closed(self):
+        '''
+        Called for a deliberate disconnect, the link is not reconnected.
+        '''
+        self.wanted = False
+        self.up = False
+        self.next_attempt = None
+
+    def lost(self):
+        '''
+        Marks a live link as dropped and schedules a reconnect if it should
+        be up. Returns True if the link was up until now.
+        '''
+        if not self.up:
+            return False
+        self.up = False
+        if self.wanted:
+            self.next_attempt = time.monotonic()
+        return True
+
+    def failed(self):
+        '''
+        Schedules the next attempt after a failed reconnect, returns the
+        delay in seconds.
+        '''
+        self.attempts += 1
+        delay = min(self.max_backoff, self.min_backoff * 2 ** (self.attempts - 1))
+        delay *= random.uniform(0.8, 1.2)
+        self.next_attempt = time.monotonic() + delay
+        return delay
+
+    def activity(self):
+        self.last_activity = time.monotonic()
+
+    def reconnect_due(self):
+        return self.reconnecting and self.next_attempt is not None and \
+            time.monotonic() >= self.next_attempt
+
+    def health_check_due(self):
+        return self.up and self.health_interval > 0 and \
+            time.monotonic() - self.last_activity >= self.health_interval
+
+    def next_due(self):
+        '''
+        Returns the seconds until the next reconnect attempt or health check,
+        or None if neither is pending.
+        '''
+        if self.reconnecting and self.next_attempt is not None:
+            return max(0, self.next_attempt - time.monotonic())
+        if self.up and self.health_interval > 0:
+            return max(0, self.last_activity + self.health_interval - time.monotonic())
+        return None
+
+    def handshake_done(self, link):
+        return self.handshakes.get(link, set())
+
+    def record_handshake(self, link, checked):
+        self.handshakes[link] = set(checked)
@@ -0,0 +1,78 @@
+'''
+Level of detail reduction for drawing many sweeps. Traces are reduced to
+screen resolution before they are handed to Matplotlib, keeping the minimum
+and maximum of each screen column so that narrow peaks are not lost. All
+functions work on a shared frequency axis and 2-D arrays with one row per
+sweep in one vectorised step.
+'''
+import numpy as np
+
+
+def column_starts(freq_data, width, log=True):
+    '''
+    Splits the frequency axis into width columns of equal size on screen
+    (in log10 of the frequency for a log axis) and returns the index of the
+    first point in each column, columns without a point are dropped.
+    '''
+    position = np.log10(freq_data) if log else np.asarray(freq_data)
+    edges = np.linspace(position[0], position[-1], int(width) + 1)[:-1]
+    starts = np.unique(np.searchsorted(position, edges, 'left'))
+    return starts[starts < len(position)]
+
+
+def minmax_decimate(freq_data, data, width, log=True):
+    '''
+    Returns (freq, data) reduced to the minimum and maximum of each screen
+    column, two points per column. data can be one trace or a 2-D array of
+    traces, traces that already fit in 2 * width points are returned as is.
+    '''
+    freq_data = np.asarray(freq_data)
+    data = np.asarray(data)
+    if len(freq_data) <= 2 * width:
+        return freq_data, data
+    starts = column_starts(freq_data, width, log)
+    low = np.minimum.reduceat(data, starts, axis=-1)
+    high = np.maximum.reduceat(data, starts, axis=-1)
+    freq = np.repeat(freq_data[starts], 2)
+    return freq, np.stack((low, high), axis=-1).reshape(data.shape[:-1] + (-1,))
+
+
+def envelope(freq_data, data, width, log=True):
+    '''
+    Returns (freq, low, high), the minimum and maximum over all traces at
+    each point, reduced to screen columns.
+    '''
+    low = data.min(axis=0)
+    high = data.max(axis=0)
+    freq_data = np.asarray(freq_data)
+    if len(freq_data) <= 2 * width:
+        return freq_data, low, high
+    starts = column_starts(freq_data, width, log)
+    return (freq_data[starts],
+            np.minimum.reduceat(low, starts),
+            np.maximum.reduceat(high, starts))
+
+
+def resample_image(freq_data, data, width, height, log=True):
+    '''
+    Resamples a 2-D array of traces onto an image of at most height rows by
+    width columns spread evenly across the frequency span on screen. When
+    there are more points or sweeps than pixels each pixel keeps the
+    maximum of the values it covers, otherwise the nearest point is used.
+    '''
+    freq_data = np.asarray(freq_data)
+    position = np.log10(freq_data) if log else freq_data
+    if len(freq_data) > width:
+        starts = column_starts(freq_data, width, log)
+        data = np.maximum.reduceat(data, starts, axis=1)
+        position = position[starts]
+    centres = np.linspace(position[0], position[-1], int(width))
+    nearest = np.clip(np.searchsorted(position, centres), 1, len(position) - 1)
+    left = position[nearest - 1]
+    right = position[nearest]
+    nearest -= (centres - left) < (right - centres)
+    image = data[:, nearest]
+    if len(image) > height:
+        rows = np.unique(np.linspace(0, len(image), int(height), endpoint=False).astype(int))
+        image = np.maximum.reduceat(image, rows, axis=0)
+    return image
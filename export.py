@@ -0,0 +1,121 @@
+'''
+Functions for saving sweeps to disk. Every writer takes the frequency,
+magnitude (dB) and phase (degrees) data either as 1-D arrays for a single
+sweep or as 2-D arrays with one row per sweep, and writes them in one
+vectorised step.
+'''
+import os
+import numpy as np
+
+
+FORMATS = ('.csv', '.txt', '.npz', '.s1p', '.s2p')
+
+
+def as_sweeps(data):
+    '''
+    Returns the data as a 2-D array with one row per sweep.
+    '''
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
+        return data[np.newaxis, :]
+    return data
+
+
+def save_csv(file_name, freq_data, mag_data, phase_data, delimiter=','):
+    '''
+    Writes a Frequency, Magnitude, Phase table. Several sweeps on the same
+    frequency axis share one Frequency column followed by a Magnitude and
+    Phase column per sweep, sweeps on different axes each get their own
+    Frequency column.
+    '''
+    freq_data = as_sweeps(freq_data)
+    mag_data = as_sweeps(mag_data)
+    phase_data = as_sweeps(phase_data)
+    sweeps = len(mag_data)
+    if sweeps == 1:
+        header = ['Frequency', 'Magnitude', 'Phase']
+        columns = [freq_data[0], mag_data[0], phase_data[0]]
+    elif np.all(freq_data == freq_data[0]):
+        header = ['Frequency']
+        for i in range(sweeps):
+            header += ['Magnitude_{}'.format(i), 'Phase_{}'.format(i)]
+        columns = [freq_data[0]]
+        columns += list(np.stack((mag_data, phase_data), axis=1).reshape(2 * sweeps, -1))
+    else:
+        header = []
+        for i in range(sweeps):
+            header += ['Frequency_{}'.format(i), 'Magnitude_{}'.format(i), 'Phase_{}'.format(i)]
+        columns = list(np.stack((freq_data, mag_data, phase_data), axis=1).reshape(3 * sweeps, -1))
+    np.savetxt(file_name, np.column_stack(columns), delimiter=delimiter,
+               header=delimiter.join(header), comments='', fmt='%.10g')
+
+
+def save_npz(file_name, freq_data, mag_data, phase_data, **metadata):
+    '''
+    Writes the sweeps as 2-D arrays to a compressed NumPy archive, extra
+    keyword arguments (timestamps, settings) are stored alongside them.
+    '''
+    np.savez_compressed(file_name,
+                        freq_data=as_sweeps(freq_data),
+                        mag_data=as_sweeps(mag_data),
+                        phase_data=as_sweeps(phase_data),
+                        **metadata)
+
+
+def to_complex(mag_data, phase_data):
+    '''
+    Converts magnitude in dB and phase in degrees to complex S-parameters.
+    '''
+    return 10 ** (np.asarray(mag_data) / 20) * np.exp(1j * np.radians(phase_data))
+
+
+def save_touchstone(file_name, freq_data, mag_data, phase_data, ports=1,
+                    reference=50):
+    '''
+    Writes a Touchstone file per sweep. A .s1p file holds the measurement
+    as S11 in dB/angle format. A .s2p file holds it as S21 in real/imaginary
+    format with the unmeasured parameters set to zero. With several sweeps
+    the files are numbered name_0000.s1p, name_0001.s1p and so on.
+    '''
+    freq_data = as_sweeps(freq_data)
+    mag_data = as_sweeps(mag_data)
+    phase_data = as_sweeps(phase_data)
+    base, ext = os.path.splitext(file_name)
+    ext = ext or '.s{}p'.format(ports)
+    names = [base + ext] if len(mag_data) == 1 else \
+        ['{}_{:04d}{}'.format(base, i, ext) for i in range(len(mag_data))]
+
+    for name, freq, mag, phase in zip(names, freq_data, mag_data, phase_data):
+        if ports == 1:
+            header = '# Hz S DB R {}'.format(reference)
+            table = np.column_stack((freq, mag, phase))
+        else:
+            header = '! S21 measured, S11 S12 S22 not measured\n# Hz S RI R {}'.format(reference)
+            s21 = to_complex(mag, phase)
+            zeros = np.zeros_like(freq)
+            table = np.column_stack((freq, zeros, zeros, s21.real, s21.imag,
+                                     zeros, zeros, zeros, zeros))
+        np.savetxt(name, table, header=header, comments='', fmt='%.10g')
+    return names
+
+
+def export(file_name, freq_data, mag_data, phase_data, **metadata):
+    '''
+    Saves sweeps in the format given by the file extension, a name without
+    an extension is saved as CSV. Returns the list of the names of the files
+    written, Touchstone files hold one sweep each.
+    '''
+    base, ext = os.path.splitext(file_name)
+    ext = ext.lower()
+    if ext not in FORMATS:
+        file_name = file_name + '.csv'
+        ext = '.csv'
+
+    if ext in ('.csv', '.txt'):
+        save_csv(file_name, freq_data, mag_data, phase_data)
+    elif ext == '.npz':
+        save_npz(file_name, freq_data, mag_data, phase_data, **metadata)
+    else:
+        return save_touchstone(file_name, freq_data, mag_data, phase_data,
+                               ports=int(ext[2]))
+    return [file_name]
@@ -0,0 +1,297 @@
+'''
+Recording and replay of the traffic on the Prologix link. A recorder saves
+every byte written to and read from the controller with a timestamp, and a
+replay serves a recorded session to the driver in place of the socket,
+either as fast as possible or at the recorded pace. The framing, parsing,
+queueing and plotting can then be exercised and profiled on a real session
+without an instrument attached.
+
+Both plug into AsyncPrologixTransport as its connector, the function it
+opens its streams with:
+
+    recorder = SessionRecorder('bench.gpib')
+    transport = PrologixTransport(connector=recorder.open_connection)
+
+    replay = SessionReplay('bench.gpib', realtime=False)
+    transport = PrologixTransport(connector=replay.open_connection)
+
+A session file starts with the magic bytes and the wall clock time the
+recording started, followed by one record per event: a little-endian
+header of the time since the start (f8), the event kind (u1) and the data
+length (u4), then the data.
+'''
+import sys
+import time
+import struct
+import asyncio
+import logging
+import argparse
+
+
+MAGIC = b'HPGPIB01'
+HEADER = struct.Struct('<8sd')
+EVENT = struct.Struct('<dBI')
+
+# event kinds, a connect carries 'host:port', writes and reads carry the
+# bytes as they went over the link
+CONNECT = 0
+WRITE = 1
+READ = 2
+CLOSE = 3
+KINDS = ('connect', 'write', 'read', 'close')
+
+
+def read_session(file_name):
+    '''
+    Returns the start time and the list of (time, kind, data) events of a
+    session file.
+    '''
+    with open(file_name, 'rb') as f:
+        content = f.read()
+    if len(content) < HEADER.size:
+        raise ValueError('{} is not a session file'.format(file_name))
+    magic, started = HEADER.unpack_from(content)
+    if magic != MAGIC:
+        raise ValueError('{} is not a session file'.format(file_name))
+    events = []
+    offset = HEADER.size
+    while offset + EVENT.size <= len(content):
+        timestamp, kind, length = EVENT.unpack_from(content, offset)
+        offset += EVENT.size
+        events.append((timestamp, kind, content[offset:offset + length]))
+        offset += length
+    return started, events
+
+
+class SessionRecorder(object):
+    '''
+    This class writes the traffic of every connection opened through
+    open_connection to a session file. Reads, connects and closes are
+    flushed to disk straight away so a session that ends in a crash is
+    still complete up to the last reply.
+    '''
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.started = time.monotonic()
+        self.events = 0
+        self.file = open(file_name, 'wb')
+        self.file.write(HEADER.pack(MAGIC, time.time()))
+        self.file.flush()
+
+    def record(self, kind, data=b''):
+        if self.file is None:
+            return
+        self.file.write(EVENT.pack(time.monotonic() - self.started, kind, len(data)))
+        self.file.write(data)
+        self.events += 1
+        if kind != WRITE:
+            self.file.flush()
+
+    async def open_connection(self, host, port, **kwargs):
+        reader, writer = await asyncio.open_connection(host, port, **kwargs)
+        self.record(CONNECT, '{}:{}'.format(host, port).encode('ascii'))
+        return RecordingReader(reader, self), RecordingWriter(writer, self)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class RecordingReader(object):
+    '''
+    This class passes the reads of AsyncPrologixTransport on to a stream
+    reader and records the bytes they return.
+    '''
+    def __init__(self, reader, recorder):
+        self.reader = reader
+        self.recorder = recorder
+
+    async def recorded(self, operation):
+        try:
+            data = await operation
+        except asyncio.IncompleteReadError as e:
+            self.recorder.record(READ, e.partial)
+            self.recorder.record(CLOSE)
+            raise
+        if data:
+            self.recorder.record(READ, data)
+        else:
+            self.recorder.record(CLOSE)
+        return data
+
+    async def readuntil(self, separator=b'\n'):
+        return await self.recorded(self.reader.readuntil(separator))
+
+    async def readexactly(self, n):
+        return await self.recorded(self.reader.readexactly(n))
+
+    async def read(self, n=-1):
+        return await self.recorded(self.reader.read(n))
+
+
+class RecordingWriter(object):
+    '''
+    This class passes writes on to a stream writer and records them.
+    '''
+    def __init__(self, writer, recorder):
+        self.writer = writer
+        self.recorder = recorder
+
+    def write(self, data):
+        self.recorder.record(WRITE, data)
+        self.writer.write(data)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def is_closing(self):
+        return self.writer.is_closing()
+
+    def close(self):
+        self.recorder.record(CLOSE)
+        self.writer.close()
+
+    async def wait_closed(self):
+        await self.writer.wait_closed()
+
+
+class SessionReplay(object):
+    '''
+    This class serves a recorded session in place of the controller. Each
+    call of open_connection replays the next connection in the file. What
+    the driver writes is compared with the recording, and once it has
+    written what was recorded the replies that followed are fed to it,
+    straight away or, with realtime, after the recorded delay divided by
+    speed. At the end of a connection the stream is closed, so further
+    reads fail as if the controller had hung up. With strict a write that
+    differs from the recording raises ConnectionError, otherwise it is
+    counted in mismatches and logged.
+    '''
+    def __init__(self, file_name, realtime=False, speed=1.0, strict=False):
+        self.file_name = file_name
+        self.realtime = realtime
+        self.speed = speed
+        self.strict = strict
+        self.started, self.events = read_session(file_name)
+        self.position = 0
+        self.mismatches = 0
+        self.logger = logging.getLogger(__name__)
+
+    async def open_connection(self, host, port, limit=2 ** 16, **kwargs):
+        while self.position < len(self.events) and self.events[self.position][1] != CONNECT:
+            self.position += 1
+        if self.position == len(self.events):
+            raise ConnectionRefusedError('No more connections in {}'.format(self.file_name))
+        start = self.position + 1
+        self.position = start
+        while self.position < len(self.events) and self.events[self.position][1] != CONNECT:
+            self.position += 1
+        reader = asyncio.StreamReader(limit=limit)
+        connection = ReplayConnection(self, reader, self.events[start:self.position])
+        connection.release()
+        return reader, connection
+
+    def mismatch(self, expected, written):
+        self.mismatches += 1
+        message = 'Replay expected {!r}, driver wrote {!r}'.format(expected[:40], written[:40])
+        if self.strict:
+            raise ConnectionError(message)
+        if self.mismatches <= 10:
+            self.logger.warning(message)
+
+
+class ReplayConnection(object):
+    '''
+    This class is the writer side of one replayed connection, it matches the
+    driver's writes against the recorded ones and releases the recorded
+    replies into the reader.
+    '''
+    def __init__(self, session, reader, events):
+        self.session = session
+        self.reader = reader
+        self.events = events
+        self.index = 0
+        self.expected = b''
+        self.anchor = events[0][0] if events else 0
+        self.written = time.monotonic()
+        self.closed = False
+        self.finished = False
+
+    def write(self, data):
+        data = bytes(data)
+        while data:
+            if not self.expected:
+                if self.index >= len(self.events):
+                    # the reader has been closed, so the driver sees the
+                    # controller hang up
+                    if not self.finished:
+                        self.session.logger.info('Reached the end of the recorded connection')
+                        self.finished = True
+                    return
+                self.anchor, kind, self.expected = self.events[self.index]
+                self.index += 1
+                self.written = time.monotonic()
+            n = min(len(data), len(self.expected))
+            if data[:n] != self.expected[:n]:
+                self.session.mismatch(self.expected, data)
+            data, self.expected = data[n:], self.expected[n:]
+            if not self.expected:
+                self.release()
+
+    def release(self):
+        '''
+        Feeds the reads recorded after the last matched write to the reader,
+        up to the next write.
+        '''
+        loop = asyncio.get_event_loop()
+        delay = 0
+        while self.index < len(self.events):
+            timestamp, kind, data = self.events[self.index]
+            if kind == WRITE:
+                return
+            self.index += 1
+            if self.session.realtime:
+                delay = max(delay, (timestamp - self.anchor) / self.session.speed -
+                            (time.monotonic() - self.written))
+            if kind == CLOSE:
+                break
+            self.feed(loop, delay, self.reader.feed_data, data)
+        # the end of the connection, after any replies still on their way
+        self.feed(loop, delay, self.reader.feed_eof)
+
+    def feed(self, loop, delay, action, *args):
+        if delay > 0:
+            loop.call_later(delay, action, *args)
+        else:
+            action(*args)
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='List the events of a recorded GPIB session')
+    parser.add_argument('file_name')
+    parser.add_argument('-w', '--width', type=int, default=60,
+                        help='bytes of data shown per event')
+    args = parser.parse_args(argv)
+    started, events = read_session(args.file_name)
+    print('Recorded {}, {} events'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)), len(events)))
+    for timestamp, kind, data in events:
+        text = repr(data[:args.width])[2:-1] + ('...' if len(data) > args.width else '')
+        print('{:12.6f} {:<8}{:>8} {}'.format(timestamp, KINDS[kind], len(data), text))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,165 +1,1152 @@
+import re
 import sys
 import os
 import time
-import telnetlib
+import queue
+import collections
 import multiprocessing
 import numpy as np
 import logging
-import logging.handlers
-import numpy.core._methods
-import numpy.lib.format
+
+from prologix import PrologixTransport
+from gpib_session import SessionRecorder, SessionReplay
+from connection_manager import ConnectionManager
+from trace_buffer import TraceRingBuffer
+from sweep_archive import SweepArchive
+from trace_monitor import TraceMonitor, format_event
+from metrics import Metrics, command_name
+import multi_logging as ml
+import analysis
+
+
+# HP4195A output data formats, selected with the FMTn command. The binary
+# formats return each trace as an IEEE 728 '#A' block: the two characters
+# '#A', a 16-bit big-endian byte count and then big-endian IEEE floats.
+ASCII_FORMAT = 'FMT1'
+BINARY_FORMATS = {'FMT2': np.dtype('>f8'),
+                  'FMT3': np.dtype('>f4')}
+
+# commands that change the frequency axis, a trailing '?' is a query of the
+# setting rather than a change. SWTn selects the sweep type (linear or log
+# frequency) and so changes the axis, SWTRG only triggers a sweep.
+SETTINGS_COMMANDS = re.compile(r'\b(START|STOP|CENTER|SPAN|NOP|SWT(?:\d|\s*=)|FNC|IP|RST)(?!\?)', re.IGNORECASE)
+SETTINGS_QUERIES = ('START?', 'STOP?', 'NOP?', 'SWT?')
+
+# data registers, returned as binary blocks in FMT2 and FMT3
+TRACE_REGISTERS = ('A?', 'B?', 'C?', 'D?', 'X?')
+
+# controller commands that take no argument and do not reply
+SILENT_CONTROLLER_COMMANDS = ('++clr', '++ifc', '++llo', '++loc', '++rst', '++trg')
+
+# sweep control: SWM1 sweeps continuously, SWM2 sweeps once each time it is
+# triggered with SWTRG. The end of a sweep sets STATUS_SWEEP_END in the
+# status byte, which raises a service request once it is in the RQS mask.
+CONTINUOUS_SWEEP = 'SWM1'
+SINGLE_SWEEP = 'SWM2'
+SWEEP_TRIGGER = 'SWTRG'
+STATUS_SWEEP_END = 0x10
+
+DEFAULT_HOST = 'bi-gpib-01.dyndns.cern.ch'
+DEFAULT_PORT = 1234
+
+
+def parse_ascii_trace(raw_data):
+    '''
+    Parses a comma separated ASCII trace, returns an empty array if the
+    response is not a list of numbers.
+    '''
+    try:
+        return np.array(raw_data.split(','), dtype=float)
+    except ValueError:
+        return np.array([], dtype=float)
+
+
+def parse_binary_trace(block, data_format):
+    '''
+    Decodes the payload of a binary block without copying it. A block that
+    still has its '#A' header is checked against the length in the header.
+    Raises ValueError if the length does not fit the header or is not a
+    whole number of values.
+    '''
+    dtype = BINARY_FORMATS[data_format]
+    if block[:2] == b'#A':
+        if len(block) < 4 or int.from_bytes(block[2:4], 'big') != len(block) - 4:
+            raise ValueError('Block of {} bytes does not match its header'.format(len(block)))
+        block = block[4:]
+    if len(block) % dtype.itemsize:
+        raise ValueError('Block of {} bytes is not a whole number of {} byte values'.format(len(block), dtype.itemsize))
+    return np.frombuffer(block, dtype=dtype)
+
+
+def expects_reply(command):
+    '''
+    Returns True if a command makes the instrument or controller reply:
+    instrument queries end in '?' and controller commands reply when given
+    without an argument.
+    '''
+    command = command.strip()
+    if command.endswith('?'):
+        return True
+    if command.startswith('++'):
+        return len(command.split()) == 1 and command.lower() not in SILENT_CONTROLLER_COMMANDS
+    return False
 
 
 class hp4195a(multiprocessing.Process):
-    def __init__(self, command_queue, message_queue, data_queue, logger_queue):
+    def __init__(self, command_queue, message_queue, data_queue, logger_queue,
+                 data_format=ASCII_FORMAT, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 trace_channel=None, gpib_addr=11, archive_path=None,
+                 metrics=False, metrics_path=None, metrics_interval=5,
+                 log_level=logging.INFO, log_every=100,
+                 record_path=None, replay_path=None, replay_realtime=False,
+                 triggered=True, monitor=None, event_queue=None,
+                 settings_check_interval=5):
         super(hp4195a, self).__init__()
         self.command_queue = command_queue
         self.message_queue = message_queue
         self.data_queue = data_queue
         self.logging_queue = logger_queue
+        # log records go to the GUI process in batches, the per-query and
+        # per-sweep messages are DEBUG or sampled so continuous acquisition
+        # does not flood the logging queue
+        self.log_level = log_level
+        self.sample = ml.Sampler(logging.getLogger(__name__), log_every)
+        self.trace_channel = trace_channel
 
         self.mag_data = []
         self.phase_data = []
         self.freq_data = []
 
-        self.host = 'bi-gpib-01.dyndns.cern.ch'
-        self.port = '1234'
-        self.gpib_addr = 11
+        self.host = host
+        self.port = int(port)
+        # several analysers can share one controller on different GPIB
+        # addresses, the controller is switched between them with ++addr
+        if isinstance(gpib_addr, int):
+            gpib_addr = [gpib_addr]
+        self.gpib_addrs = list(gpib_addr)
+        self.gpib_addr = self.gpib_addrs[0]
+        self.active_addr = None
 
         self.telnet_id = 'Prologix GPIB-ETHERNET Controller version 01.06.06.00'
         self.device_id = 'HP4195A'
 
+        # ASCII is the default; pass 'FMT2' or 'FMT3' to transfer traces as
+        # binary blocks instead of comma separated text
+        if data_format != ASCII_FORMAT and data_format not in BINARY_FORMATS:
+            raise ValueError('Unknown data format: {}'.format(data_format))
+        self.data_format = data_format
+
+        # responses are framed on the line terminator (or the block length for
+        # binary traces) so a query returns as soon as its reply is complete,
+        # the timeouts are only the deadline for a reply that never arrives
+        self.query_timeout = 3
+        self.command_timeouts = {'A?': 10, 'B?': 10, 'X?': 10}
+        self.connect_timeout = 10
+        self.transport = None
+        # with record_path every byte exchanged with the controller is saved
+        # to a session file, with replay_path a recorded session stands in
+        # for the controller, replayed as fast as possible or at the
+        # recorded pace with replay_realtime
+        self.record_path = record_path
+        self.replay_path = replay_path
+        self.replay_realtime = replay_realtime
+
+        # once connected the link is kept up: an idle link is checked with
+        # ++ver every health_interval seconds, and a dropped one is
+        # reconnected with backoff, skipping the identity queries of the
+        # handshake that already succeeded on it. A replay is not checked as
+        # the checks would not match the recording.
+        self.connection = ConnectionManager()
+        if replay_path is not None:
+            self.connection.health_interval = 0
+        # the queries of a sweep are sent back to back and their replies read
+        # as they arrive, set to False to send them one at a time
+        self.pipeline = True
+
+        # in triggered mode the analyser is put in single sweep mode, each
+        # acquisition triggers a sweep and the traces are read as soon as the
+        # status byte reports its end. The controller's SRQ line is polled
+        # every poll_interval seconds with ++srq, which does not touch the
+        # bus, and the status byte is read with ++spoll once it is raised.
+        # If the end of a sweep is not reported the driver falls back to
+        # reading the free-running sweep until it reconnects.
+        self.trigger_sweeps = triggered
+        self.triggered = triggered
+        self.sweep_timeout = 30
+        self.poll_interval = 0.005
+
+        # the most recent sweeps are kept in a ring buffer, continuous
+        # acquisition only publishes a sweep when the GUI has consumed the
+        # previous ones, so a slow display drops frames instead of growing
+        # data_queue
+        self.continuous = False
+        self.sweep_rate = 0
+        self.next_sweep = 0
+        self.buffer_size = 100
+        self.max_points = 401
+        self.max_pending = 2
+        self.max_failures = 5
+        self.failures = 0
+
+        # the frequency axis only changes with the sweep settings, so it is
+        # cached per settings and X? is only read for settings not seen before.
+        # The settings are checked with short queries always after a command
+        # that changes them and otherwise every settings_check_interval
+        # seconds, 0 checks them with every sweep. A change of the number of
+        # points on the front panel is noticed at the next sweep from the
+        # trace lengths, but a start or stop change that keeps the number of
+        # points goes unnoticed for up to settings_check_interval seconds.
+        self.freq_cache = collections.OrderedDict()
+        self.freq_cache_size = 16
+        self.settings_key = None
+        self.settings_checked = 0
+        self.settings_check_interval = settings_check_interval
+        self.settings_supported = True
+
+        # an adaptive sweep takes a coarse sweep of coarse_points, finds the
+        # peaks, notches and phase zero crossings in it and sweeps up to
+        # max_segments narrow spans reaching segment_width coarse points
+        # either side of them. Unless sweeps are triggered, the analyser is
+        # given segment_settle seconds to complete a sweep after each change
+        # of span. The points are shared out so the stitched trace fits in
+        # max_points.
+        self.coarse_points = 101
+        self.max_segments = 4
+        self.segment_width = 3
+        self.segment_settle = 0.5
+        self.feature_prominence = 3
+
+        # every sweep is also appended to the archive file when one is open
+        self.archive_path = archive_path
+        self.archive = None
+
+        # with monitor, a dict of TraceMonitor options, continuous sweeps are
+        # only published and sweeps only archived when they changed, broke
+        # a mask limit or are due as a heartbeat. Requested sweeps are
+        # always replied to. Alarm events are logged, kept in alarms and put
+        # on event_queue if one is given.
+        self.monitor = TraceMonitor(**monitor) if monitor is not None else None
+        self.event_queue = event_queue
+        self.alarms = collections.deque(maxlen=100)
+        self.published = True
+
+        # requests are (request_id, command, args) tuples, replies are
+        # (request_id, success, payload) tuples on the message queue
+        self.request_id = None
+        self.backlog = collections.deque()
+
+        # latency, throughput and queue metrics are off by default, with a
+        # metrics_path they are also written to that file every
+        # metrics_interval seconds
+        self.metrics = Metrics(metrics or metrics_path is not None)
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self.metrics_due = 0
+
     def run(self):
         '''
         This function will run when the class is launched as a separate
         process.
         '''
-        self.qh = logging.handlers.QueueHandler(self.logging_queue)
+        self.qh = ml.BatchingQueueHandler(self.logging_queue)
         self.root = logging.getLogger()
-        self.root.setLevel(logging.DEBUG)
+        self.root.setLevel(self.log_level)
         self.root.addHandler(self.qh)
         self.logger = logging.getLogger(__name__)
 
-        while True:
-            self.command = self.command_queue.get()
-            self.logger.info('Received \"{}\" from GUI'.format(self.command))
-            self.logger.info('Command queue size = {}'.format(self.command_queue.qsize()))
-
-            if self.command == 'connect':
-                self.logger.info('Connecting to HP4195A')
-                self.telnet_connect()
-
-            elif self.command == 'disconnect':
-                self.logger.info('Disconnecting from HP4195A')
-                self.telnet_disconnect()
-
-            elif self.command == 'start_acquisition':
-                self.logger.info('Starting data acquisition')
-                if self.acquire_mag_data():
-                    if self.acquire_phase_data():
-                        if self.acquire_freq_data():
-                            self.logger.info('Acquired data OK')
-                        else:
-                            self.logger.warning('Frequency data acquisition failed')
-                            self.message_queue.put(False)
-                    else:
-                        self.logger.warning('Phase data acquisition failed')
-                        self.message_queue.put(False)
-                else:
-                    self.logger.warning('Magnitude data acquisition failed')
-                    self.message_queue.put(False)
-
-                mag_check = len(self.mag_data) == len(self.freq_data)
-                phase_check = len(self.phase_data) == len(self.freq_data)
-
-                if mag_check and phase_check:
-                    self.logger.info('Data length check passed ({}, {}, {})'.format(len(self.mag_data),len(self.phase_data),len(self.freq_data)))
-                    self.message_queue.put(True)
-                    self.data_queue.put(self.mag_data)
-                    self.data_queue.put(self.phase_data)
-                    self.data_queue.put(self.freq_data)
-                    self.mag_data = []
-                    self.phase_data = []
-                    self.freq_data = []
-                else:
-                    self.logger.warning('Data length check failed ({}, {}, {})'.format(len(self.mag_data),len(self.phase_data),len(self.freq_data)))
-                    self.message_queue.put(False)
-
-            elif self.command == 'send_command':
-                self.command =  self.command_queue.get()
-                self.logger.info('Sending GPIB command: {}'.format(self.command))
-                self.response = self.send_query(self.command)
-                self.logger.info('Response: {}'.format(self.response))
-                self.data_queue.put(self.response)
+        self.metrics.add_source(self.metrics_gauges)
+
+        self.trace_buffer = TraceRingBuffer(self.buffer_size, self.max_points)
+        if self.archive_path is not None:
+            self.open_archive(self.archive_path)
+
+        self.running = True
+        while self.running:
+            # sweeps wait while the link is being reconnected
+            sweeping = self.continuous and not self.connection.reconnecting
+            timeouts = []
+            if sweeping:
+                timeouts.append(self.next_sweep - time.monotonic())
+            if self.metrics_path is not None:
+                timeouts.append(self.metrics_due - time.monotonic())
+            connection_timeout = self.connection.next_due()
+            if connection_timeout is not None:
+                timeouts.append(connection_timeout)
+            request = self.next_request(max(0, min(timeouts)) if timeouts else None)
+            self.write_metrics()
+            self.maintain_connection()
+            if request is None:
+                if sweeping and time.monotonic() >= self.next_sweep:
+                    try:
+                        self.continuous_sweep()
+                    except Exception:
+                        self.logger.exception('Continuous sweep failed')
+                        self.sweep_failed()
+                continue
+            self.request_id, self.command, args = request
+            self.logger.info('Received \"{}\" ({}) from GUI'.format(self.command, self.request_id))
+            if self.sample('command_queue'):
+                self.logger.debug('Command queue size = {}'.format(self.command_queue.qsize()))
+            try:
+                with self.metrics.timer('command.' + self.command):
+                    self.handle_command(self.command, args)
+            except Exception as e:
+                self.logger.exception('Command \"{}\" failed'.format(self.command))
+                self.metrics.count('command_errors')
+                self.reply(False, str(e))
+        self.shutdown()
+
+    def shutdown(self):
+        '''
+        Closes the link and the archive and flushes the log records before
+        run returns, so the process exits without being terminated while it
+        holds the lock of a queue it shares with the GUI process. Sweeps
+        still waiting for the GUI are dropped.
+        '''
+        self.continuous = False
+        self.close_archive()
+        if self.transport is not None:
+            self.transport.close()
+        self.data_queue.cancel_join_thread()
+        if self.event_queue is not None:
+            self.event_queue.cancel_join_thread()
+        self.logger.info('Device process stopped')
+        self.reply(True)
+        self.root.removeHandler(self.qh)
+        self.qh.close()
+
+    def next_request(self, timeout=None):
+        '''
+        Returns the next (request_id, command, args) request, or None if the
+        timeout expires first. Requests waiting on the command queue are moved
+        into a local backlog so that a cancellation can overtake the request
+        it refers to.
+        '''
+        try:
+            while True:
+                self.queue_request(self.command_queue.get_nowait())
+        except queue.Empty:
+            pass
+        while not self.backlog:
+            try:
+                self.queue_request(self.command_queue.get(timeout=timeout))
+            except queue.Empty:
+                return None
+        return self.backlog.popleft()
+
+    def queue_request(self, request):
+        request_id, command, args = request
+        if command != 'cancel':
+            self.backlog.append(request)
+            return
+        for pending in self.backlog:
+            if pending[0] == args[0]:
+                self.backlog.remove(pending)
+                self.logger.info('Cancelled \"{}\" ({})'.format(pending[1], pending[0]))
+                break
+
+    def reply(self, success, payload=None):
+        '''
+        Answers the request being handled with a (request_id, success,
+        payload) message.
+        '''
+        self.message_queue.put((self.request_id, success, payload))
+
+    def handle_command(self, command, args):
+        if command == 'connect':
+            self.logger.info('Connecting to HP4195A')
+            self.telnet_connect()
+
+        elif command == 'disconnect':
+            self.logger.info('Disconnecting from HP4195A')
+            self.continuous = False
+            if self.archive is not None:
+                self.archive.flush()
+            self.telnet_disconnect()
+
+        elif command == 'shutdown':
+            # run returns and replies once the process is ready to exit
+            self.logger.info('Shutting down')
+            self.running = False
+
+        elif command == 'start_acquisition':
+            self.logger.info('Starting data acquisition')
+            self.select_instrument(args[0] if args else self.gpib_addr)
+            if self.acquire_sweep():
+                sweep = self.store_sweep()
+                self.reply(True, self.sweep_message(sweep))
+            else:
+                self.reply(False, 'Data acquisition failed')
+
+        elif command == 'adaptive_sweep':
+            self.logger.info('Starting adaptive acquisition')
+            self.select_instrument(args[0] if args else self.gpib_addr)
+            if self.acquire_adaptive():
+                sweep = self.store_sweep()
+                self.reply(True, self.sweep_message(sweep))
+            else:
+                self.reply(False, 'Adaptive acquisition failed')
+
+        elif command == 'start_continuous':
+            self.logger.info('Starting continuous acquisition')
+            self.continuous = True
+            self.failures = 0
+            self.next_sweep = time.monotonic()
+            self.reply(True)
+
+        elif command == 'stop_continuous':
+            self.logger.info('Stopping continuous acquisition')
+            self.continuous = False
+            self.reply(True)
+
+        elif command == 'set_sweep_rate':
+            self.sweep_rate = float(args[0])
+            self.logger.info('Sweep rate set to {} sweeps/s'.format(self.sweep_rate or 'max'))
+            self.reply(True)
+
+        elif command == 'open_archive':
+            self.open_archive(args[0])
+            self.reply(True, args[0])
+
+        elif command == 'close_archive':
+            self.close_archive()
+            self.reply(True)
+
+        elif command == 'set_monitor':
+            options = args[0] if args else None
+            self.monitor = TraceMonitor(**options) if options is not None else None
+            self.logger.info('Monitoring {}'.format(options if options is not None else 'off'))
+            self.reply(True)
+
+        elif command == 'set_reference':
+            if self.monitor is None or not len(self.freq_data):
+                self.reply(False, 'No sweep to monitor against')
+            else:
+                self.monitor.set_reference(self.mag_data, self.phase_data, self.freq_data)
+                self.logger.info('Monitoring against a fixed reference sweep')
+                self.reply(True)
+
+        elif command == 'get_alarms':
+            self.reply(True, list(self.alarms))
+
+        elif command == 'get_buffer':
+            self.logger.info('Sending {} buffered sweeps'.format(len(self.trace_buffer)))
+            self.reply(True, self.trace_buffer.snapshot())
+
+        elif command == 'get_metrics':
+            self.reply(True, self.metrics.snapshot())
+
+        elif command == 'enable_metrics':
+            enabled = bool(args[0]) if args else True
+            self.metrics.enable(enabled)
+            self.logger.info('Metrics {}'.format('enabled' if enabled else 'disabled'))
+            self.reply(True, enabled)
+
+        elif command == 'reset_metrics':
+            self.metrics.reset()
+            self.reply(True)
+
+        elif command == 'write_command':
+            # for setting commands that do not reply, nothing is read back
+            self.logger.info('Writing GPIB command: {}'.format(args[0]))
+            self.send_command(args[0])
+            self.reply(True)
+
+        elif command == 'query_batch':
+            commands = list(args[0])
+            self.logger.info('Sending GPIB commands: {}'.format('; '.join(commands)))
+            replies = self.send_batch(commands)
+            if replies is None:
+                self.reply(False, 'Command failed')
+            else:
+                self.reply(True, [self.format_reply(c, r) for c, r in zip(commands, replies)])
+
+        elif command == 'send_command':
+            self.logger.info('Sending GPIB command: {}'.format(args[0]))
+            self.response = self.send_query(args[0])
+            self.logger.info('Response: {}'.format(self.response))
+            self.reply(True, self.response)
+
+        else:
+            self.logger.warning('Unknown command \"{}\"'.format(command))
+            self.reply(False, 'Unknown command')
+
+    def acquire_sweep(self):
+        '''
+        Reads the magnitude, phase and frequency traces of the current sweep.
+        Returns True if all three were read and have matching lengths.
+        '''
+        with self.metrics.timer('sweep'):
+            self.mag_data = []
+            self.phase_data = []
+            self.freq_data = []
+            if self.triggered and not self.trigger_sweep():
+                return False
+            if self.pipeline:
+                acquired = self.acquire_pipelined()
+                if acquired is None:
+                    self.logger.warning('Pipelined acquisition failed, reading the registers one at a time')
+                    acquired = self.acquire_serial()
+            else:
+                acquired = self.acquire_serial()
+            if acquired and len(self.mag_data) == len(self.phase_data) != len(self.freq_data):
+                acquired = self.reload_freq_data()
+            return acquired and self.check_lengths()
+
+    def trigger_sweep(self):
+        '''
+        Starts a single sweep and waits for the status byte to report its
+        end. Returns False if the controller did not reply. If the serial
+        poll is not understood or the end of the sweep is never reported the
+        driver switches back to reading the free-running sweep, and the
+        traces are read as before.
+        '''
+        # the serial poll clears the end of the previous sweep
+        replies = self.send_batch(['++spoll', SWEEP_TRIGGER])
+        if replies is None:
+            return False
+        if not replies[0].strip().isdigit():
+            self.stop_triggering('the serial poll returned {!r}'.format(replies[0]))
+            return True
+        deadline = time.monotonic() + self.sweep_timeout
+        with self.metrics.timer('sweep.wait'):
+            while True:
+                if self.send_query('++srq') == '1':
+                    status = self.send_query('++spoll')
+                    if status.isdigit() and int(status) & STATUS_SWEEP_END:
+                        return True
+                if time.monotonic() >= deadline:
+                    self.stop_triggering('no end of sweep within {} s'.format(self.sweep_timeout))
+                    return True
+                time.sleep(self.poll_interval)
+
+    def stop_triggering(self, reason):
+        self.logger.warning('Triggered sweeps disabled, {}'.format(reason))
+        self.metrics.count('trigger_failures')
+        self.triggered = False
+        try:
+            self.set_sweep_mode()
+        except (TimeoutError, ConnectionError) as e:
+            self.logger.warning('Could not set the sweep mode: {}'.format(e))
+
+    def acquire_pipelined(self):
+        '''
+        Reads the sweep settings (when they are due for a check) and the
+        magnitude and phase registers in one batch, then the frequency axis
+        if it is not cached. Returns None if the batch failed.
+        '''
+        check = self.settings_due()
+        queries = list(SETTINGS_QUERIES) if check else []
+        queries += ['A?', 'B?']
+        replies = self.send_batch(queries)
+        if replies is None:
+            return None
+        key = self.update_settings(replies[:-2]) if check else self.current_settings()
+        self.mag_data = self.parse_trace(replies[-2])
+        self.phase_data = self.parse_trace(replies[-1])
+        if len(self.mag_data) == 0 or len(self.phase_data) == 0:
+            self.logger.warning('Magnitude or phase data acquisition failed')
+            return False
+        if not self.load_freq_data(key):
+            self.logger.warning('Frequency data acquisition failed')
+            return False
+        return True
+
+    def acquire_serial(self):
+        if not self.acquire_mag_data():
+            self.logger.warning('Magnitude data acquisition failed')
+            return False
+        if not self.acquire_phase_data():
+            self.logger.warning('Phase data acquisition failed')
+            return False
+        if not self.acquire_freq_data():
+            self.logger.warning('Frequency data acquisition failed')
+            return False
+        return True
+
+    def acquire_adaptive(self):
+        '''
+        Takes a coarse sweep, sweeps narrow spans around the features found
+        in it and stitches them into one trace with non-uniform point
+        spacing. The start, stop and number of points are restored
+        afterwards. Returns True if every sweep succeeded.
+        '''
+        original = self.send_batch(['START?', 'STOP?', 'NOP?'])
+        if original is None:
+            self.logger.warning('Could not read the sweep settings for an adaptive sweep')
+            return False
+        try:
+            if not self.sweep_span(None, None, self.coarse_points):
+                return False
+            coarse = (self.mag_data, self.phase_data, self.freq_data)
+            features = analysis.find_features(self.mag_data, self.phase_data,
+                                              self.feature_prominence)
+            spans = analysis.segment_spans(self.freq_data, features,
+                                           self.segment_width, self.max_segments)
+            self.logger.info('Found {} features, sweeping {} segments'.format(len(features), len(spans)))
+            segments = []
+            if spans:
+                points = min(self.max_points, (self.max_points - self.coarse_points) // len(spans))
+                for start, stop in spans:
+                    if not self.sweep_span(start, stop, points):
+                        return False
+                    segments.append((self.mag_data, self.phase_data, self.freq_data))
+            self.metrics.count('adaptive_segments', len(segments))
+            self.mag_data, self.phase_data, self.freq_data = analysis.stitch(coarse, segments)
+            return True
+        finally:
+            start, stop, points = original
+            try:
+                self.send_command('START={}HZ;STOP={}HZ;NOP={}'.format(start, stop, int(float(points))))
+            except (TimeoutError, ConnectionError) as e:
+                self.logger.warning('Could not restore the sweep settings: {}'.format(e))
+
+    def sweep_span(self, start, stop, points):
+        '''
+        Sets the span (unless start is None) and the number of points, waits
+        for a sweep with the new settings and reads it.
+        '''
+        commands = ['NOP={}'.format(points)]
+        if start is not None:
+            commands = ['START={:.3f}HZ'.format(start), 'STOP={:.3f}HZ'.format(stop)] + commands
+        self.send_command(';'.join(commands))
+        self.wait_for_sweep()
+        return self.acquire_sweep()
+
+    def wait_for_sweep(self):
+        # a triggered acquisition starts its own sweep with the new span
+        if not self.triggered:
+            time.sleep(self.segment_settle)
+
+    def check_lengths(self):
+        mag_check = len(self.mag_data) == len(self.freq_data)
+        phase_check = len(self.phase_data) == len(self.freq_data)
+
+        if mag_check and phase_check:
+            if self.sample('length_check', logging.INFO):
+                self.logger.info('Data length check passed ({}, {}, {})'.format(len(self.mag_data),len(self.phase_data),len(self.freq_data)))
+            return True
+        self.logger.warning('Data length check failed ({}, {}, {})'.format(len(self.mag_data),len(self.phase_data),len(self.freq_data)))
+        return False
+
+    def continuous_sweep(self):
+        '''
+        Acquires one sweep in continuous mode, stores it in the ring buffer and
+        publishes it as a (sequence, mag, phase, freq) tuple if the monitor
+        passes it on and the GUI is keeping up. A None on the data queue
+        tells the GUI that continuous acquisition stopped after repeated
+        failures.
+        '''
+        self.select_instrument(self.gpib_addr)
+        if self.sweep_rate > 0:
+            self.next_sweep = max(self.next_sweep + 1 / self.sweep_rate, time.monotonic())
+        if not self.acquire_sweep():
+            if not self.check_health():
+                # the sweeps resume once the link is back
+                return
+            self.sweep_failed()
+            return
+        self.failures = 0
+        sweep = self.store_sweep()
+        if not self.published:
+            return
+        if self.trace_channel is not None:
+            # the GUI always reads the newest slot, so one pending
+            # notification is enough however far behind it is
+            message = self.sweep_message(sweep)
+            if self.data_queue.qsize() < 1:
+                self.data_queue.put(message)
+        elif self.data_queue.qsize() < self.max_pending:
+            self.data_queue.put(self.sweep_message(sweep))
+        else:
+            self.metrics.count('sweeps_dropped')
+            if self.sample('dropped'):
+                self.logger.debug('Dropped sweep {}, GUI is behind'.format(sweep))
+
+    def sweep_failed(self):
+        '''
+        Counts a failed continuous sweep. After max_failures in a row
+        continuous acquisition stops and a None on the data queue tells the
+        GUI.
+        '''
+        self.failures += 1
+        self.metrics.count('sweep_failures')
+        if self.failures >= self.max_failures:
+            self.logger.warning('Stopping continuous acquisition after {} failures'.format(self.failures))
+            self.continuous = False
+            self.data_queue.put(None)
+
+    def store_sweep(self):
+        '''
+        Adds the current sweep to the ring buffer and, unless the monitor
+        holds it back, to the archive. Returns its ring buffer sequence
+        number, published is set to whether it should be passed on.
+        '''
+        timestamp = time.time()
+        self.metrics.count('sweeps')
+        sweep = self.trace_buffer.append(self.mag_data, self.phase_data,
+                                         self.freq_data, timestamp)
+        self.published = self.check_sweep()
+        if self.archive is not None and self.published:
+            self.archive.append(self.mag_data, self.phase_data, self.freq_data,
+                                timestamp=timestamp, sequence=sweep,
+                                gpib_addr=self.active_addr or 0)
+        return sweep
+
+    def check_sweep(self):
+        '''
+        Runs the monitor on the current sweep and raises its alarms. Returns
+        whether the sweep should be passed on.
+        '''
+        if self.monitor is None:
+            return True
+        with self.metrics.timer('monitor'):
+            publish, events = self.monitor.check(self.mag_data, self.phase_data, self.freq_data)
+        for event in events:
+            self.raise_alarm(event)
+        self.metrics.count('sweeps_published' if publish else 'sweeps_held')
+        return publish
+
+    def raise_alarm(self, event):
+        event['gpib_addr'] = self.active_addr
+        self.alarms.append(event)
+        self.metrics.count('alarms_' + event['state'])
+        if event['state'] == 'raised':
+            self.logger.warning(format_event(event))
+        else:
+            self.logger.info(format_event(event))
+        if self.event_queue is not None:
+            self.event_queue.put(event)
+
+    def open_archive(self, file_name):
+        self.close_archive()
+        self.archive = SweepArchive(file_name)
+        self.logger.info('Archiving sweeps to {} ({} already stored)'.format(file_name, len(self.archive)))
+
+    def close_archive(self):
+        if self.archive is not None:
+            self.logger.info('Closing archive {}'.format(self.archive.file_name))
+            self.archive.close()
+            self.archive = None
+
+    def metrics_gauges(self):
+        '''
+        Returns the gauges that are read when a metrics snapshot is taken
+        rather than on every event.
+        '''
+        gauges = {'connected': int(self.connection.up),
+                  'backlog': len(self.backlog),
+                  'ring_buffer': len(self.trace_buffer),
+                  'freq_cache': len(self.freq_cache)}
+        try:
+            gauges['command_queue'] = self.command_queue.qsize()
+            gauges['data_queue'] = self.data_queue.qsize()
+        except NotImplementedError:
+            pass
+        if self.transport is not None:
+            gauges['bytes_read'] = self.transport.bytes_read
+            gauges['bytes_written'] = self.transport.bytes_written
+        if self.archive is not None:
+            gauges['archive_sweeps'] = len(self.archive)
+        return gauges
+
+    def write_metrics(self):
+        '''
+        Writes the metrics file if one is set and it is due.
+        '''
+        if self.metrics_path is None or time.monotonic() < self.metrics_due:
+            return
+        self.metrics_due = time.monotonic() + self.metrics_interval
+        try:
+            self.metrics.write(self.metrics_path)
+        except OSError as e:
+            self.logger.warning('Could not write metrics to {}: {}'.format(self.metrics_path, e))
+
+    def sweep_message(self, sweep):
+        '''
+        Returns the current sweep as a (sequence, mag, phase, freq) message
+        for the GUI. With a shared trace channel the arrays are written to
+        shared memory and the message only carries the channel sequence
+        number, the arrays in it are then None. Otherwise it carries the
+        arrays and the ring buffer sequence number.
+        '''
+        if self.trace_channel is not None:
+            sequence = self.trace_channel.write(self.mag_data, self.phase_data, self.freq_data)
+            return (sequence, None, None, None)
+        # the queue pickles in a background thread, so send the freshly
+        # acquired arrays rather than views into the ring buffer
+        return (sweep, self.mag_data, self.phase_data, self.freq_data)
 
     def telnet_connect(self):
+        if self.connection.up and self.transport.connected and self.check_health():
+            self.logger.info('Reusing the connection to {}:{}'.format(self.host, self.port))
+            self.reply(True)
+            return
         self.logger.info('Starting Telnet communications')
-        self.tn = telnetlib.Telnet(self.host, self.port)
-        if self.send_query('++ver') == self.telnet_id:
-            self.logger.info('Successfully established connection with {}'.format(self.telnet_id))
-            self.init_device()
+        self.open_link()
+        error = self.handshake()
+        if error is None:
+            self.connection.established()
+            self.reply(True)
         else:
-            self.tn.close()
-            self.logger.warning('Failed to setup Telnet communications')
-            self.message_queue.put(False)
+            self.transport.close()
+            self.reply(False, error)
+
+    def open_link(self):
+        if self.transport is None:
+            self.transport = PrologixTransport(connector=self.session_connector())
+        if self.transport.connected:
+            self.transport.close()
+        self.transport.connect(self.host, self.port, self.connect_timeout)
+        self.active_addr = None
+        self.settings_supported = True
+        self.triggered = self.trigger_sweeps
+        self.invalidate_settings()
+
+    def session_connector(self):
+        '''
+        Returns the function the transport opens its connection with when a
+        session is recorded or replayed, None for the controller's socket.
+        '''
+        if self.replay_path is not None:
+            self.logger.info('Replaying session {}'.format(self.replay_path))
+            return SessionReplay(self.replay_path, realtime=self.replay_realtime).open_connection
+        if self.record_path is not None:
+            self.logger.info('Recording session to {}'.format(self.record_path))
+            return SessionRecorder(self.record_path).open_connection
+        return None
 
     def telnet_disconnect(self):
         self.logger.info('Disconnecting Telnet connection')
-        self.tn.close()
-        self.message_queue.put(True)
+        self.connection.closed()
+        if self.triggered and self.transport.connected:
+            # leave the analysers sweeping for the front panel
+            for addr in self.gpib_addrs:
+                self.select_instrument(addr)
+                self.send_command(CONTINUOUS_SWEEP)
+        self.transport.close()
+        self.reply(True)
 
-    def init_device(self):
-        self.logger.info('Querying HP4195A')
-        if self.send_query('ID?') == self.device_id:
-            self.logger.info('Successfully found {}'.format(self.device_id))
+    def handshake(self, cached=False):
+        '''
+        Checks the controller and the analysers on a new link and sets them
+        up. Returns None on success or the reason it failed. With cached,
+        the identities confirmed by an earlier handshake with the same host
+        and port are not queried again, only the settings are sent.
+        '''
+        link = (self.host, self.port)
+        done = self.connection.handshake_done(link) if cached else set()
+        if 'controller' not in done:
+            if self.send_query('++ver') != self.telnet_id:
+                self.logger.warning('Failed to setup Telnet communications')
+                return 'Unrecognised controller'
+            self.logger.info('Successfully established connection with {}'.format(self.telnet_id))
+        for addr in self.gpib_addrs:
+            self.select_instrument(addr)
+            if addr not in done:
+                self.logger.info('Querying HP4195A at GPIB address {}'.format(addr))
+                if self.send_query('ID?') != self.device_id:
+                    self.logger.warning('Error unrecognised device at GPIB address {}'.format(addr))
+                    return 'Unrecognised device at GPIB address {}'.format(addr)
+                self.logger.info('Successfully found {}'.format(self.device_id))
             self.logger.info('Initialising HP4195A')
             self.send_command('++auto 1')
-            self.message_queue.put(True)
+            self.set_data_format()
+            self.set_sweep_mode()
+        self.select_instrument(self.gpib_addr)
+        self.connection.record_handshake(link, ['controller'] + self.gpib_addrs)
+        return None
+
+    def maintain_connection(self):
+        '''
+        Reconnects a dropped link once its backoff has expired and checks an
+        idle one, called on every pass of the request loop.
+        '''
+        if self.connection.reconnect_due():
+            self.reconnect()
+        elif self.connection.health_check_due():
+            self.check_health()
+
+    def check_health(self):
+        '''
+        Asks the controller for its version, which does not involve the bus.
+        Returns True if the link answered, otherwise it is treated as lost.
+        '''
+        self.metrics.count('health_checks')
+        reply = self.send_query('++ver')
+        if reply == self.telnet_id:
+            return True
+        self.connection_lost('health check returned {!r}'.format(reply))
+        return False
+
+    def reconnect(self):
+        self.logger.info('Reconnecting to {}:{}'.format(self.host, self.port))
+        self.metrics.count('reconnect_attempts')
+        try:
+            self.open_link()
+            error = self.handshake(cached=True)
+        except (TimeoutError, ConnectionError) as e:
+            error = str(e)
+        if error is None:
+            self.connection.established()
+            self.metrics.count('reconnects')
+            self.logger.info('Reconnected to {}:{}'.format(self.host, self.port))
+            return True
+        self.transport.close()
+        delay = self.connection.failed()
+        self.logger.warning('Reconnect failed: {}, next attempt in {:.1f} s'.format(error, delay))
+        return False
+
+    def connection_lost(self, reason):
+        if self.connection.lost():
+            self.logger.warning('Lost the connection to {}:{}: {}'.format(self.host, self.port, reason))
+            self.metrics.count('connections_lost')
+            self.transport.close()
+
+    def check_link(self, error):
+        '''
+        Called when an exchange failed, returns True if the error took the
+        link down, in which case it is reconnected.
+        '''
+        if isinstance(error, ConnectionError) and not self.transport.connected:
+            self.connection_lost(error)
+            return True
+        return False
+
+    def select_instrument(self, addr):
+        '''
+        Points the controller at the instrument on the given GPIB address, the
+        ++addr command is only sent when the address changes.
+        '''
+        if addr != self.active_addr:
+            self.send_command('++addr {}'.format(addr))
+            self.active_addr = addr
+            self.invalidate_settings()
+
+    def set_sweep_mode(self):
+        '''
+        Selects single sweeps with a service request at the end of each one
+        in triggered mode, and continuous sweeps otherwise.
+        '''
+        if self.triggered:
+            self.send_command('{};RQS{}'.format(SINGLE_SWEEP, STATUS_SWEEP_END))
         else:
-            self.tn.close()
-            self.logger.warning('Error unrecognised device')
-            self.message_queue.put(False)
+            self.send_command(CONTINUOUS_SWEEP)
+        self.logger.info('Sweep mode set to {}'.format('triggered' if self.triggered else 'continuous'))
+
+    def set_data_format(self):
+        '''
+        Selects the trace output format on the instrument.
+        '''
+        self.send_command(self.data_format)
+        self.logger.info('Data format set to {}'.format(self.data_format))
 
     def acquire_mag_data(self):
-        raw_mag_data = self.send_query('A?')
-        mag_data = np.fromstring(raw_mag_data, dtype=float, sep=',')
+        mag_data = self.acquire_trace('A?')
         if len(mag_data) > 0:
             self.mag_data = mag_data
             return True
 
     def acquire_phase_data(self):
-            raw_phase_data = self.send_query('B?')
-            phase_data = np.fromstring(raw_phase_data, dtype=float, sep=',')
-            if len(phase_data) > 0:
-                self.phase_data = phase_data
-                return True
+        phase_data = self.acquire_trace('B?')
+        if len(phase_data) > 0:
+            self.phase_data = phase_data
+            return True
 
     def acquire_freq_data(self):
-        raw_freq_data = self.send_query('X?')
-        freq_data = np.fromstring(raw_freq_data, dtype=float, sep=',')
+        return self.load_freq_data(self.current_settings())
+
+    def load_freq_data(self, key):
+        '''
+        Takes the frequency axis from the cache for the given settings key,
+        or reads X? and caches it.
+        '''
+        if key is not None and key in self.freq_cache:
+            if self.sample('freq_cache'):
+                self.logger.debug('Using cached frequency axis for {}'.format(key))
+            self.freq_data = self.freq_cache[key]
+            return True
+        freq_data = self.acquire_trace('X?')
         if len(freq_data) > 0:
             self.freq_data = freq_data
+            if key is not None:
+                self.freq_cache[key] = freq_data
+                while len(self.freq_cache) > self.freq_cache_size:
+                    self.freq_cache.popitem(last=False)
             return True
 
+    def reload_freq_data(self):
+        '''
+        Drops the cached frequency axis that no longer matches the length of
+        the traces, queries the settings and reads X? again. The settings
+        were changed on the front panel since they were last checked.
+        '''
+        self.logger.info('Trace length changed to {}, reading the sweep settings again'.format(len(self.mag_data)))
+        self.metrics.count('settings_changed')
+        self.freq_cache.pop(self.settings_key, None)
+        self.invalidate_settings()
+        if not self.load_freq_data(self.current_settings()):
+            self.logger.warning('Frequency data acquisition failed')
+            return False
+        return True
+
+    def current_settings(self):
+        '''
+        Returns a key identifying the current sweep settings, or None if they
+        cannot be queried, in which case the frequency axis is not cached.
+        '''
+        if not self.settings_due():
+            return self.settings_key if self.settings_supported else None
+        return self.update_settings([self.send_query(query) for query in SETTINGS_QUERIES])
+
+    def settings_due(self):
+        '''
+        Returns True if the sweep settings have to be queried before the
+        frequency axis can be taken from the cache.
+        '''
+        if not self.settings_supported:
+            return False
+        return self.settings_key is None or \
+            time.monotonic() - self.settings_checked >= self.settings_check_interval
+
+    def update_settings(self, values):
+        '''
+        Stores the replies to SETTINGS_QUERIES as the current settings key
+        and returns it, or disables caching if any of them failed.
+        '''
+        for query, value in zip(SETTINGS_QUERIES, values):
+            if value == 'Command failed':
+                self.logger.warning('Settings query {} failed, frequency axis caching disabled'.format(query))
+                self.settings_supported = False
+                self.invalidate_settings()
+                return None
+        self.settings_key = (self.active_addr,) + tuple(values)
+        self.settings_checked = time.monotonic()
+        return self.settings_key
+
+    def invalidate_settings(self, command=None):
+        if command is None or SETTINGS_COMMANDS.search(command):
+            self.settings_key = None
+
+    def acquire_trace(self, register):
+        '''
+        Reads a data register from the instrument and returns it as a NumPy
+        array. Binary blocks are decoded in place with np.frombuffer, ASCII
+        responses are parsed as comma separated floats.
+        '''
+        if self.data_format in BINARY_FORMATS:
+            try:
+                if self.sample('sent'):
+                    self.logger.debug('Sent \"{}\"'.format(register))
+                with self.metrics.timer('query.' + register):
+                    block = self.transport.read_trace(register, binary=True,
+                                                      timeout=self.timeout(register))
+                self.connection.activity()
+                if self.sample('received'):
+                    self.logger.debug('Received {} byte binary block'.format(len(block)))
+                with self.metrics.timer('parse'):
+                    return parse_binary_trace(block, self.data_format)
+            except (TimeoutError, ConnectionError, ValueError) as e:
+                self.logger.warning('Block read of {} failed: {}'.format(register, e))
+                if self.check_link(e):
+                    return np.zeros(0)
+            self.logger.warning('Binary read of {} failed, falling back to ASCII'.format(register))
+            self.data_format = ASCII_FORMAT
+            self.set_data_format()
+
+        raw_data = self.send_query(register)
+        with self.metrics.timer('parse'):
+            return parse_ascii_trace(raw_data)
+
+    def parse_trace(self, reply):
+        '''
+        Parses a trace reply from send_batch, returns an empty array if a
+        binary block is malformed.
+        '''
+        with self.metrics.timer('parse'):
+            if self.data_format in BINARY_FORMATS:
+                try:
+                    return parse_binary_trace(reply, self.data_format)
+                except ValueError as e:
+                    self.logger.warning('Invalid binary trace: {}'.format(e))
+                    return np.zeros(0)
+            return parse_ascii_trace(reply)
+
+    def format_reply(self, command, reply):
+        '''
+        Returns a reply from send_batch as text, binary traces are converted
+        to comma separated values as in the ASCII format.
+        '''
+        if reply is None:
+            return ''
+        if isinstance(reply, bytes):
+            return ','.join(str(v) for v in parse_binary_trace(reply, self.data_format))
+        return reply
+
+    def send_batch(self, commands):
+        '''
+        Sends a list of commands back to back and returns their replies in
+        order, as the raw block for a data register in a binary format, as
+        text for other queries and None for commands without a reply.
+        Returns None if any reply did not arrive.
+        '''
+        reads = []
+        for command in commands:
+            self.invalidate_settings(command)
+            if not expects_reply(command):
+                reads.append(None)
+            elif self.data_format in BINARY_FORMATS and command.strip().upper() in TRACE_REGISTERS:
+                reads.append('block')
+            else:
+                reads.append('line')
+        if self.sample('sent'):
+            self.logger.debug('Sent \"{}\"'.format('; '.join(commands)))
+        timeout = max(self.timeout(command) for command in commands)
+        try:
+            with self.metrics.timer('query.batch'):
+                replies = self.transport.query_batch(commands, reads, timeout)
+        except (TimeoutError, ConnectionError) as e:
+            self.logger.warning('No response to batch \"{}\": {}'.format('; '.join(commands), e))
+            self.metrics.count('query_failures')
+            self.check_link(e)
+            return None
+        try:
+            replies = [reply.decode('ascii') if read == 'line' else reply
+                       for read, reply in zip(reads, replies)]
+        except UnicodeDecodeError as e:
+            self.logger.warning('Invalid response to batch \"{}\": {}'.format('; '.join(commands), e))
+            self.metrics.count('query_failures')
+            return None
+        self.connection.activity()
+        return replies
+
+    def timeout(self, command):
+        return self.command_timeouts.get(command, self.query_timeout)
+
     def send_command(self, command):
-        cmd = command + '\r\n'
-        self.logger.info('Sent \"{}\"'.format(cmd.rstrip()))
-        self.tn.write(cmd.encode('ascii'))
+        self.invalidate_settings(command)
+        if self.sample('sent'):
+            self.logger.debug('Sent \"{}\"'.format(command))
+        try:
+            with self.metrics.timer('write.' + command_name(command)):
+                self.transport.write(command, self.timeout(command))
+        except ConnectionError as e:
+            self.check_link(e)
+            raise
 
     def send_query(self, command):
-        self.send_command(command)
-        data = ['init']
-        response = []
-        while data != []:
-            raw_data = self.tn.read_until(b'\r\n', timeout=3).decode('ascii')
-            self.logger.info('Received {} of {}'.format(len(raw_data), type(raw_data)))
-            #raw_data = self.tn.read_until(b'EOF', timeout=4).decode('ascii')
-            data = raw_data.splitlines()
-            if data != []:
-                response.append(data[0])
-
-        if len(response) > 0:
-            ret = response[0]
-        else:
-             ret = 'Command failed'
-        return ret
+        self.invalidate_settings(command)
+        if self.sample('sent'):
+            self.logger.debug('Sent \"{}\"'.format(command))
+        try:
+            with self.metrics.timer('query.' + command_name(command)):
+                raw_data = self.transport.query(command, self.timeout(command)).decode('ascii')
+        except (TimeoutError, ConnectionError, UnicodeDecodeError) as e:
+            self.logger.warning('No response to \"{}\": {}'.format(command, e))
+            self.metrics.count('query_failures')
+            self.check_link(e)
+            return 'Command failed'
+        self.connection.activity()
+        if self.sample('received'):
+            self.logger.debug('Received {} of {}'.format(len(raw_data), type(raw_data)))
+        return raw_data
@@ -0,0 +1,389 @@
+'''
+Headless batch acquisition from a HP4195A, for scripts and schedulers on
+machines without a display. It starts the hp4195a worker process without
+Qt, connects, applies the setting commands, takes a number of sweeps or
+sweeps for a duration, and writes them to files or stdout.
+
+    python hp4195a_cli.py --host gpib-01 -c START=1KHZ -c STOP=10MHZ -n 10 -o run.npz
+    python hp4195a_cli.py --host gpib-01 --duration 3600 --interval 10 -o run.sweeps
+    python hp4195a_cli.py --host gpib-01 -n 1 -o - > sweep.csv
+    python hp4195a_cli.py --host gpib-01 -n 32 --average 16 --resonance -o avg.npz
+    python hp4195a_cli.py --replay bench.gpib -n 100 -o - > replayed.csv
+    python hp4195a_cli.py --host gpib-01 --duration 86400 --interval 10 --mag-threshold 0.5 -o 'drift_{:05d}.npz'
+
+An output name containing a format field such as sweep_{:04d}.s1p writes
+each sweep to its own file as it arrives, a .sweeps file appends them to a
+sweep archive, '-' streams them to stdout as CSV rows and any other name
+collects them and writes a single file at the end. Averaging, smoothing
+and phase unwrapping are applied to each sweep before it is written, so the
+written traces are the processed ones (except in a .sweeps archive, which
+the worker writes directly).
+
+With a deviation threshold, a mask or --changes-only, only the sweeps that
+changed, broke the mask or are due as a heartbeat are written, and each
+alarm raised or cleared is reported on stderr. The checks are made on the
+traces as acquired, before averaging and smoothing.
+'''
+import os
+import sys
+import time
+import signal
+import logging
+import argparse
+import threading
+import multiprocessing
+import numpy as np
+
+import hp4195a as hp
+import multi_logging as ml
+import export
+import analysis
+import trace_monitor
+from acquisition_pool import Controller
+
+
+# exit codes
+EXIT_OK = 0
+EXIT_SWEEPS_FAILED = 1
+EXIT_USAGE = 2
+EXIT_CONNECTION = 3
+EXIT_SETUP = 4
+EXIT_INTERRUPTED = 130
+
+
+class SweepCounts(object):
+    '''
+    This class holds the number of sweeps taken and failed so far, so they
+    are still known when acquisition is interrupted.
+    '''
+    def __init__(self):
+        self.taken = 0
+        self.failed = 0
+
+
+class SweepWriter(object):
+    '''
+    This class writes sweeps to the output chosen on the command line, see
+    the module docstring for the forms the output name can take.
+    '''
+    def __init__(self, output, controller=None):
+        self.output = output
+        self.controller = controller
+        self.sweeps = []
+        self.files = []
+        self.count = 0
+        self.header_written = False
+
+    def open(self):
+        if self.output.endswith('.sweeps'):
+            success, payload = self.controller.request('open_archive', os.path.abspath(self.output))
+            if not success:
+                raise IOError('Could not open archive {}: {}'.format(self.output, payload))
+
+    def write(self, timestamp, mag_data, phase_data, freq_data):
+        index = self.count
+        self.count += 1
+        if self.output == '-':
+            self.write_rows(index, timestamp, mag_data, phase_data, freq_data)
+        elif self.output.endswith('.sweeps'):
+            # the worker appends each sweep to the archive itself
+            pass
+        elif '{' in self.output:
+            self.files.extend(export.export(self.output.format(index), freq_data, mag_data, phase_data))
+        else:
+            self.sweeps.append((timestamp, mag_data, phase_data, freq_data))
+
+    def write_rows(self, index, timestamp, mag_data, phase_data, freq_data):
+        if not self.header_written:
+            sys.stdout.write('Sweep,Timestamp,Frequency,Magnitude,Phase\n')
+            self.header_written = True
+        n = len(freq_data)
+        table = np.column_stack((np.full(n, index), np.full(n, timestamp),
+                                 freq_data, mag_data, phase_data))
+        np.savetxt(sys.stdout, table, delimiter=',', fmt=('%d', '%.6f', '%.10g', '%.10g', '%.10g'))
+        sys.stdout.flush()
+
+    def close(self):
+        '''
+        Writes the collected sweeps, only the sweeps with the same point
+        count as the first one are kept so they stack into 2-D arrays.
+        Returns the names of the files written.
+        '''
+        if self.output.endswith('.sweeps'):
+            self.controller.request('close_archive')
+            return [self.output] if self.count else []
+        if not self.sweeps:
+            return self.files
+        points = len(self.sweeps[0][3])
+        sweeps = [s for s in self.sweeps if len(s[3]) == points]
+        if len(sweeps) < len(self.sweeps):
+            logging.getLogger(__name__).warning('Dropped {} sweeps with a different point count'.format(len(self.sweeps) - len(sweeps)))
+        timestamps, mag_data, phase_data, freq_data = (np.array(column) for column in zip(*sweeps))
+        return export.export(self.output, freq_data, mag_data, phase_data,
+                             timestamps=timestamps)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Headless HP4195A acquisition')
+    parser.add_argument('--host', default=os.environ.get('HP4195A_HOST', hp.DEFAULT_HOST),
+                        help='Prologix controller host name')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('HP4195A_PORT', hp.DEFAULT_PORT)))
+    parser.add_argument('--gpib-addr', type=int, default=11)
+    parser.add_argument('--format', default=hp.ASCII_FORMAT,
+                        choices=[hp.ASCII_FORMAT] + sorted(hp.BINARY_FORMATS),
+                        help='trace transfer format')
+    parser.add_argument('--record', metavar='SESSION',
+                        help='record every byte exchanged with the controller to a session file')
+    parser.add_argument('--replay', metavar='SESSION',
+                        help='replay a recorded session instead of connecting to the controller')
+    parser.add_argument('--realtime', action='store_true',
+                        help='replay the replies with their recorded delays')
+    parser.add_argument('-c', '--command', action='append', default=[], dest='commands',
+                        help='setting command sent before the first sweep, can be repeated')
+    parser.add_argument('-n', '--sweeps', type=int,
+                        help='number of sweeps to take')
+    parser.add_argument('-d', '--duration', type=float,
+                        help='seconds to keep sweeping for')
+    parser.add_argument('-i', '--interval', type=float, default=0,
+                        help='seconds between the start of successive sweeps')
+    parser.add_argument('-o', '--output', default='-',
+                        help="output file, '-' for stdout")
+    parser.add_argument('--max-failures', type=int, default=5,
+                        help='consecutive failed sweeps before giving up')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for each sweep')
+    parser.add_argument('--free-run', action='store_true',
+                        help='read the continuously running sweep instead of triggering each one')
+    parser.add_argument('--settings-interval', type=float, default=5,
+                        help='seconds between checks for sweep settings changed on the front panel, 0 for every sweep')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='take each sweep as a coarse sweep refined around its peaks and notches')
+    parser.add_argument('-a', '--average', type=int, default=0,
+                        help='exponentially average over this many sweeps')
+    parser.add_argument('--running', action='store_true',
+                        help='average with a running mean instead')
+    parser.add_argument('--smooth', type=int, default=0,
+                        help='smooth the traces over this many points')
+    parser.add_argument('--unwrap', action='store_true',
+                        help='remove the 360 degree jumps from the phase')
+    parser.add_argument('-r', '--resonance', action='store_true',
+                        help='report the peak frequency, -3 dB bandwidth and Q of each sweep on stderr')
+    parser.add_argument('--changes-only', action='store_true',
+                        help='only write sweeps that changed, with the default thresholds')
+    parser.add_argument('--mag-threshold', type=float,
+                        help='write a sweep when its magnitude moved by more than this many dB')
+    parser.add_argument('--phase-threshold', type=float,
+                        help='write a sweep when its phase moved by more than this many degrees')
+    parser.add_argument('--rms', action='store_true',
+                        help='compare the RMS deviation over the sweep with the thresholds instead of the largest one')
+    parser.add_argument('--reference', choices=('previous', 'fixed'), default='previous',
+                        help='compare with the last sweep written or always with the first one')
+    parser.add_argument('--mag-mask', metavar='CSV',
+                        help='magnitude limits, rows of frequency, lower and upper limit')
+    parser.add_argument('--phase-mask', metavar='CSV',
+                        help='phase limits, rows of frequency, lower and upper limit')
+    parser.add_argument('--heartbeat', type=float, default=0,
+                        help='write a sweep at least this often in seconds while monitoring')
+    parser.add_argument('-p', '--progress', action='store_true',
+                        help='report each sweep on stderr')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='level of the log messages written to stderr')
+    args = parser.parse_args(argv)
+    if args.sweeps is None and args.duration is None:
+        args.sweeps = 1
+    if args.output != '-' and os.path.splitext(args.output)[1].lower() not in export.FORMATS + ('.sweeps',):
+        parser.error('unknown output format {}'.format(args.output))
+    try:
+        args.monitor = monitor_options(args)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    return args
+
+
+def monitor_options(args):
+    '''
+    Returns the TraceMonitor options given on the command line, None if
+    every sweep is to be written.
+    '''
+    if args.changes_only and args.mag_threshold is None and args.phase_threshold is None:
+        args.mag_threshold, args.phase_threshold = 1, 10
+    options = {'mag_threshold': args.mag_threshold,
+               'phase_threshold': args.phase_threshold,
+               'statistic': 'rms' if args.rms else 'max',
+               'reference': args.reference,
+               'heartbeat': args.heartbeat}
+    if args.mag_mask:
+        options['mag_mask'] = trace_monitor.load_mask(args.mag_mask)
+    if args.phase_mask:
+        options['phase_mask'] = trace_monitor.load_mask(args.phase_mask)
+    if args.mag_threshold is None and args.phase_threshold is None and \
+            'mag_mask' not in options and 'phase_mask' not in options:
+        return None
+    return options
+
+
+def progress(message):
+    sys.stderr.write(message + '\n')
+    sys.stderr.flush()
+
+
+def report_resonance(index, mag_data, freq_data):
+    r = analysis.resonance(freq_data, mag_data)
+    progress('Sweep {} peak {:.6g} Hz {:.2f} dB, bandwidth {:.4g} Hz, Q {:.4g}'.format(
+             index, r['frequency'][0], r['magnitude'][0], r['bandwidth'][0], r['q'][0]))
+
+
+def acquire(controller, writer, args, counts=None):
+    '''
+    Takes sweeps until the requested number or duration is reached. Returns
+    the number of sweeps taken and the number that failed, which are also
+    kept up to date in counts as the sweeps are taken.
+    '''
+    logger = logging.getLogger(__name__)
+    processor = analysis.TraceProcessor(average=args.average, running=args.running,
+                                        smooth=args.smooth, unwrap=args.unwrap)
+    # a .sweeps archive is written by the worker, which is given the
+    # monitor options itself
+    monitor = None
+    if args.monitor is not None and not args.output.endswith('.sweeps'):
+        monitor = trace_monitor.TraceMonitor(**args.monitor)
+    deadline = None if args.duration is None else time.monotonic() + args.duration
+    if counts is None:
+        counts = SweepCounts()
+    consecutive = 0
+    next_sweep = time.monotonic()
+    while True:
+        if args.sweeps is not None and counts.taken >= args.sweeps:
+            break
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        delay = next_sweep - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        next_sweep = max(next_sweep + args.interval, time.monotonic())
+
+        start = time.monotonic()
+        command = 'adaptive_sweep' if args.adaptive else 'start_acquisition'
+        success, payload = controller.request(command, timeout=args.timeout)
+        elapsed = time.monotonic() - start
+        if not success:
+            counts.failed += 1
+            consecutive += 1
+            logger.warning('Sweep failed: {}'.format(payload))
+            if consecutive >= args.max_failures:
+                logger.error('Giving up after {} failed sweeps in a row'.format(consecutive))
+                break
+            continue
+        consecutive = 0
+        sequence, mag_data, phase_data, freq_data = payload
+        publish = True
+        if monitor is not None:
+            publish, events = monitor.check(mag_data, phase_data, freq_data)
+            for event in events:
+                progress(trace_monitor.format_event(event))
+        if processor.enabled:
+            mag_data, phase_data = processor.process(mag_data, phase_data, freq_data)
+        if publish:
+            writer.write(time.time(), mag_data, phase_data, freq_data)
+        counts.taken += 1
+        if args.progress:
+            total = '/{}'.format(args.sweeps) if args.sweeps is not None else ''
+            progress('Sweep {}{} ({} points, {:.3f} s{})'.format(counts.taken, total, len(freq_data), elapsed,
+                     '' if publish else ', unchanged'))
+        if args.resonance:
+            report_resonance(counts.taken, mag_data, freq_data)
+    return counts.taken, counts.failed
+
+
+def run(args):
+    logger = logging.getLogger(__name__)
+    logging_queue = multiprocessing.Queue()
+    listener = threading.Thread(target=ml.logger_thread, args=(logging_queue,))
+    listener.daemon = True
+    listener.start()
+
+    controller = Controller(args.host, args.port, logging_queue, args.format,
+                            log_level=args.log_level, record_path=args.record,
+                            replay_path=args.replay, replay_realtime=args.realtime,
+                            triggered=not args.free_run,
+                            settings_check_interval=args.settings_interval,
+                            monitor=args.monitor if args.output.endswith('.sweeps') else None)
+    controller.instruments['cli'] = args.gpib_addr
+    # Ctrl+C is handled here, the worker must keep running to disconnect
+    handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        controller.start()
+    finally:
+        signal.signal(signal.SIGINT, handler)
+    # set up after the worker has started so that a forked worker does not
+    # inherit the handler and log everything twice
+    setup_logging(args.log_level)
+    try:
+        success, payload = controller.request('connect', timeout=30)
+        if not success:
+            logger.error('Could not connect to {}:{}: {}'.format(args.host, args.port, payload))
+            return EXIT_CONNECTION
+
+        for command in args.commands:
+            if command.endswith('?'):
+                success, payload = controller.request('send_command', command)
+                success = success and payload != 'Command failed'
+                if success:
+                    progress('{}: {}'.format(command, payload))
+            else:
+                success, payload = controller.request('write_command', command)
+            if not success:
+                logger.error('Setting command {} failed: {}'.format(command, payload))
+                return EXIT_SETUP
+
+        writer = SweepWriter(args.output, controller)
+        writer.open()
+        counts = SweepCounts()
+        interrupted = False
+        try:
+            taken, failed = acquire(controller, writer, args, counts)
+        except (KeyboardInterrupt, BrokenPipeError) as e:
+            # stopped with Ctrl+C or the reader of stdout went away
+            if isinstance(e, BrokenPipeError):
+                sys.stdout = open(os.devnull, 'w')
+            interrupted = True
+            taken, failed = counts.taken, counts.failed
+        files = writer.close()
+        if args.progress:
+            progress('{} sweeps taken, {} failed{}'.format(taken, failed,
+                     ', written to ' + ', '.join(files) if files else ''))
+        if interrupted:
+            return EXIT_INTERRUPTED
+        if failed or (args.sweeps is not None and taken < args.sweeps):
+            return EXIT_SWEEPS_FAILED
+        return EXIT_OK
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+    finally:
+        # the worker is joined before the listener is stopped so its last
+        # records are written, if the listener does not finish the queue is
+        # abandoned rather than waited on so the exit status is returned
+        controller.stop()
+        logging_queue.put(None)
+        listener.join(5)
+        if listener.is_alive():
+            logging_queue.cancel_join_thread()
+
+
+def setup_logging(level):
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s'))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.log_level = args.log_level.upper()
+    return run(args)
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -1,29 +1,75 @@
+import time
+start_time = time.perf_counter()
+
 import sys
 import os
+import json
 import threading
 import logging.config
 
 import hp4195a as hp
 import multi_logging as ml
+from shared_trace import SharedTraceChannel
 
 from multiprocessing import Queue, freeze_support
-from main_window import MainWindow
-from PyQt5 import QtWidgets
+
+
+def report_startup(startup, window, exit_after):
+    '''
+    Called on the first pass of the event loop, once the window is up. Logs
+    the startup timings and, with HP4195A_STARTUP_EXIT set, prints them as
+    JSON and quits so benchmarks can time the launch.
+    '''
+    startup['ready'] = time.perf_counter() - start_time
+    for name, value in startup.items():
+        window.metrics.gauge('startup_' + name, round(value, 3))
+    window.logger.info('Startup took {:.3f} s (imports {:.3f} s, window {:.3f} s)'.format(startup['ready'], startup['imports'], startup['window']))
+    if exit_after:
+        print(json.dumps(startup))
+        sys.stdout.flush()
+        QtWidgets.QApplication.instance().quit()
+
 
 if __name__ == '__main__':
     freeze_support()
 
+    # the GUI modules are only imported by the main process, a device process
+    # started with spawn (Windows and frozen builds) re-imports this module
+    # and only needs the driver
+    from PyQt5 import QtWidgets, QtCore
+    from main_window import MainWindow
+    startup = {'imports': time.perf_counter() - start_time}
+
     command_queue = Queue()
     message_queue = Queue()
     data_queue = Queue()
     logging_queue = Queue()
+    event_queue = Queue()
+    trace_channel = SharedTraceChannel()
 
-    dp = hp.hp4195a(command_queue, message_queue, data_queue, logging_queue)
+    host = os.environ.get('HP4195A_HOST', hp.DEFAULT_HOST)
+    port = os.environ.get('HP4195A_PORT', hp.DEFAULT_PORT)
+    metrics_path = os.environ.get('HP4195A_METRICS')
+    log_level = os.environ.get('HP4195A_LOG_LEVEL', 'INFO').upper()
+    dp = hp.hp4195a(command_queue, message_queue, data_queue, logging_queue,
+                    host=host, port=port, trace_channel=trace_channel,
+                    metrics_path=metrics_path, log_level=log_level,
+                    record_path=os.environ.get('HP4195A_RECORD'),
+                    replay_path=os.environ.get('HP4195A_REPLAY'),
+                    replay_realtime='HP4195A_REPLAY_REALTIME' in os.environ,
+                    event_queue=event_queue)
     dp.daemon = True
     dp.start()
+    startup['worker'] = time.perf_counter() - start_time
 
+    # lets the help window load Qt WebEngine after the application exists
+    QtCore.QCoreApplication.setAttribute(QtCore.Qt.AA_ShareOpenGLContexts)
     app = QtWidgets.QApplication(sys.argv)
-    gp = MainWindow(command_queue, message_queue, data_queue, logging_queue)
+    gp = MainWindow(command_queue, message_queue, data_queue, logging_queue,
+                    trace_channel=trace_channel,
+                    metrics=metrics_path is not None, log_level=log_level,
+                    event_queue=event_queue)
+    startup['window'] = time.perf_counter() - start_time
 
     if getattr(sys, 'frozen', False):
         dir_name = os.path.dirname(sys.executable)
@@ -33,11 +79,25 @@ if __name__ == '__main__':
     log_file_path = os.path.join(dir_name, 'logging.conf')
 
     logging.config.fileConfig(log_file_path, disable_existing_loggers=False)
+    logging.getLogger().setLevel(log_level)
     lp = threading.Thread(target=ml.logger_thread, args=(logging_queue,))
     lp.daemon = True
     lp.start()
 
-    sys.exit(app.exec_())
-    dp.join()
+    QtCore.QTimer.singleShot(0, lambda: report_startup(startup, gp,
+                                                       'HP4195A_STARTUP_EXIT' in os.environ))
+    exit_code = app.exec_()
+    # the device process is asked to exit rather than killed with the
+    # application, so its last log records arrive and it cannot be stopped
+    # while it holds the lock of the logging queue
+    command_queue.put((None, 'shutdown', ()))
+    dp.join(10)
+    if dp.is_alive():
+        dp.terminate()
+        dp.join()
+    logging.getLogger().removeHandler(gp.qh)
+    gp.qh.close()
     logging_queue.put(None)
-    lp.join()
+    lp.join(5)
+    trace_channel.close()
+    sys.exit(exit_code)
@@ -0,0 +1,352 @@
+import re
+import sys
+import time
+import random
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+import numpy as np
+
+
+PROLOGIX_VERSION = 'Prologix GPIB-ETHERNET Controller version 01.06.06.00'
+DEVICE_ID = 'HP4195A'
+
+FAULT_MODES = ('none', 'drop', 'truncate', 'garbage', 'disconnect', 'stall')
+
+UNITS = {'HZ': 1.0, 'KHZ': 1e3, 'MHZ': 1e6, 'GHZ': 1e9}
+SETTING = re.compile(r'^(START|STOP|CENTER|SPAN|NOP)\s*=\s*([-+0-9.eE]+)\s*([A-Z]*)$')
+
+BINARY_DTYPES = {'FMT2': np.dtype('>f8'),
+                 'FMT3': np.dtype('>f4')}
+
+# status byte bits, the end of sweep bit is also the one the driver waits on
+STATUS_SWEEP_END = 0x10
+STATUS_RQS = 0x40
+RQS_MASK = re.compile(r'^RQS(\d+)$')
+
+
+class InstrumentState(object):
+    '''
+    This class holds the sweep settings of the simulated analyser and generates
+    synthetic magnitude and phase traces for them. The device under test is a
+    second order band-pass resonator with a little measurement noise, which
+    gives traces that look like a real transmission measurement.
+
+    A single sweep started with SWTRG takes sweep_time seconds, at the end
+    the end of sweep bit is set in the status byte and a service request is
+    raised if the RQS mask includes it.
+    '''
+    def __init__(self, points=401, start=1e3, stop=1e7, log_sweep=True,
+                 resonance=None, q_factor=20, noise=0.05, sweep_time=0.0,
+                 seed=None):
+        self.points = points
+        self.start = start
+        self.stop = stop
+        self.log_sweep = log_sweep
+        self.resonance = resonance
+        self.q_factor = q_factor
+        self.noise = noise
+        self.data_format = 'FMT1'
+        self.sweep_time = sweep_time
+        self.sweep_mode = 1
+        self.sweep_end = None
+        self.status = 0
+        self.rqs_mask = 0
+        self.sweep_count = 0
+        self.rng = np.random.default_rng(seed)
+
+    def freq_data(self):
+        if self.log_sweep:
+            return np.geomspace(self.start, self.stop, self.points)
+        return np.linspace(self.start, self.stop, self.points)
+
+    def response(self):
+        f = self.freq_data()
+        f0 = self.resonance or np.sqrt(self.start * self.stop)
+        # slow drift of the resonance so consecutive sweeps differ
+        f0 = f0 * (1 + 1e-3 * np.sin(self.sweep_count / 10.0))
+        x = self.q_factor * (f / f0 - f0 / f)
+        h = 1 / (1 + 1j * x)
+        mag = 20 * np.log10(np.abs(h))
+        phase = np.degrees(np.angle(h))
+        mag += self.noise * self.rng.standard_normal(self.points)
+        phase += self.noise * self.rng.standard_normal(self.points)
+        return mag, phase
+
+    def apply(self, command):
+        '''
+        Applies a sweep setting command such as START=1MHZ or NOP=201.
+        Returns False if the command was not recognised.
+        '''
+        match = SETTING.match(command)
+        if match:
+            name, value, unit = match.groups()
+            value = float(value) * UNITS.get(unit, 1.0)
+            if name == 'START':
+                self.start = value
+            elif name == 'STOP':
+                self.stop = value
+            elif name == 'NOP':
+                self.points = max(2, min(int(value), 401))
+            else:
+                center = (self.start + self.stop) / 2
+                span = self.stop - self.start
+                if name == 'CENTER':
+                    center = value
+                else:
+                    span = value
+                self.start = center - span / 2
+                self.stop = center + span / 2
+            return True
+        if command in ('SWT1', 'SWT2'):
+            self.log_sweep = command == 'SWT2'
+            return True
+        if command in ('FMT1', 'FMT2', 'FMT3'):
+            self.data_format = command
+            return True
+        if command in ('SWM1', 'SWM2', 'SWM3'):
+            self.sweep_mode = int(command[-1])
+            return True
+        if command == 'SWTRG':
+            self.status &= ~STATUS_SWEEP_END
+            self.sweep_end = time.monotonic() + self.sweep_time
+            return True
+        match = RQS_MASK.match(command)
+        if match:
+            self.rqs_mask = int(match.group(1))
+            return True
+        return False
+
+    def status_byte(self):
+        if self.sweep_end is not None and time.monotonic() >= self.sweep_end:
+            self.status |= STATUS_SWEEP_END
+            self.sweep_end = None
+        if self.status & self.rqs_mask:
+            return self.status | STATUS_RQS
+        return self.status
+
+    def service_requested(self):
+        return bool(self.status_byte() & STATUS_RQS)
+
+    def serial_poll(self):
+        '''
+        Returns the status byte and clears it, as a serial poll does.
+        '''
+        status = self.status_byte()
+        self.status = 0
+        return status
+
+    def query(self, command):
+        '''
+        Returns the response to an instrument query, or None if the command is
+        not a query this simulator understands.
+        '''
+        if command == 'ID?':
+            return DEVICE_ID
+        if command == 'START?':
+            return '{:.6E}'.format(self.start)
+        if command == 'STOP?':
+            return '{:.6E}'.format(self.stop)
+        if command == 'NOP?':
+            return str(self.points)
+        if command == 'SWT?':
+            return '2' if self.log_sweep else '1'
+        if command in ('A?', 'B?', 'X?'):
+            if command == 'X?':
+                data = self.freq_data()
+            else:
+                mag, phase = self.response()
+                data = mag if command == 'A?' else phase
+                if command == 'B?':
+                    self.sweep_count += 1
+            return data
+        return None
+
+    def encode(self, data):
+        if isinstance(data, str):
+            return data.encode('ascii') + b'\r\n'
+        if self.data_format in BINARY_DTYPES:
+            payload = np.asarray(data, dtype=BINARY_DTYPES[self.data_format]).tobytes()
+            return b'#A' + len(payload).to_bytes(2, 'big') + payload + b'\r\n'
+        return ','.join('{:.6E}'.format(v) for v in data).encode('ascii') + b'\r\n'
+
+
+class PrologixHandler(socketserver.StreamRequestHandler):
+    '''
+    This class handles one client connection, it interprets Prologix '++'
+    controller commands itself and passes everything else to the simulated
+    instrument on the bus.
+    '''
+    def setup(self):
+        super(PrologixHandler, self).setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sim = self.server.simulator
+        self.auto = self.sim.auto
+        self.addr = 11
+        self.pending = None
+
+    def handle(self):
+        for raw in self.rfile:
+            for command in raw.decode('ascii', 'replace').strip().split(';'):
+                command = command.strip()
+                if command and not self.dispatch(command):
+                    return
+
+    def dispatch(self, command):
+        self.sim.logger.debug('Received "{}"'.format(command))
+        if command.startswith('++'):
+            return self.controller_command(command[2:].split())
+        state = self.sim.state
+        with self.sim.lock:
+            response = state.query(command.upper())
+            if response is None:
+                state.apply(command.upper().replace(' ', ''))
+                return True
+            reply = state.encode(response)
+        if self.auto:
+            return self.reply(reply, data=not isinstance(response, str))
+        self.pending = (reply, not isinstance(response, str))
+        return True
+
+    def controller_command(self, args):
+        name = args[0] if args else ''
+        if name == 'ver':
+            return self.reply(PROLOGIX_VERSION.encode('ascii') + b'\r\n')
+        if name == 'auto':
+            if len(args) > 1:
+                self.auto = args[1] == '1'
+                return True
+            return self.reply(b'1\r\n' if self.auto else b'0\r\n')
+        if name == 'addr':
+            if len(args) > 1:
+                self.addr = int(args[1])
+                return True
+            return self.reply('{}\r\n'.format(self.addr).encode('ascii'))
+        if name in ('srq', 'spoll'):
+            with self.sim.lock:
+                if name == 'srq':
+                    value = int(self.sim.state.service_requested())
+                else:
+                    value = self.sim.state.serial_poll()
+            return self.reply('{}\r\n'.format(value).encode('ascii'))
+        if name == 'read' and self.pending is not None:
+            reply, data = self.pending
+            self.pending = None
+            return self.reply(reply, data=data)
+        return True
+
+    def reply(self, payload, data=False):
+        '''
+        Sends a response with the configured link latency. Fault modes are
+        only applied to trace data so the connection handshake still works.
+        '''
+        sim = self.sim
+        fault = sim.fault if data and sim.rng.random() < sim.fault_rate else 'none'
+        if fault == 'drop':
+            return True
+        if fault == 'disconnect':
+            return False
+        if fault == 'truncate':
+            payload = payload[:len(payload) // 2]
+        elif fault == 'garbage':
+            payload = bytes(sim.rng.randrange(32, 256) for _ in range(len(payload) - 2)) + b'\r\n'
+        elif fault == 'stall':
+            time.sleep(sim.stall_time)
+        if sim.byte_delay:
+            time.sleep(len(payload) * sim.byte_delay)
+        try:
+            self.wfile.write(payload)
+        except OSError:
+            return False
+        return True
+
+
+class ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Simulator(object):
+    '''
+    This class is a stand-in for a HP4195A behind a Prologix GPIB-ETHERNET
+    controller. It listens on a TCP port so the hp4195a process can connect
+    to it exactly as it would to the real hardware.
+    '''
+    def __init__(self, host='127.0.0.1', port=1234, points=401,
+                 byte_delay=0.0, fault='none', fault_rate=0.0,
+                 stall_time=5.0, auto=True, sweep_time=0.0, seed=None):
+        if fault not in FAULT_MODES:
+            raise ValueError('Unknown fault mode: {}'.format(fault))
+        self.logger = logging.getLogger(__name__)
+        self.state = InstrumentState(points=points, sweep_time=sweep_time, seed=seed)
+        self.lock = threading.Lock()
+        self.byte_delay = byte_delay
+        self.fault = fault
+        self.fault_rate = fault_rate
+        self.stall_time = stall_time
+        # the controller keeps its read-after-write setting across power
+        # cycles, the driver expects it to already be enabled when it sends ID?
+        self.auto = auto
+        self.rng = random.Random(seed)
+        self.server = ThreadingServer((host, port), PrologixHandler)
+        self.server.simulator = self
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info('Simulator listening on {}:{}'.format(*self.address))
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HP4195A and Prologix GPIB-ETHERNET simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1234)
+    parser.add_argument('--points', type=int, default=401,
+                        help='number of points per trace')
+    parser.add_argument('--byte-delay', type=float, default=0.0,
+                        help='seconds of link latency added per byte sent')
+    parser.add_argument('--fault', choices=FAULT_MODES, default='none')
+    parser.add_argument('--fault-rate', type=float, default=0.0,
+                        help='probability of a fault on each trace transfer')
+    parser.add_argument('--sweep-time', type=float, default=0.0,
+                        help='seconds a triggered single sweep takes')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    sim = Simulator(args.host, args.port, points=args.points,
+                    byte_delay=args.byte_delay, fault=args.fault,
+                    fault_rate=args.fault_rate, sweep_time=args.sweep_time,
+                    seed=args.seed)
+    sim.logger.info('Simulator listening on {}:{}'.format(*sim.address))
+    try:
+        sim.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
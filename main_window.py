@@ -1,25 +1,38 @@
-import csv
-import markdown
+import json
+import queue
 import logging
-import logging.handlers
 import numpy as np
-from PyQt5 import QtWidgets, QtCore, QtGui, QtWebEngineWidgets
+from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtGui import QIcon
 from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.ticker import FuncFormatter, MaxNLocator, EngFormatter
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from command_client import CommandClient
+from trace_buffer import TraceHistory
+import decimation
+import analysis
+import trace_monitor
+from metrics import Metrics, format_snapshot
+import multi_logging as ml
+import export
 
 
 class MainWindow(QtWidgets.QMainWindow):
     '''
     This class is for the main GUI window, it creates the graph, textboxes, buttons etc. and their events. It does not directly communicate with the hardware but instead puts messages in a command queue which are handled by another process.
     '''
-    def __init__(self, command_queue, message_queue, data_queue, logging_queue):
+    def __init__(self, command_queue, message_queue, data_queue, logging_queue,
+                 trace_channel=None, metrics=False, log_level=logging.INFO,
+                 event_queue=None):
         super(MainWindow, self).__init__()
         # create data queues
         self.command_queue = command_queue
         self.message_queue = message_queue
         self.data_queue = data_queue
         self.logging_queue = logging_queue
+        self.trace_channel = trace_channel
+        self.event_queue = event_queue
 
         # main window settings
         self.title = 'HP4195A'
@@ -28,13 +41,33 @@ class MainWindow(QtWidgets.QMainWindow):
         self.height = 600
 
         # create logging queue and handler
-        self.qh = logging.handlers.QueueHandler(self.logging_queue)
+        self.qh = ml.BatchingQueueHandler(self.logging_queue)
         self.root = logging.getLogger()
-        self.root.setLevel(logging.DEBUG)
+        self.root.setLevel(log_level)
         self.root.addHandler(self.qh)
         self.logger = logging.getLogger(__name__)
 
+        self.metrics = Metrics(metrics)
+        self.client = CommandClient(self.command_queue, self.message_queue, parent=self,
+                                    metrics=self.metrics)
+        self.metrics_window = None
+        self.connect_timeout = 30
+        self.command_timeout = 15
+        self.acquisition_timeout = 60
+        self.acquired_sweep = None
+        self.average_count = 16
+        self.smooth_width = 5
+        # with Monitor Changes only the sweeps that moved by more than these
+        # thresholds, broke the mask or are heartbeats are sent by the device
+        # process
+        self.monitor_options = {'mag_threshold': 1, 'phase_threshold': 10, 'heartbeat': 10}
+        self.file_filter = "CSV Files (*.csv);;Text Files (*.txt);;NumPy Files (*.npz);;Touchstone Files (*.s1p *.s2p);;All Files (*)"
+
         self.connected = False
+        self.continuous = False
+        self.refresh_interval = 100
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh_continuous)
         self.initUI()
 
     def initUI(self):
@@ -44,6 +77,8 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.graph = PlotCanvas(self,
                                 data_queue=self.data_queue,
+                                trace_channel=self.trace_channel,
+                                metrics=self.metrics,
                                 width=6,
                                 height=4.1)
         self.graph.move(0,20)
@@ -58,9 +93,12 @@ class MainWindow(QtWidgets.QMainWindow):
         self.generate_persistance_checkbox()
         self.generate_mag_enable_checkbox()
         self.generate_phase_enable_checkbox()
+        self.generate_continuous_checkbox()
+        self.generate_sweep_rate_box()
         self.generate_menu_bar()
 
         self.acquire_button.setEnabled(False)
+        self.continuous_cb.setEnabled(False)
         self.update_button.setEnabled(False)
         self.save_button.setEnabled(True)
 
@@ -69,11 +107,24 @@ class MainWindow(QtWidgets.QMainWindow):
     def generate_menu_bar(self):
         self.main_menu = self.menuBar()
         self.file_menu = self.main_menu.addMenu('File')
+        self.view_menu = self.main_menu.addMenu('View')
+        self.analysis_menu = self.main_menu.addMenu('Analysis')
         self.about_menu = self.main_menu.addMenu('About')
 
         self.generate_menu_save_button()
+        self.generate_menu_export_button()
+        self.generate_menu_archive_button()
         self.generate_menu_exit_button()
+        self.generate_menu_waterfall_button()
+        self.generate_menu_metrics_button()
+        self.generate_menu_average_button()
+        self.generate_menu_smooth_button()
+        self.generate_menu_unwrap_button()
+        self.generate_menu_resonance_button()
+        self.generate_menu_adaptive_button()
+        self.generate_menu_monitor_button()
         self.generate_menu_help_button()
+        self.generate_cancel_shortcut()
 
     def generate_menu_save_button(self):
         self.save_button = QtWidgets.QAction(QIcon('exit24.png'),
@@ -84,6 +135,22 @@ class MainWindow(QtWidgets.QMainWindow):
         self.save_button.triggered.connect(self.save_file_dialog)
         self.file_menu.addAction(self.save_button)
 
+    def generate_menu_export_button(self):
+        self.export_button = QtWidgets.QAction(QIcon('exit24.png'),
+                                               'Export Buffer...',
+                                               self)
+        self.export_button.setShortcut('Ctrl+E')
+        self.export_button.setStatusTip('Export all buffered sweeps')
+        self.export_button.triggered.connect(self.export_buffer_dialog)
+        self.file_menu.addAction(self.export_button)
+
+    def generate_menu_archive_button(self):
+        self.archive_button = QtWidgets.QAction('Record to Archive...', self)
+        self.archive_button.setCheckable(True)
+        self.archive_button.setStatusTip('Append every sweep to an archive file')
+        self.archive_button.triggered.connect(self.toggle_archive)
+        self.file_menu.addAction(self.archive_button)
+
     def generate_menu_exit_button(self):
         self.exit_button = QtWidgets.QAction(QIcon('exit24.png'), 'Exit', self)
         self.exit_button.setShortcut('Ctrl+Q')
@@ -91,6 +158,80 @@ class MainWindow(QtWidgets.QMainWindow):
         self.exit_button.triggered.connect(self.close)
         self.file_menu.addAction(self.exit_button)
 
+    def generate_menu_waterfall_button(self):
+        self.waterfall_button = QtWidgets.QAction('Waterfall', self)
+        self.waterfall_button.setCheckable(True)
+        self.waterfall_button.setShortcut('Ctrl+W')
+        self.waterfall_button.setStatusTip('Show the sweep history as a waterfall image')
+        self.waterfall_button.triggered.connect(self.change_waterfall_state)
+        self.view_menu.addAction(self.waterfall_button)
+
+    def generate_menu_metrics_button(self):
+        self.metrics_button = QtWidgets.QAction('Metrics...', self)
+        self.metrics_button.setShortcut('Ctrl+M')
+        self.metrics_button.setStatusTip('Show latency and throughput metrics')
+        self.metrics_button.triggered.connect(self.metrics_dialog)
+        self.view_menu.addAction(self.metrics_button)
+
+    def generate_menu_average_button(self):
+        self.average_button = QtWidgets.QAction('Average', self)
+        self.average_button.setCheckable(True)
+        self.average_button.setStatusTip('Exponentially average the last {} sweeps'.format(self.average_count))
+        self.average_button.triggered.connect(self.change_analysis_state)
+        self.analysis_menu.addAction(self.average_button)
+        self.reset_average_button = QtWidgets.QAction('Restart Average', self)
+        self.reset_average_button.setStatusTip('Discard the sweeps averaged so far')
+        self.reset_average_button.triggered.connect(self.graph.processor.reset)
+        self.analysis_menu.addAction(self.reset_average_button)
+
+    def generate_menu_smooth_button(self):
+        self.smooth_button = QtWidgets.QAction('Smooth', self)
+        self.smooth_button.setCheckable(True)
+        self.smooth_button.setStatusTip('Smooth the traces over {} points'.format(self.smooth_width))
+        self.smooth_button.triggered.connect(self.change_analysis_state)
+        self.analysis_menu.addAction(self.smooth_button)
+
+    def generate_menu_unwrap_button(self):
+        self.unwrap_button = QtWidgets.QAction('Unwrap Phase', self)
+        self.unwrap_button.setCheckable(True)
+        self.unwrap_button.setStatusTip('Remove the 360 degree jumps from the phase trace')
+        self.unwrap_button.triggered.connect(self.change_analysis_state)
+        self.analysis_menu.addAction(self.unwrap_button)
+
+    def generate_menu_resonance_button(self):
+        self.resonance_button = QtWidgets.QAction('Resonance Markers', self)
+        self.resonance_button.setCheckable(True)
+        self.resonance_button.setShortcut('Ctrl+R')
+        self.resonance_button.setStatusTip('Mark the peak, its -3 dB bandwidth and Q')
+        self.resonance_button.triggered.connect(self.change_resonance_state)
+        self.analysis_menu.addAction(self.resonance_button)
+
+    def generate_menu_adaptive_button(self):
+        self.adaptive_button = QtWidgets.QAction('Adaptive Acquire', self)
+        self.adaptive_button.setShortcut('Ctrl+Shift+A')
+        self.adaptive_button.setStatusTip('Acquire a coarse sweep and re-sweep narrow spans around its peaks and notches')
+        self.adaptive_button.triggered.connect(self.start_adaptive_acquisition)
+        self.analysis_menu.addSeparator()
+        self.analysis_menu.addAction(self.adaptive_button)
+
+    def generate_menu_monitor_button(self):
+        self.monitor_button = QtWidgets.QAction('Monitor Changes', self)
+        self.monitor_button.setCheckable(True)
+        self.monitor_button.setShortcut('Ctrl+Shift+M')
+        self.monitor_button.setStatusTip('Only show and archive sweeps that changed by more than {} dB or {} degrees'.format(self.monitor_options['mag_threshold'], self.monitor_options['phase_threshold']))
+        self.monitor_button.triggered.connect(self.change_monitor_state)
+        self.reference_button = QtWidgets.QAction('Set Reference', self)
+        self.reference_button.setStatusTip('Compare the following sweeps with the last one instead of the previous one shown')
+        self.reference_button.triggered.connect(self.set_reference)
+        self.mask_button = QtWidgets.QAction('Load Mask...', self)
+        self.mask_button.setStatusTip('Raise an alarm when the magnitude leaves the limits in a CSV file')
+        self.mask_button.triggered.connect(self.load_mask_dialog)
+        self.clear_mask_button = QtWidgets.QAction('Clear Mask', self)
+        self.clear_mask_button.triggered.connect(self.clear_mask)
+        self.analysis_menu.addSeparator()
+        for action in (self.monitor_button, self.reference_button, self.mask_button, self.clear_mask_button):
+            self.analysis_menu.addAction(action)
+
     def generate_menu_help_button(self):
         self.help_button = QtWidgets.QAction(QIcon('exit24.png'), 'Help', self)
         self.help_button.setShortcut('Ctrl+H')
@@ -98,6 +239,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self.help_button.triggered.connect(self.help_dialog)
         self.about_menu.addAction(self.help_button)
 
+    def generate_cancel_shortcut(self):
+        self.cancel_shortcut = QtWidgets.QShortcut(QtGui.QKeySequence('Esc'), self)
+        self.cancel_shortcut.activated.connect(self.cancel_requests)
+
     def generate_connection_button(self):
         self.connect_button = QtWidgets.QPushButton('Connect', self)
         self.connect_button.setToolTip('Connect to a HP4195A Network Analyser')
@@ -161,7 +306,7 @@ class MainWindow(QtWidgets.QMainWindow):
     def generate_mag_enable_checkbox(self):
         self.mag_cb = QtWidgets.QCheckBox('Magnitude', self)
         self.mag_cb.toggle()
-        self.mag_cb.resize(590,30)
+        self.mag_cb.resize(100,30)
         self.mag_cb.move(100, 450)
         self.mag_cb.setToolTip('Display magnitude data')
         self.mag_cb.stateChanged.connect(self.change_mag_state)
@@ -173,6 +318,39 @@ class MainWindow(QtWidgets.QMainWindow):
         self.phase_cb.setToolTip('Display phase data')
         self.phase_cb.stateChanged.connect(self.change_phase_state)
 
+    def generate_continuous_checkbox(self):
+        self.continuous_cb = QtWidgets.QCheckBox('Continuous', self)
+        self.continuous_cb.resize(100,30)
+        self.continuous_cb.move(290, 450)
+        self.continuous_cb.setToolTip('Acquire and display sweeps continuously')
+        self.continuous_cb.stateChanged.connect(self.change_continuous_state)
+
+    def generate_sweep_rate_box(self):
+        self.sweep_rate_box = QtWidgets.QDoubleSpinBox(self)
+        self.sweep_rate_box.setRange(0, 10)
+        self.sweep_rate_box.setSingleStep(0.1)
+        self.sweep_rate_box.setSpecialValueText('Max')
+        self.sweep_rate_box.resize(80,30)
+        self.sweep_rate_box.move(500, 450)
+        self.sweep_rate_box.setToolTip('Continuous sweep rate limit, 0 for as fast as possible')
+        self.sweep_rate_box.valueChanged.connect(self.change_sweep_rate)
+        self.sweep_rate_label = QtWidgets.QLabel('Sweeps/s:', self)
+        self.sweep_rate_label.resize(80,30)
+        self.sweep_rate_label.move(420,450)
+
+    def change_continuous_state(self):
+        if self.continuous_cb.isChecked() == self.continuous:
+            return
+        if self.continuous:
+            self.stop_continuous()
+        else:
+            self.start_continuous()
+
+    def change_sweep_rate(self):
+        self.logger.info('Sweep rate: {}'.format(self.sweep_rate_box.value()))
+        self.client.submit('set_sweep_rate', self.sweep_rate_box.value(),
+                           timeout=self.command_timeout)
+
     def change_persist_state(self):
         if self.graph.persist:
             self.graph.persist = False
@@ -185,6 +363,76 @@ class MainWindow(QtWidgets.QMainWindow):
             self.phase_cb.setEnabled(False)
             self.logger.info('Persistence: Enabled')
 
+    def change_waterfall_state(self):
+        self.graph.waterfall = self.waterfall_button.isChecked()
+        self.logger.info('Waterfall: {}'.format('Enabled' if self.graph.waterfall else 'Disabled'))
+        self.graph.plot()
+
+    def change_analysis_state(self):
+        processor = self.graph.processor
+        processor.average = self.average_count if self.average_button.isChecked() else 0
+        processor.smooth = self.smooth_width if self.smooth_button.isChecked() else 0
+        processor.unwrap = self.unwrap_button.isChecked()
+        processor.reset()
+        self.logger.info('Analysis: average {}, smooth {}, unwrap {}'.format(processor.average, processor.smooth, processor.unwrap))
+
+    def change_resonance_state(self):
+        self.graph.resonance = self.resonance_button.isChecked()
+        self.logger.info('Resonance markers: {}'.format('Enabled' if self.graph.resonance else 'Disabled'))
+        self.graph.plot()
+
+    def change_monitor_state(self):
+        options = self.monitor_options if self.monitor_button.isChecked() else None
+        self.submit('set_monitor', options, timeout=self.command_timeout)
+        self.logger.info('Monitor changes: {}'.format('Enabled' if options is not None else 'Disabled'))
+
+    def set_reference(self):
+        if not self.monitor_button.isChecked():
+            self.monitor_button.setChecked(True)
+            self.change_monitor_state()
+        self.submit('set_reference', callback=self.reference_set,
+                    timeout=self.command_timeout)
+
+    def reference_set(self, success, payload):
+        if success:
+            self.logger.info('Comparing sweeps with a fixed reference')
+        else:
+            self.logger.info('Could not set the reference: {}'.format(payload))
+
+    def load_mask_dialog(self):
+        options = QtWidgets.QFileDialog.Options()
+        options |= QtWidgets.QFileDialog.DontUseNativeDialog
+        file_name, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Load Mask", "", "CSV Files (*.csv);;All Files (*)", options=options)
+        if not file_name:
+            return
+        try:
+            self.monitor_options['mag_mask'] = trace_monitor.load_mask(file_name)
+        except (OSError, ValueError) as e:
+            self.logger.warning('Could not load mask {}: {}'.format(file_name, e))
+            return
+        self.logger.info('Loaded mask {}'.format(file_name))
+        self.monitor_button.setChecked(True)
+        self.change_monitor_state()
+
+    def clear_mask(self):
+        self.monitor_options.pop('mag_mask', None)
+        if self.monitor_button.isChecked():
+            self.change_monitor_state()
+
+    def show_alarms(self):
+        '''
+        Shows the alarm events raised by the device process since the last
+        call in the status bar, they are logged by the device process.
+        '''
+        if self.event_queue is None:
+            return
+        while True:
+            try:
+                event = self.event_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.statusBar().showMessage(trace_monitor.format_event(event))
+
     def change_mag_state(self):
         if self.graph.magnitude:
             self.graph.magnitude = False
@@ -206,60 +454,159 @@ class MainWindow(QtWidgets.QMainWindow):
             self.graph.plot()
 
     def toggle_connect_button(self):
-        if len(self.command_box.text()) > 0 and self.connected:
+        if len(self.command_box.text()) > 0 and self.connected and not self.continuous:
             self.command_button.setEnabled(True)
         else:
             self.command_button.setEnabled(False)
 
+    def submit(self, command, *args, callback=None, timeout=None):
+        '''
+        Sends a request to the device process without waiting for it. A busy
+        cursor is shown until the reply arrives, times out or is cancelled.
+        '''
+        def finished(success, payload):
+            QtWidgets.QApplication.restoreOverrideCursor()
+            if callback is not None:
+                callback(success, payload)
+
+        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.BusyCursor)
+        return self.client.submit(command, *args, callback=finished, timeout=timeout)
+
+    def cancel_requests(self):
+        self.logger.info('Cancelling {} pending request(s)'.format(len(self.client.pending)))
+        self.client.cancel_all()
+
     def connect(self):
+        if self.client.busy('connect') or self.client.busy('disconnect'):
+            return
         if self.connected:
+            if self.continuous:
+                self.stop_continuous()
             self.logger.info('Disconnecting from HP4195A')
-            QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-            self.command_queue.put('disconnect')
-            self.logger.info('Command queue size = {}'.format(self.command_queue.qsize()))
-            if self.message_queue.get():
-                self.logger.info('Message queue size = {}'.format(self.message_queue.qsize()))
-                self.logger.info('Successfully disconnected from HP4195A')
-                QtWidgets.QApplication.restoreOverrideCursor()
-                self.connect_button.setText("Connect")
-                self.acquire_button.setEnabled(False)
-                self.connected = False
-            else:
-                self.logger.info('Disconnection from HP4195 failed')
+            self.connect_button.setEnabled(False)
+            return self.submit('disconnect', callback=self.disconnected,
+                               timeout=self.command_timeout)
         else:
             self.logger.info('Attempting to connect to HP4195A')
-            QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-            self.command_queue.put('connect')
-            self.logger.info('Command queue size = {}'.format(self.command_queue.qsize()))
-            if self.message_queue.get():
-                self.logger.info('Message queue size = {}'.format(self.message_queue.qsize()))
-                self.logger.info('Successfully connected to HP4195A')
-                QtWidgets.QApplication.restoreOverrideCursor()
-                self.connect_button.setText("Disconnect")
-                self.acquire_button.setEnabled(True)
-                self.connected = True
-            else:
-                self.logger.info('Connection to HP4195 failed')
+            self.connect_button.setEnabled(False)
+            return self.submit('connect', callback=self.connected_reply,
+                               timeout=self.connect_timeout)
+
+    def disconnected(self, success, payload):
+        self.connect_button.setEnabled(True)
+        if success:
+            self.logger.info('Successfully disconnected from HP4195A')
+            self.connect_button.setText("Connect")
+            self.acquire_button.setEnabled(False)
+            self.continuous_cb.setEnabled(False)
+            self.connected = False
+            self.toggle_connect_button()
+        else:
+            self.logger.info('Disconnection from HP4195 failed: {}'.format(payload))
+
+    def connected_reply(self, success, payload):
+        self.connect_button.setEnabled(True)
+        if success:
+            self.logger.info('Successfully connected to HP4195A')
+            self.connect_button.setText("Disconnect")
+            self.acquire_button.setEnabled(True)
+            self.continuous_cb.setEnabled(True)
+            self.connected = True
+            self.toggle_connect_button()
+        else:
+            self.logger.info('Connection to HP4195 failed: {}'.format(payload))
 
     def start_acquisition(self):
         self.logger.info('Starting data acquisition')
-        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
         self.acquire_button.setEnabled(False)
-        self.command_queue.put('start_acquisition')
-        self.logger.info('Command queue size = {}'.format(self.command_queue.qsize()))
-        reply = self.message_queue.get()
-        self.logger.info('Message queue size = {}'.format(self.message_queue.qsize()))
-        if reply:
+        self.submit('start_acquisition', callback=self.acquired,
+                    timeout=self.acquisition_timeout)
+
+    def start_adaptive_acquisition(self):
+        if not self.connected or self.continuous:
+            self.logger.info('Adaptive acquisition needs a connection and continuous acquisition stopped')
+            return
+        self.logger.info('Starting adaptive data acquisition')
+        self.acquire_button.setEnabled(False)
+        self.submit('adaptive_sweep', callback=self.acquired,
+                    timeout=self.acquisition_timeout)
+
+    def acquired(self, success, payload):
+        self.show_alarms()
+        if success:
             self.logger.info('Successfully acquired data')
-            QtWidgets.QApplication.restoreOverrideCursor()
+            self.acquired_sweep = payload
             self.update_button.setEnabled(True)
             self.save_button.setEnabled(True)
         else:
-            self.logger.info('Data acquisition failed')
-            self.acquire_button.setEnabled(True)
+            self.logger.info('Data acquisition failed: {}'.format(payload))
+            self.acquire_button.setEnabled(self.connected and not self.continuous)
+
+    def start_continuous(self):
+        self.logger.info('Starting continuous acquisition')
+        self.continuous = True
+        self.acquire_button.setEnabled(False)
+        self.update_button.setEnabled(False)
+        self.command_button.setEnabled(False)
+        self.submit('start_continuous', callback=self.continuous_started,
+                    timeout=self.command_timeout)
+
+    def continuous_started(self, success, payload):
+        if success:
+            self.refresh_timer.start(self.refresh_interval)
+        else:
+            self.logger.info('Continuous acquisition failed to start: {}'.format(payload))
+            self.finish_continuous()
+
+    def stop_continuous(self):
+        self.logger.info('Stopping continuous acquisition')
+        self.submit('stop_continuous', callback=lambda success, payload: self.finish_continuous(),
+                    timeout=self.acquisition_timeout)
+
+    def finish_continuous(self):
+        self.refresh_timer.stop()
+        self.continuous = False
+        self.refresh_continuous()
+        self.continuous_cb.setChecked(False)
+        self.acquire_button.setEnabled(self.connected)
+        self.toggle_connect_button()
+
+    def refresh_continuous(self):
+        '''
+        Draws the newest sweep waiting on the data queue. Older sweeps that
+        arrived since the last refresh are not drawn, only added to the
+        average.
+        '''
+        latest = None
+        stopped = False
+        received = 0
+        while True:
+            try:
+                item = self.data_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                stopped = True
+            else:
+                if latest is not None:
+                    self.graph.accumulate(latest)
+                latest = item
+                received += 1
+        if latest is not None:
+            self.metrics.count('sweeps_displayed')
+            self.metrics.count('sweeps_skipped', received - 1)
+            self.graph.load_sweep(latest)
+            self.graph.plot()
+        self.show_alarms()
+        if stopped and self.continuous:
+            self.logger.info('Continuous acquisition stopped by the device process')
+            self.finish_continuous()
 
     def update_plot(self):
         self.logger.info('Updating plot')
+        if self.acquired_sweep is not None:
+            self.graph.load_sweep(self.acquired_sweep)
+            self.acquired_sweep = None
         self.graph.plot()
         # TODO: check plot updated OK
         self.update_button.setEnabled(False)
@@ -267,36 +614,109 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def send_command(self):
         command = self.command_box.text()
-        self.command_queue.put('send_command')
-        self.logger.info('Command queue size = {}'.format(self.command_queue.qsize()))
-        self.command_queue.put(command)
-        self.logger.info('Command queue size = {}'.format(self.command_queue.qsize()))
-        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-        response = self.data_queue.get()
-        self.logger.info('Data queue size = {}'.format(self.data_queue.qsize()))
-        if len(response) > 0:
-            QtWidgets.QApplication.restoreOverrideCursor()
+        self.command_box.setText('')
+        # several commands separated by ';' are sent back to back as one batch
+        commands = [c.strip() for c in command.split(';') if c.strip()]
+        if len(commands) > 1:
+            self.submit('query_batch', commands,
+                        callback=lambda success, responses: self.batch_reply(commands, success, responses),
+                        timeout=self.command_timeout)
+            return
+        self.submit('send_command', command,
+                    callback=lambda success, response: self.command_reply(command, success, response),
+                    timeout=self.command_timeout)
+
+    def batch_reply(self, commands, success, responses):
+        if not success:
+            self.response_box.setText('{}: {}'.format('; '.join(commands), responses or 'No response'))
+            return
+        replies = ['{}: {}'.format(c, r) for c, r in zip(commands, responses) if r]
+        self.response_box.setText('; '.join(replies) or 'No response')
+
+    def command_reply(self, command, success, response):
+        if success and len(response) > 0:
             self.response_box.setText('{}: {}'.format(command, response))
-            self.command_box.setText('')
+        else:
+            self.response_box.setText('{}: {}'.format(command, response or 'No response'))
 
-    def save_file_dialog(self):
+    def get_save_file_name(self, title):
         options = QtWidgets.QFileDialog.Options()
         options |= QtWidgets.QFileDialog.DontUseNativeDialog
-        file_name, _ = QtWidgets.QFileDialog.getSaveFileName(self,"Save File","","All Files (*);;Text Files (*.txt);;CSV Files (*.csv)", options=options)
+        file_name, _ = QtWidgets.QFileDialog.getSaveFileName(self, title, "", self.file_filter, options=options)
+        return file_name
+
+    def save_file_dialog(self):
+        file_name = self.get_save_file_name("Save File")
         if file_name:
             self.save_file(file_name)
 
     def save_file(self, file_name):
-        file_name = file_name +'.csv'
         self.logger.info('Saving data to: {}'.format(file_name))
-        rows = zip(self.graph.freq_data,
-                   self.graph.mag_data,
-                   self.graph.phase_data)
-        with open(file_name, "w") as output:
-            writer = csv.writer(output, lineterminator='\n')
-            writer.writerow(['Frequency', 'Magnitude', 'Phase'])
-            for row in rows:
-                writer.writerow(row)
+        names = export.export(file_name,
+                              self.graph.freq_data,
+                              self.graph.mag_data,
+                              self.graph.phase_data)
+        self.logger.info('Saved data to: {}'.format(', '.join(names)))
+
+    def toggle_archive(self):
+        if not self.archive_button.isChecked():
+            self.logger.info('Stopping archive recording')
+            self.submit('close_archive', timeout=self.command_timeout)
+            return
+        options = QtWidgets.QFileDialog.Options()
+        options |= QtWidgets.QFileDialog.DontUseNativeDialog
+        options |= QtWidgets.QFileDialog.DontConfirmOverwrite
+        file_name, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Record to Archive", "", "Sweep Archives (*.sweeps);;All Files (*)", options=options)
+        if not file_name:
+            self.archive_button.setChecked(False)
+            return
+        if not file_name.endswith('.sweeps'):
+            file_name = file_name + '.sweeps'
+        self.submit('open_archive', file_name, callback=self.archive_opened,
+                    timeout=self.command_timeout)
+
+    def archive_opened(self, success, payload):
+        if success:
+            self.logger.info('Recording sweeps to: {}'.format(payload))
+        else:
+            self.logger.info('Could not open archive: {}'.format(payload))
+            self.archive_button.setChecked(False)
+
+    def export_buffer_dialog(self):
+        file_name = self.get_save_file_name("Export Buffer")
+        if file_name:
+            self.submit('get_buffer',
+                        callback=lambda success, buffer: self.export_buffer(file_name, success, buffer),
+                        timeout=self.command_timeout)
+
+    def export_buffer(self, file_name, success, buffer):
+        '''
+        Saves the sweeps buffered by the device process in one file. Only the
+        sweeps with the same point count as the newest one are exported so
+        they stack into 2-D arrays.
+        '''
+        if not success or len(buffer['points']) == 0:
+            self.logger.info('No buffered sweeps to export')
+            return
+        points = buffer['points'][-1]
+        rows = buffer['points'] == points
+        self.logger.info('Exporting {} sweeps to: {}'.format(np.count_nonzero(rows), file_name))
+        names = export.export(file_name,
+                              buffer['freq_data'][rows, :points],
+                              buffer['mag_data'][rows, :points],
+                              buffer['phase_data'][rows, :points],
+                              timestamps=buffer['timestamps'][rows],
+                              sequence=buffer['sequence'][rows])
+        if len(names) > 1:
+            self.logger.info('Exported to: {} ... {}'.format(names[0], names[-1]))
+        else:
+            self.logger.info('Exported to: {}'.format(names[0]))
+
+    def metrics_dialog(self):
+        if self.metrics_window is None:
+            self.metrics_window = Metrics_Window(self)
+        self.metrics_window.show()
+        self.metrics_window.raise_()
 
     def help_dialog(self):
         help_window = Help_Window()
@@ -304,8 +724,9 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def closeEvent(self, event):
         if True:
+            self.client.cancel_all()
             if self.connected:
-                self.connect()
+                self.client.wait(self.connect(), timeout=self.command_timeout)
             event.accept()
         else:
             event.ignore()
@@ -314,23 +735,39 @@ class MainWindow(QtWidgets.QMainWindow):
 class PlotCanvas(FigureCanvas):
     '''
     This class is for the figure that displays the data, it reads data off the data queue and updates the graph depending on the settings.
+
+    The trace artists are created once and updated in place. Redraws blit the traces onto a cached background of the axes, a full redraw (including the layout) only happens when the axis limits or the view change. Earlier sweeps are kept in a bounded 2-D trace history. In persist mode up to lod_threshold of them are overlaid as lines reduced to screen resolution, beyond that their min/max envelope is drawn instead. The waterfall view draws the history as a single image, newest sweep at the top.
+
+    Incoming sweeps pass through a TraceProcessor for averaging, smoothing and phase unwrapping before they are drawn, and the resonance markers show the peak, its -3 dB points and Q of the magnitude trace.
     '''
     def __init__(self,
                  parent=None,
                  data_queue=None,
+                 trace_channel=None,
+                 metrics=None,
                  width=5,
                  height=4,
                  dpi=100):
         self.data_queue = data_queue
+        self.trace_channel = trace_channel
+        self.metrics = metrics if metrics is not None else Metrics()
         self.persist = False
+        self.waterfall = False
+        self.history_depth = 1000
+        self.lod_threshold = 50
         self.magnitude = True
         self.phase = True
-        self.freq_data = range(1, 100)
-        self.mag_data = [0 for i in range(1, 100)]
-        self.phase_data = [0 for i in range(1, 100)]
+        self.freq_data = np.arange(1, 100)
+        self.mag_data = np.zeros(99)
+        self.phase_data = np.zeros(99)
+        self.history = TraceHistory(self.history_depth)
+        self.processor = analysis.TraceProcessor()
+        self.resonance = False
+        self.background = None
         self.fig = Figure(figsize=(width, height), dpi=dpi)
         self.mag_ax = self.fig.add_subplot(111)
         self.phase_ax = self.mag_ax.twinx()
+        self.waterfall_ax = self.fig.add_subplot(111, label='waterfall')
 
         FigureCanvas.__init__(self, self.fig)
         self.setParent(parent)
@@ -339,46 +776,337 @@ class PlotCanvas(FigureCanvas):
                                    QtWidgets.QSizePolicy.Expanding,
                                    QtWidgets.QSizePolicy.Expanding)
         FigureCanvas.updateGeometry(self)
+        self.create_artists()
+        self.mpl_connect('draw_event', self.on_draw)
         self.plot()
 
-    def plot(self):
-        if self.persist == False:
-            self.mag_ax.clear()
-            self.phase_ax.clear()
-
-        if self.data_queue.qsize():
-            self.mag_data = self.data_queue.get()
-            self.phase_data = self.data_queue.get()
-            self.freq_data = self.data_queue.get()
-
+    def create_artists(self):
         self.mag_ax.set_ylabel('Magnitude (dB)')
         self.phase_ax.set_ylabel('Phase (deg)')
         self.mag_ax.set_xlabel('Frequency (Hz)')
-        self.phase_ax.set_xlim(np.min(self.freq_data),                                                 np.max(self.freq_data))
-        self.phase_ax.set_ylim(np.min(self.phase_data)-20,                                             np.max(self.phase_data)+20)
-        self.mag_ax.set_xlim(np.min(self.freq_data), np.max(self.freq_data))
-        self.mag_ax.set_ylim(np.min(self.mag_data)-20,                                               np.max(self.mag_data)+20)
+        self.mag_ax.set_xscale('log')
+        self.phase_ax.set_xscale('log')
+        self.mag_ax.grid(color='0.9', linestyle='--', linewidth=1)
+        self.phase_ax.grid(color='0.9', linestyle='--', linewidth=1)
+
+        self.mag_overlay = LineCollection([], colors='b', linewidths=0.5, alpha=0.3, animated=True)
+        self.phase_overlay = LineCollection([], colors='r', linewidths=0.5, alpha=0.3, animated=True)
+        self.mag_ax.add_collection(self.mag_overlay, autolim=False)
+        self.phase_ax.add_collection(self.phase_overlay, autolim=False)
+        self.mag_envelope = PolyCollection([], facecolors='b', edgecolors='none', alpha=0.2, animated=True)
+        self.phase_envelope = PolyCollection([], facecolors='r', edgecolors='none', alpha=0.2, animated=True)
+        self.mag_ax.add_collection(self.mag_envelope, autolim=False)
+        self.phase_ax.add_collection(self.phase_envelope, autolim=False)
+        self.mag_line, = self.mag_ax.plot([], [], 'b', animated=True)
+        self.phase_line, = self.phase_ax.plot([], [], 'r', animated=True)
+        self.peak_marker, = self.mag_ax.plot([], [], 'kv', animated=True)
+        self.band_line, = self.mag_ax.plot([], [], 'k|-', linewidth=1, animated=True)
+        self.resonance_text = self.mag_ax.text(0.02, 0.97, '', transform=self.mag_ax.transAxes,
+                                               va='top', fontsize=8, animated=True)
+
+        # the waterfall x axis is log10 of the frequency so the image columns
+        # are evenly spaced, the ticks are labelled in Hz
+        self.waterfall_ax.set_xlabel('Frequency')
+        self.waterfall_ax.set_ylabel('Sweeps ago')
+        hertz = EngFormatter(unit='Hz')
+        self.waterfall_ax.xaxis.set_major_locator(MaxNLocator(6, steps=[1, 2, 5, 10]))
+        self.waterfall_ax.xaxis.set_major_formatter(FuncFormatter(lambda x, pos: hertz(float('{:.3g}'.format(10 ** x)))))
+        self.waterfall_image = self.waterfall_ax.imshow(np.zeros((1, 1)), aspect='auto',
+                                                        origin='upper', interpolation='nearest',
+                                                        cmap='viridis', animated=True)
+        self.waterfall_ax.set_visible(False)
+
+    def load_sweep(self, sweep):
+        '''
+        Loads a (sequence, mag, phase, freq) sweep message from the device
+        process. Messages without arrays refer to the shared trace channel,
+        which always holds the newest sweep.
+        '''
+        sequence, mag_data, phase_data, freq_data = sweep
+        if mag_data is None:
+            latest = self.trace_channel.read()
+            if latest is None:
+                return
+            sequence, mag_data, phase_data, freq_data = latest
+        self.set_data(mag_data, phase_data, freq_data)
+
+    def accumulate(self, sweep):
+        '''
+        Adds a sweep that will not be drawn to the running average, so the
+        average covers every sweep even when the display drops some.
+        '''
+        sequence, mag_data, phase_data, freq_data = sweep
+        if self.processor.average > 1 and mag_data is not None:
+            self.processor.process(mag_data, phase_data, freq_data)
+
+    def set_data(self, mag_data, phase_data, freq_data):
+        if self.processor.enabled:
+            mag_data, phase_data = self.processor.process(mag_data, phase_data, freq_data)
+        self.mag_data = np.asarray(mag_data)
+        self.phase_data = np.asarray(phase_data)
+        self.freq_data = np.asarray(freq_data)
+        if self.persist or self.waterfall:
+            self.history.append(self.mag_data, self.phase_data, self.freq_data)
+
+    def update_limits(self):
+        '''
+        Sets new axis limits if the frequency span changed or a trace left the
+        current limits (or no longer fills them), returns True if any changed.
+        '''
+        changed = False
+        if self.waterfall_ax.get_visible() != self.waterfall:
+            self.waterfall_ax.set_visible(self.waterfall)
+            self.mag_ax.set_visible(not self.waterfall)
+            self.phase_ax.set_visible(not self.waterfall)
+            changed = True
+        x_limits = (np.min(self.freq_data), np.max(self.freq_data))
+        if self.waterfall:
+            x_limits = tuple(np.log10(x_limits))
+            if self.waterfall_ax.get_xlim() != x_limits:
+                self.waterfall_ax.set_xlim(*x_limits)
+                changed = True
+            # the sweep axis grows in powers of two up to the history depth,
+            # so it only needs a full redraw a few times as the history fills
+            rows = min(self.history_depth, max(64, 2 ** int(np.ceil(np.log2(max(len(self.history), 1))))))
+            if self.waterfall_ax.get_ylim() != (rows, 0):
+                self.waterfall_ax.set_ylim(rows, 0)
+                changed = True
+            return changed
+        if self.mag_ax.get_xlim() != x_limits:
+            self.mag_ax.set_xlim(*x_limits)
+            self.phase_ax.set_xlim(*x_limits)
+            changed = True
+        for ax, data in ((self.mag_ax, self.mag_data), (self.phase_ax, self.phase_data)):
+            low, high = np.min(data), np.max(data)
+            bottom, top = ax.get_ylim()
+            if low < bottom or high > top or low - bottom > 40 or top - high > 40:
+                ax.set_ylim(low - 20, high + 20)
+                changed = True
+        return changed
+
+    def on_draw(self, event):
+        # a full draw leaves out the animated traces, keep it as the
+        # background and blit the traces on top
+        self.background = self.copy_from_bbox(self.fig.bbox)
+        self.draw_traces()
+
+    def draw_traces(self):
+        if self.waterfall:
+            artists = (self.waterfall_image,)
+        else:
+            artists = (self.mag_envelope, self.phase_envelope, self.mag_overlay,
+                       self.phase_overlay, self.mag_line, self.phase_line,
+                       self.peak_marker, self.band_line, self.resonance_text)
+        for artist in artists:
+            artist.axes.draw_artist(artist)
+
+    def update_overlays(self):
+        '''
+        Loads the persisted sweeps into the overlay artists, as lines reduced
+        to the axes width in pixels for a few sweeps and as a min/max envelope
+        for many.
+        '''
+        n = len(self.history) if self.persist else 0
+        width = max(int(self.mag_ax.bbox.width), 1)
+        freq_data = self.history.freq_data
+        for overlay, envelope, data in ((self.mag_overlay, self.mag_envelope, self.history.mag_data),
+                                        (self.phase_overlay, self.phase_envelope, self.history.phase_data)):
+            if n == 0:
+                overlay.set_segments([])
+                envelope.set_verts([])
+            elif n <= self.lod_threshold:
+                freq, rows = decimation.minmax_decimate(freq_data, data[self.history.rows()], width)
+                overlay.set_segments(np.stack(np.broadcast_arrays(freq, rows), axis=-1))
+                envelope.set_verts([])
+            else:
+                freq, low, high = decimation.envelope(freq_data, data[:n], width)
+                overlay.set_segments([])
+                envelope.set_verts([np.column_stack((np.concatenate((freq, freq[::-1])),
+                                                     np.concatenate((low, high[::-1]))))])
 
-        if self.magnitude == True:
-            self.mag_ax.grid(color='0.9', linestyle='--', linewidth=1)
-            self.mag_ax.semilogx(self.freq_data, self.mag_data, 'b')
+    def update_waterfall(self):
+        '''
+        Loads the history of the magnitude (or the phase if the magnitude is
+        hidden) into the waterfall image, resampled to the axes size.
+        '''
+        n = len(self.history)
+        if n == 0:
+            self.waterfall_image.set_data(np.zeros((1, 1)))
+            return
+        data = self.history.mag_data if self.magnitude or not self.phase else self.history.phase_data
+        bbox = self.waterfall_ax.bbox
+        image = decimation.resample_image(self.history.freq_data,
+                                          self.history.ordered(data, newest_first=True),
+                                          max(int(bbox.width), 1), max(int(bbox.height), 1))
+        self.waterfall_image.set_data(image)
+        self.waterfall_image.set_extent(self.waterfall_ax.get_xlim() + (n, 0))
+        self.waterfall_image.set_clim(np.min(image), np.max(image))
 
-        if self.phase == True:
-            self.phase_ax.grid(color='0.9', linestyle='--', linewidth=1)
-            self.phase_ax.semilogx(self.freq_data, self.phase_data, 'r')
+    def update_resonance(self):
+        '''
+        Marks the peak of the magnitude trace and the band between its -3 dB
+        points, with the centre frequency, bandwidth and Q as text.
+        '''
+        visible = self.resonance and self.magnitude and len(self.freq_data) > 2
+        for artist in (self.peak_marker, self.band_line, self.resonance_text):
+            artist.set_visible(visible)
+        if not visible:
+            return
+        r = analysis.resonance(self.freq_data, self.mag_data)
+        peak, lower, upper = r['magnitude'][0], r['lower'][0], r['upper'][0]
+        self.peak_marker.set_data([r['frequency'][0]], [peak])
+        self.band_line.set_data([lower, upper], [peak - 3, peak - 3])
+        text = 'f0 {:.6g} Hz'.format(r['frequency'][0])
+        if np.isfinite(r['q'][0]):
+            text += '\nBW {:.4g} Hz\nQ {:.4g}'.format(r['bandwidth'][0], r['q'][0])
+        self.resonance_text.set_text(text)
 
-        self.fig.tight_layout()
-        self.draw()
+    def plot(self):
+        if not self.persist and not self.waterfall:
+            self.history.clear()
+
+        self.mag_line.set_data(self.freq_data, self.mag_data)
+        self.phase_line.set_data(self.freq_data, self.phase_data)
+        self.mag_line.set_visible(self.magnitude)
+        self.mag_overlay.set_visible(self.magnitude)
+        self.mag_envelope.set_visible(self.magnitude)
+        self.phase_line.set_visible(self.phase)
+        self.phase_overlay.set_visible(self.phase)
+        self.phase_envelope.set_visible(self.phase)
+
+        if self.update_limits() or self.background is None:
+            with self.metrics.timer('redraw.full'):
+                self.fig.tight_layout()
+                self.update_traces()
+                self.draw()
+        else:
+            with self.metrics.timer('redraw.blit'):
+                self.update_traces()
+                self.restore_region(self.background)
+                self.draw_traces()
+                self.blit(self.fig.bbox)
+
+    def update_traces(self):
+        if self.waterfall:
+            self.update_waterfall()
+        else:
+            self.update_overlays()
+            self.update_resonance()
+
+class Metrics_Window(QtWidgets.QDialog):
+    '''
+    This class is for the metrics window, it shows the latency histograms, counters and queue depths of the device process and the GUI and refreshes them once a second while it is open.
+    '''
+    def __init__(self, main_window):
+        super(Metrics_Window, self).__init__(main_window)
+        self.main_window = main_window
+        self.client = main_window.client
+        self.metrics = main_window.metrics
+        self.device_snapshot = None
+        self.refresh_interval = 1000
+        self.setWindowTitle('Metrics')
+        self.resize(620, 520)
+
+        self.enable_cb = QtWidgets.QCheckBox('Enabled', self)
+        self.enable_cb.setChecked(self.metrics.enabled)
+        self.enable_cb.setToolTip('Collect metrics in both processes')
+        self.enable_cb.stateChanged.connect(self.change_enabled_state)
+        self.reset_button = QtWidgets.QPushButton('Reset', self)
+        self.reset_button.clicked.connect(self.reset)
+        self.save_button = QtWidgets.QPushButton('Save...', self)
+        self.save_button.clicked.connect(self.save_dialog)
+        self.view = QtWidgets.QPlainTextEdit(self)
+        self.view.setReadOnly(True)
+        self.view.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+
+        self.buttons = QtWidgets.QHBoxLayout()
+        self.buttons.addWidget(self.enable_cb)
+        self.buttons.addStretch()
+        self.buttons.addWidget(self.reset_button)
+        self.buttons.addWidget(self.save_button)
+        self.layout = QtWidgets.QVBoxLayout(self)
+        self.layout.addLayout(self.buttons)
+        self.layout.addWidget(self.view)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start(self.refresh_interval)
+        super(Metrics_Window, self).showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super(Metrics_Window, self).hideEvent(event)
+
+    def change_enabled_state(self):
+        enabled = self.enable_cb.isChecked()
+        self.metrics.enable(enabled)
+        self.client.submit('enable_metrics', enabled, timeout=self.main_window.command_timeout)
+        self.refresh()
+
+    def reset(self):
+        self.metrics.reset()
+        self.client.submit('reset_metrics', timeout=self.main_window.command_timeout)
+        self.refresh()
+
+    def refresh(self):
+        if not self.client.busy('get_metrics'):
+            self.client.submit('get_metrics', callback=self.device_metrics,
+                               timeout=self.main_window.command_timeout)
+        self.show_metrics()
+
+    def device_metrics(self, success, payload):
+        if success:
+            self.device_snapshot = payload
+            self.show_metrics()
+
+    def snapshots(self):
+        return {'device': self.device_snapshot, 'gui': self.metrics.snapshot()}
+
+    def show_metrics(self):
+        snapshots = self.snapshots()
+        if snapshots['device'] is None:
+            text = 'Device process\nWaiting for metrics\n'
+        else:
+            text = format_snapshot(snapshots['device'], 'Device process')
+        text += '\n' + format_snapshot(snapshots['gui'], 'GUI')
+        scroll = self.view.verticalScrollBar().value()
+        self.view.setPlainText(text)
+        self.view.verticalScrollBar().setValue(scroll)
+
+    def save_dialog(self):
+        options = QtWidgets.QFileDialog.Options()
+        options |= QtWidgets.QFileDialog.DontUseNativeDialog
+        file_name, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save Metrics", "", "JSON Files (*.json);;Text Files (*.txt);;All Files (*)", options=options)
+        if file_name:
+            self.save(file_name)
+
+    def save(self, file_name):
+        snapshots = self.snapshots()
+        with open(file_name, 'w') as f:
+            if file_name.endswith('.json'):
+                json.dump(snapshots, f, indent=2, sort_keys=True)
+            else:
+                f.write(self.view.toPlainText())
 
 class Help_Window(QtWidgets.QDialog):
     '''
     This class is for the help window that displays the readme file to the user, it reads the readme file and displays the information as html using the markdown syntax.
+
+    Markdown and Qt WebEngine are only imported when the window is first opened, if WebEngine is not available the html is shown in a QTextBrowser instead.
     '''
     def __init__(self):
         super(Help_Window, self).__init__()
+        import markdown
         self.setWindowTitle("Help")
         self.setWindowIcon(QIcon('hp_icon.png'))
-        self.view = QtWebEngineWidgets.QWebEngineView(self)
+        try:
+            from PyQt5 import QtWebEngineWidgets
+            self.view = QtWebEngineWidgets.QWebEngineView(self)
+        except ImportError:
+            self.view = QtWidgets.QTextBrowser(self)
         self.layout = QtWidgets.QVBoxLayout(self)
         self.layout.addWidget(self.view)
         self.file = QtCore.QFile('README.md')
@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import time
+import bisect
+
+
+# upper bucket edges of the latency histograms in seconds, four per decade
+# from 10 us to 100 s, anything slower goes in a final overflow bucket
+BUCKET_EDGES = tuple(10 ** (e / 4) for e in range(-20, 9))
+
+
+def command_name(command):
+    '''
+    Returns the mnemonic of a GPIB or controller command without its
+    arguments, '++addr 11' gives '++addr' and 'START=1MHZ' gives 'START', so
+    the number of histograms stays bounded.
+    '''
+    match = re.match(r'\+*[A-Za-z]+\??', command.strip())
+    return match.group(0).upper() if match else 'other'
+
+
+class Histogram(object):
+    '''
+    This class counts durations into logarithmic buckets and keeps their
+    count, sum, minimum and maximum. Percentiles are estimated from the
+    bucket edges, so they are accurate to about a quarter of a decade.
+    '''
+    def __init__(self, edges=BUCKET_EDGES):
+        self.edges = edges
+        self.buckets = [0] * (len(edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                edge = self.edges[i] if i < len(self.edges) else self.max
+                return min(edge, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else 0.0,
+                'min': self.min if self.count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99)}
+
+
+class Timer(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics(object):
+    '''
+    This class collects latency histograms, counters and gauges for one
+    process. When disabled every call returns straight away and timer()
+    hands back a shared no-op context manager, so the instrumentation can
+    stay in the hot path.
+
+        metrics = Metrics(enabled=True)
+        with metrics.timer('query.A?'):
+            ...
+        metrics.count('sweeps')
+        metrics.gauge('data_queue', data_queue.qsize())
+        metrics.write('metrics.json')
+
+    Gauges that are expensive or pointless to update on every event can be
+    registered as sources, functions returning a dict of gauge values that
+    are only called when a snapshot is taken.
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.sources = []
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def enable(self, enabled=True):
+        if enabled and not self.enabled:
+            self.reset()
+        self.enabled = enabled
+
+    def add_source(self, source):
+        self.sources.append(source)
+
+    def timer(self, name):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        if not self.enabled:
+            return
+        self.gauges[name] = value
+
+    def snapshot(self):
+        '''
+        Returns the current values as a dict of plain Python types, rates
+        are counts per second since the metrics were last reset.
+        '''
+        gauges = dict(self.gauges)
+        if self.enabled:
+            for source in self.sources:
+                gauges.update(source())
+        uptime = time.monotonic() - self.started
+        return {'enabled': self.enabled,
+                'timestamp': time.time(),
+                'uptime': uptime,
+                'counters': dict(self.counters),
+                'rates': {name: value / uptime if uptime > 0 else 0.0
+                          for name, value in self.counters.items()},
+                'gauges': gauges,
+                'latency': {name: h.summary() for name, h in self.histograms.items()}}
+
+    def write(self, file_name, snapshot=None):
+        '''
+        Writes a snapshot to a file, as JSON if the name ends in .json and as
+        a text table otherwise. The file is replaced in one step so readers
+        never see it half written.
+        '''
+        if snapshot is None:
+            snapshot = self.snapshot()
+        if file_name.endswith('.json'):
+            text = json.dumps(snapshot, indent=2, sort_keys=True)
+        else:
+            text = format_snapshot(snapshot)
+        temp_name = file_name + '.tmp'
+        with open(temp_name, 'w') as f:
+            f.write(text)
+        os.replace(temp_name, file_name)
+
+
+def format_snapshot(snapshot, title=None):
+    '''
+    Formats a snapshot as a text table, latencies are in milliseconds.
+    '''
+    lines = []
+    if title:
+        lines.append(title)
+    if not snapshot.get('enabled'):
+        lines.append('Metrics disabled')
+        return '\n'.join(lines) + '\n'
+    lines.append('Uptime {:.1f} s'.format(snapshot['uptime']))
+    if snapshot['counters']:
+        lines.append('')
+        lines.append('{:<28}{:>12}{:>12}'.format('Counter', 'Total', 'Per s'))
+        for name in sorted(snapshot['counters']):
+            lines.append('{:<28}{:>12}{:>12.2f}'.format(name, snapshot['counters'][name], snapshot['rates'][name]))
+    if snapshot['gauges']:
+        lines.append('')
+        lines.append('{:<28}{:>12}'.format('Gauge', 'Value'))
+        for name in sorted(snapshot['gauges']):
+            lines.append('{:<28}{:>12}'.format(name, snapshot['gauges'][name]))
+    if snapshot['latency']:
+        lines.append('')
+        lines.append('{:<28}{:>8}{:>10}{:>10}{:>10}{:>10}'.format('Latency (ms)', 'Count', 'Mean', 'p50', 'p99', 'Max'))
+        for name in sorted(snapshot['latency']):
+            h = snapshot['latency'][name]
+            lines.append('{:<28}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+                name, h['count'], h['mean'] * 1e3, h['p50'] * 1e3, h['p99'] * 1e3, h['max'] * 1e3))
+    return '\n'.join(lines) + '\n'
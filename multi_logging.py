@@ -1,9 +1,185 @@
+import queue
 import logging
+import logging.handlers
+import threading
+import collections
+
+
+class BatchingQueueHandler(logging.Handler):
+    '''
+    This class sends log records to another process in batches. Records are
+    buffered and put on the queue as one list when the buffer is full, when
+    a record at flush_level or above arrives, or after flush_interval
+    seconds at most. Only the message arguments are merged here, the
+    records are formatted and written by the listener.
+    '''
+    def __init__(self, queue, capacity=64, flush_interval=0.2,
+                 flush_level=logging.WARNING):
+        super(BatchingQueueHandler, self).__init__()
+        self.queue = queue
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.buffer = []
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_periodically,
+                                        name='LogFlusher')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def prepare(self, record):
+        '''
+        Makes a record picklable without formatting it, the arguments are
+        merged into the message and a traceback is rendered to text.
+        '''
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.buffer.append(self.prepare(record))
+            if len(self.buffer) >= self.capacity or record.levelno >= self.flush_level:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                self.queue.put(self.buffer)
+                self.buffer = []
+        finally:
+            self.release()
+
+    def flush_periodically(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        '''
+        Stops the flusher thread and sends the records still buffered. The
+        thread is joined first, so no flush is in progress once close
+        returns and the process can exit.
+        '''
+        self.closed.set()
+        if self.flusher is not threading.current_thread():
+            self.flusher.join()
+        self.flush()
+        super(BatchingQueueHandler, self).close()
+
+
+class Sampler(object):
+    '''
+    This class decides whether a message on the acquisition hot path is
+    logged before it is formatted or a record is created. A message is
+    dropped if its logger is not enabled for the level, otherwise one call
+    in every is logged for each key.
+
+        sample = Sampler(logger, every=100)
+        if sample('length_check', logging.INFO):
+            logger.info('Data length check passed ({})'.format(n))
+    '''
+    def __init__(self, logger, every=100):
+        self.logger = logger
+        self.every = max(1, int(every))
+        self.counts = {}
+
+    def __call__(self, key, level=logging.DEBUG):
+        if not self.logger.isEnabledFor(level):
+            return False
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        return count % self.every == 0
+
+
+def handlers_for(logger):
+    '''
+    Returns the handlers a record logged on logger is passed to, following
+    the same propagation rules as Logger.callHandlers.
+    '''
+    handlers = []
+    while logger is not None:
+        handlers.extend(logger.handlers)
+        if not logger.propagate:
+            break
+        logger = logger.parent
+    return handlers
+
+
+def emit_batch(handler, records):
+    '''
+    Writes a list of records to a handler. Stream and file handlers get all
+    the formatted records in one write and one flush, other handlers and
+    handlers that rotate their files are called per record.
+    '''
+    if not isinstance(handler, logging.StreamHandler) or \
+            isinstance(handler, logging.handlers.BaseRotatingHandler):
+        for record in records:
+            handler.handle(record)
+        return
+    handler.acquire()
+    try:
+        lines = []
+        for record in records:
+            if handler.filter(record):
+                lines.append(handler.format(record) + handler.terminator)
+        if not lines:
+            return
+        if handler.stream is None:
+            handler.stream = handler._open()
+        handler.stream.write(''.join(lines))
+        handler.flush()
+    except Exception:
+        handler.handleError(records[-1])
+    finally:
+        handler.release()
+
+
+def handle_batch(records):
+    '''
+    Routes a batch of records to the handlers of their loggers, grouping
+    them so that each handler is written to once per batch.
+    '''
+    batches = collections.OrderedDict()
+    for record in records:
+        logger = logging.getLogger(record.name)
+        if logger.disabled or not logger.filter(record):
+            continue
+        for handler in handlers_for(logger):
+            if record.levelno >= handler.level:
+                batches.setdefault(handler, []).append(record)
+    for handler, batch in batches.items():
+        emit_batch(handler, batch)
+
 
 def logger_thread(q):
+    '''
+    Handles the records put on the logging queue by the other processes
+    until a None arrives. Items are single records from a plain
+    QueueHandler or lists of records from a BatchingQueueHandler, everything
+    waiting on the queue is handled as one batch.
+    '''
     while True:
-        record = q.get()
-        if record is None:
+        records = []
+        stop = False
+        item = q.get()
+        while True:
+            if item is None:
+                stop = True
+                break
+            if isinstance(item, list):
+                records.extend(item)
+            else:
+                records.append(item)
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                break
+        handle_batch(records)
+        if stop:
             break
-        logger = logging.getLogger(record.name)
-        logger.handle(record)
@@ -0,0 +1,247 @@
+import asyncio
+
+
+BLOCK_HEADER = b'#A'
+
+
+class AsyncPrologixTransport(object):
+    '''
+    This class is the link to a Prologix GPIB-ETHERNET controller built on
+    asyncio streams. Responses are framed on the line terminator, or on the
+    length header for binary '#A' blocks, so a read completes as soon as the
+    reply has arrived. Every operation takes a timeout and raises
+    TimeoutError when it expires, a closed or broken link raises
+    ConnectionError and is no longer connected afterwards.
+
+    The streams are opened with connector, asyncio.open_connection unless
+    another function with the same signature is given, such as the recorder
+    or replay of a gpib_session.
+    '''
+    def __init__(self, terminator=b'\n', limit=2 ** 20, connector=None):
+        self.terminator = terminator
+        self.limit = limit
+        self.connector = connector or asyncio.open_connection
+        self.reader = None
+        self.writer = None
+        # set when a read was abandoned part way, anything still buffered or
+        # in flight belongs to that reply and is discarded before the next
+        self.dirty = False
+        # running totals of the traffic on the link, including terminators
+        # and discarded input
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self, host, port, timeout=10):
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                self.connector(host, port, limit=self.limit), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Timed out connecting to {}:{}'.format(host, port))
+        except OSError as e:
+            raise ConnectionError('Could not connect to {}:{}: {}'.format(host, port, e))
+        self.dirty = False
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.reader = None
+            self.writer = None
+
+    async def write(self, command, timeout=10):
+        '''
+        Sends a command followed by CR LF and waits until the transport
+        buffer has drained, so a stalled link pushes back on the caller.
+        '''
+        if not self.connected:
+            raise ConnectionError('Not connected')
+        data = command.encode('ascii') + b'\r\n'
+        self.writer.write(data)
+        self.bytes_written += len(data)
+        await self.guard(self.writer.drain(), timeout)
+
+    async def read_line(self, timeout=3):
+        '''
+        Returns the next non-empty line without its terminator.
+        '''
+        if not self.connected:
+            raise ConnectionError('Not connected')
+        while True:
+            line = await self.guard(self.reader.readuntil(self.terminator), timeout)
+            self.bytes_read += len(line)
+            line = line[:-len(self.terminator)].rstrip(b'\r')
+            if line:
+                return line
+
+    async def read_block(self, timeout=10):
+        '''
+        Returns the payload of a '#A' binary block, skipping the terminator
+        left over from the previous reply.
+        '''
+        if not self.connected:
+            raise ConnectionError('Not connected')
+        return await self.guard(self._read_block(), timeout)
+
+    async def _read_block(self):
+        start = await self.reader.readexactly(1)
+        while start in (b'\r', b'\n'):
+            self.bytes_read += 1
+            start = await self.reader.readexactly(1)
+        header = start + await self.reader.readexactly(3)
+        self.bytes_read += len(header)
+        if header[:2] != BLOCK_HEADER:
+            self.dirty = True
+            raise ConnectionError('Invalid block header: {}'.format(header))
+        length = int.from_bytes(header[2:4], 'big')
+        block = await self.reader.readexactly(length)
+        self.bytes_read += length
+        return block
+
+    async def query(self, command, timeout=3):
+        await self.discard_input()
+        await self.write(command, timeout)
+        return await self.read_line(timeout)
+
+    async def query_batch(self, commands, reads, timeout=3):
+        '''
+        Sends several commands back to back in one write and then collects
+        their replies in order, so the controller works through the queue
+        without waiting for a round trip between them. reads gives the reply
+        of each command: 'line', 'block' or None for a command that does not
+        reply. Returns a list of replies, None for commands without one. A
+        reply that does not arrive raises TimeoutError and leaves the link
+        to be flushed before the next request.
+        '''
+        await self.discard_input()
+        if not self.connected:
+            raise ConnectionError('Not connected')
+        data = b''.join(command.encode('ascii') + b'\r\n' for command in commands)
+        self.writer.write(data)
+        self.bytes_written += len(data)
+        await self.guard(self.writer.drain(), timeout)
+        replies = []
+        for read in reads:
+            if read == 'block':
+                replies.append(await self.read_block(timeout))
+            elif read == 'line':
+                replies.append(await self.read_line(timeout))
+            else:
+                replies.append(None)
+        return replies
+
+    async def read_trace(self, register, binary=False, timeout=10):
+        '''
+        Requests a data register and returns the raw reply, the block payload
+        in binary mode and the ASCII line otherwise.
+        '''
+        await self.discard_input()
+        await self.write(register, timeout)
+        if binary:
+            return await self.read_block(timeout)
+        return await self.read_line(timeout)
+
+    async def discard_input(self, settle=0.01):
+        '''
+        Drops the remains of an abandoned reply, waiting briefly for any of
+        it that is still on its way.
+        '''
+        if not self.dirty or not self.connected:
+            return
+        while True:
+            try:
+                data = await asyncio.wait_for(self.reader.read(self.limit), settle)
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+            self.bytes_read += len(data)
+        self.dirty = False
+
+    async def guard(self, operation, timeout):
+        try:
+            return await asyncio.wait_for(operation, timeout)
+        except asyncio.TimeoutError:
+            self.dirty = True
+            raise TimeoutError('Timed out after {} s'.format(timeout))
+        except asyncio.IncompleteReadError:
+            self.abort()
+            raise ConnectionError('Connection closed by controller')
+        except asyncio.LimitOverrunError:
+            self.dirty = True
+            raise ConnectionError('Reply exceeds {} bytes'.format(self.limit))
+        except OSError as e:
+            if isinstance(e, TimeoutError):
+                raise
+            self.abort()
+            if isinstance(e, ConnectionError):
+                raise
+            raise ConnectionError(str(e))
+
+    def abort(self):
+        '''
+        Marks the link as down after the controller closed it or the socket
+        failed, connected is False from then on.
+        '''
+        if self.writer is not None:
+            self.writer.close()
+
+
+class PrologixTransport(object):
+    '''
+    This class is a blocking facade over AsyncPrologixTransport for code that
+    is not itself asynchronous, such as the hp4195a worker process. It runs
+    each operation to completion on a private event loop.
+    '''
+    def __init__(self, terminator=b'\n', connector=None):
+        self.loop = asyncio.new_event_loop()
+        self.link = AsyncPrologixTransport(terminator, connector=connector)
+
+    @property
+    def connected(self):
+        return self.link.connected
+
+    @property
+    def bytes_read(self):
+        return self.link.bytes_read
+
+    @property
+    def bytes_written(self):
+        return self.link.bytes_written
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def connect(self, host, port, timeout=10):
+        return self.run(self.link.connect(host, port, timeout))
+
+    def write(self, command, timeout=10):
+        return self.run(self.link.write(command, timeout))
+
+    def read_line(self, timeout=3):
+        return self.run(self.link.read_line(timeout))
+
+    def read_block(self, timeout=10):
+        return self.run(self.link.read_block(timeout))
+
+    def query(self, command, timeout=3):
+        return self.run(self.link.query(command, timeout))
+
+    def query_batch(self, commands, reads, timeout=3):
+        return self.run(self.link.query_batch(commands, reads, timeout))
+
+    def read_trace(self, register, binary=False, timeout=10):
+        return self.run(self.link.read_trace(register, binary, timeout))
+
+    def close(self):
+        self.run(self.link.close())
+
+    def shutdown(self):
+        self.close()
+        self.loop.close()
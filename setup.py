@@ -18,6 +18,8 @@ options = {
             os.path.join(PYTHON_INSTALL_DIR, 'DLLs', 'tcl86t.dll'),
             os.path.join(os.path.dirname(__file__), 'logging.conf')
          ],
+        # loaded by NumPy on demand, so not found by the import scan
+        'includes': ['numpy.core._methods', 'numpy.lib.format'],
     },
 }
 
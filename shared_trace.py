@@ -0,0 +1,108 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+HEADER_WORDS = 4
+
+
+class SharedTraceChannel(object):
+    '''
+    This class passes sweeps from the device process to the GUI through a
+    block of shared memory instead of pickling arrays through a queue. The
+    block holds a small header and a number of preallocated slots, each with
+    room for the magnitude, phase and frequency traces of one sweep.
+
+    The writer fills the slot after the last one published, stamps it with
+    its sequence number and then publishes that number in the header. A
+    reader copies the newest slot and checks the stamp again afterwards, if
+    the writer reused the slot in the meantime the copy is retried. Only the
+    sequence number needs to go through the data queue.
+    '''
+    def __init__(self, max_points=401, slots=4, name=None):
+        self.max_points = max_points
+        self.slots = slots
+        self.owner = name is None
+        size = 8 * (HEADER_WORDS + 2 * slots + 3 * slots * max_points)
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.map_arrays()
+        if self.owner:
+            self.header[:] = (-1, slots, max_points, 0)
+            self.stamps[:] = -1
+
+    def map_arrays(self):
+        buf = self.shm.buf
+        offset = 0
+        self.header = np.ndarray(HEADER_WORDS, dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8 * HEADER_WORDS
+        self.stamps = np.ndarray(self.slots, dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8 * self.slots
+        self.points = np.ndarray(self.slots, dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8 * self.slots
+        self.data = np.ndarray((self.slots, 3, self.max_points), dtype=np.float64,
+                               buffer=buf, offset=offset)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def sequence(self):
+        '''
+        Sequence number of the newest published sweep, -1 before the first.
+        '''
+        return int(self.header[0])
+
+    def __getstate__(self):
+        # child processes attach to the block by name
+        return {'name': self.shm.name,
+                'max_points': self.max_points,
+                'slots': self.slots}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_points'], state['slots'], name=state['name'])
+
+    def write(self, mag_data, phase_data, freq_data):
+        '''
+        Publishes a sweep and returns its sequence number.
+        '''
+        n = len(freq_data)
+        if n > self.max_points:
+            raise ValueError('Sweep of {} points exceeds channel width of {}'.format(n, self.max_points))
+        sequence = self.sequence + 1
+        slot = sequence % self.slots
+        self.stamps[slot] = -1
+        self.data[slot, 0, :n] = mag_data
+        self.data[slot, 1, :n] = phase_data
+        self.data[slot, 2, :n] = freq_data
+        self.points[slot] = n
+        self.stamps[slot] = sequence
+        self.header[0] = sequence
+        return sequence
+
+    def read(self, retries=10):
+        '''
+        Returns (sequence, mag, phase, freq) for the newest sweep as copies
+        the caller can keep, or None if nothing has been published.
+        '''
+        for _ in range(retries):
+            sequence = self.sequence
+            if sequence < 0:
+                return None
+            slot = sequence % self.slots
+            n = int(self.points[slot])
+            trace = self.data[slot, :, :n].copy()
+            if self.stamps[slot] == sequence:
+                return sequence, trace[0], trace[1], trace[2]
+        return None
+
+    def close(self):
+        # drop the array views first, the buffer cannot be released while
+        # they still reference it
+        self.header = self.stamps = self.points = self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
@@ -0,0 +1,275 @@
+import os
+import time
+import numpy as np
+
+
+MAGIC = b'HP4195AS'
+VERSION = 1
+
+HEADER_DTYPE = np.dtype([('magic', 'S8'),
+                         ('version', '<u4'),
+                         ('max_points', '<u4'),
+                         ('count', '<u8'),
+                         ('reserved', 'u1', (40,))])
+
+# the settings of each record are also kept in a side index file, so time
+# and settings queries read 40 bytes per sweep instead of paging in records
+INDEX_DTYPE = np.dtype([('timestamp', '<f8'),
+                        ('sequence', '<i8'),
+                        ('gpib_addr', '<i4'),
+                        ('points', '<i4'),
+                        ('start', '<f8'),
+                        ('stop', '<f8')])
+
+
+def record_dtype(max_points):
+    '''
+    Layout of one sweep record, every record has room for max_points points
+    so the n-th record is always at a fixed offset in the file.
+    '''
+    return np.dtype([('timestamp', '<f8'),
+                     ('sequence', '<i8'),
+                     ('gpib_addr', '<i4'),
+                     ('points', '<i4'),
+                     ('start', '<f8'),
+                     ('stop', '<f8'),
+                     ('mag_data', '<f8', (max_points,)),
+                     ('phase_data', '<f8', (max_points,)),
+                     ('freq_data', '<f8', (max_points,))])
+
+
+class SweepArchive(object):
+    '''
+    This class is an append-only file of fixed size sweep records accessed
+    through a memory map. Each record holds the timestamp, sequence number,
+    GPIB address, the sweep settings (start, stop and number of points) and
+    the magnitude, phase and frequency traces.
+
+    The file grows in chunks of records and the header only counts a record
+    once it has been written completely. Reading returns views into the
+    memory map, so slicing a long run does not load the whole file. Records
+    are in acquisition order, so time ranges are found with a binary search
+    on the timestamps.
+
+    The timestamp, sequence number, GPIB address and settings of every
+    record are repeated in a compact index file next to the archive (the
+    archive name with .idx appended). time_range and select only read the
+    index, the records themselves are only paged in when their traces are
+    used. An index that is missing or behind the archive, such as one from
+    an archive written before the index existed, is rebuilt from the
+    records when the archive is opened.
+
+        archive = SweepArchive('overnight.sweeps')
+        archive.append(mag, phase, freq)
+        records = archive.time_range(t0, t1)
+        records['mag_data'][:, :records['points'][0]]
+    '''
+    def __init__(self, file_name, max_points=401, readonly=False,
+                 grow_by=256, flush_interval=16):
+        self.file_name = file_name
+        self.index_name = file_name + '.idx'
+        self.readonly = readonly
+        self.grow_by = grow_by
+        self.flush_interval = flush_interval
+        self.unflushed = 0
+
+        if not os.path.exists(file_name) or os.path.getsize(file_name) == 0:
+            if readonly:
+                raise IOError('Archive {} does not exist'.format(file_name))
+            header = np.zeros(1, dtype=HEADER_DTYPE)
+            header['magic'] = MAGIC
+            header['version'] = VERSION
+            header['max_points'] = max_points
+            with open(file_name, 'wb') as f:
+                f.write(header.tobytes())
+            # an index left behind by an earlier archive of the same name
+            if os.path.exists(self.index_name):
+                os.remove(self.index_name)
+
+        mode = 'r' if readonly else 'r+'
+        self.header = np.memmap(file_name, dtype=HEADER_DTYPE, mode=mode, shape=(1,))
+        if self.header['magic'][0] != MAGIC:
+            raise IOError('{} is not a sweep archive'.format(file_name))
+        if self.header['version'][0] != VERSION:
+            raise IOError('Unsupported archive version {}'.format(self.header['version'][0]))
+        self.max_points = int(self.header['max_points'][0])
+        self.dtype = record_dtype(self.max_points)
+        self.records = None
+        self.index = None
+        self.map_records()
+        self.map_index()
+        self.check_index()
+
+    def __len__(self):
+        return int(self.header['count'][0])
+
+    def __getitem__(self, index):
+        return self.records[:len(self)][index]
+
+    def capacity(self):
+        size = os.path.getsize(self.file_name) - HEADER_DTYPE.itemsize
+        return size // self.dtype.itemsize
+
+    def map_records(self):
+        capacity = self.capacity()
+        if capacity == 0:
+            self.records = np.zeros(0, dtype=self.dtype)
+            return
+        mode = 'r' if self.readonly else 'r+'
+        self.records = np.memmap(self.file_name, dtype=self.dtype, mode=mode,
+                                 offset=HEADER_DTYPE.itemsize, shape=(capacity,))
+
+    def map_index(self):
+        capacity = os.path.getsize(self.index_name) // INDEX_DTYPE.itemsize \
+            if os.path.exists(self.index_name) else 0
+        if capacity == 0:
+            self.index = np.zeros(0, dtype=INDEX_DTYPE)
+            return
+        mode = 'r' if self.readonly else 'r+'
+        self.index = np.memmap(self.index_name, dtype=INDEX_DTYPE, mode=mode,
+                               shape=(capacity,))
+
+    def resize_index(self, capacity):
+        if isinstance(self.index, np.memmap):
+            self.index.flush()
+        self.index = None
+        with open(self.index_name, 'ab') as f:
+            f.truncate(capacity * INDEX_DTYPE.itemsize)
+        self.map_index()
+
+    def check_index(self):
+        '''
+        Fills in the index entries of records that were written without
+        them, reading those records once. A read only archive keeps the
+        rebuilt index in memory.
+        '''
+        count = len(self)
+        valid = min(len(self.index), count)
+        if valid == count:
+            return
+        if self.readonly:
+            index = np.zeros(count, dtype=INDEX_DTYPE)
+            index[:valid] = self.index[:valid]
+            self.index = index
+        else:
+            self.resize_index(len(self.records))
+        for name in INDEX_DTYPE.names:
+            self.index[name][valid:count] = self.records[name][valid:count]
+        self.flush()
+
+    def grow(self):
+        if isinstance(self.records, np.memmap):
+            self.records.flush()
+        # release the map before resizing the file, Windows does not allow
+        # a mapped file to change size
+        self.records = None
+        size = HEADER_DTYPE.itemsize + (self.capacity() + self.grow_by) * self.dtype.itemsize
+        with open(self.file_name, 'r+b') as f:
+            f.truncate(size)
+        self.map_records()
+        self.resize_index(len(self.records))
+
+    def append(self, mag_data, phase_data, freq_data, timestamp=None,
+               sequence=-1, gpib_addr=0):
+        '''
+        Writes a sweep to the end of the archive and returns its index.
+        '''
+        if self.readonly:
+            raise IOError('Archive is open read only')
+        n = len(freq_data)
+        if n > self.max_points:
+            raise ValueError('Sweep of {} points exceeds archive width of {}'.format(n, self.max_points))
+        index = len(self)
+        if index >= len(self.records):
+            self.grow()
+
+        record = self.records[index]
+        record['timestamp'] = time.time() if timestamp is None else timestamp
+        record['sequence'] = sequence
+        record['gpib_addr'] = gpib_addr
+        record['points'] = n
+        record['start'] = freq_data[0] if n else 0
+        record['stop'] = freq_data[-1] if n else 0
+        record['mag_data'][:n] = mag_data
+        record['phase_data'][:n] = phase_data
+        record['freq_data'][:n] = freq_data
+        for name in INDEX_DTYPE.names:
+            self.index[name][index] = record[name]
+        self.header['count'] = index + 1
+
+        self.unflushed += 1
+        if self.unflushed >= self.flush_interval:
+            self.flush()
+        return index
+
+    def flush(self):
+        if not self.readonly:
+            # the header is flushed last, so a record is only counted once
+            # it and its index entry are on disk
+            if isinstance(self.records, np.memmap):
+                self.records.flush()
+            if isinstance(self.index, np.memmap):
+                self.index.flush()
+            self.header.flush()
+        self.unflushed = 0
+
+    def close(self):
+        self.flush()
+        self.records = None
+        self.index = None
+        self.header = None
+
+    def entries(self):
+        '''
+        Returns the index entries of the records, a structured array with
+        their timestamp, sequence, gpib_addr, points, start and stop.
+        '''
+        return self.index[:len(self)]
+
+    def timestamps(self):
+        return self.entries()['timestamp']
+
+    def time_range(self, start=None, stop=None):
+        '''
+        Returns a view of the records with start <= timestamp < stop, either
+        bound can be None.
+        '''
+        timestamps = self.timestamps()
+        first = 0 if start is None else np.searchsorted(timestamps, start, 'left')
+        last = len(timestamps) if stop is None else np.searchsorted(timestamps, stop, 'left')
+        return self[first:last]
+
+    def select(self, start=None, stop=None, points=None, gpib_addr=None,
+               time_start=None, time_stop=None):
+        '''
+        Returns the indices of the records matching the given sweep settings
+        and time range. Only the index is read, index the archive with the
+        result to get the traces.
+        '''
+        records = self.entries()
+        first = 0 if time_start is None else np.searchsorted(records['timestamp'], time_start, 'left')
+        last = len(records) if time_stop is None else np.searchsorted(records['timestamp'], time_stop, 'left')
+        records = records[first:last]
+        mask = np.ones(len(records), dtype=bool)
+        if start is not None:
+            mask &= np.isclose(records['start'], start)
+        if stop is not None:
+            mask &= np.isclose(records['stop'], stop)
+        if points is not None:
+            mask &= records['points'] == points
+        if gpib_addr is not None:
+            mask &= records['gpib_addr'] == gpib_addr
+        return first + np.flatnonzero(mask)
+
+    def traces(self, records):
+        '''
+        Returns (mag, phase, freq) 2-D views of a block of records trimmed to
+        their point count, which must be the same for all of them.
+        '''
+        if len(records) == 0:
+            empty = np.zeros((0, 0))
+            return empty, empty, empty
+        n = int(records['points'][0])
+        return (records['mag_data'][:, :n],
+                records['phase_data'][:, :n],
+                records['freq_data'][:, :n])
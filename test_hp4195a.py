@@ -0,0 +1,75 @@
+import itertools
+import multiprocessing
+
+import numpy as np
+import pytest
+
+import hp4195a as hp
+import hp4195a_simulator as simulator
+
+
+class Driver(object):
+    '''
+    This class runs the hp4195a process against a simulator on a free port
+    and sends it requests the way the GUI does.
+    '''
+    def __init__(self, **options):
+        self.simulator = simulator.Simulator(port=0, seed=1).start()
+        self.queues = [multiprocessing.Queue() for _ in range(4)]
+        self.process = hp.hp4195a(*self.queues, host='127.0.0.1',
+                                  port=self.simulator.address[1], **options)
+        self.process.daemon = True
+        self.process.start()
+        self.ids = itertools.count(1)
+
+    def request(self, command, *args):
+        request_id = next(self.ids)
+        self.queues[0].put((request_id, command, args))
+        while True:
+            reply_id, success, payload = self.queues[1].get(timeout=30)
+            if reply_id == request_id:
+                return success, payload
+
+    def sweep(self):
+        success, payload = self.request('start_acquisition')
+        assert success, payload
+        sequence, mag_data, phase_data, freq_data = payload
+        return mag_data, phase_data, freq_data
+
+    def close(self):
+        self.request('disconnect')
+        self.request('shutdown')
+        self.process.join(10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.simulator.stop()
+
+
+@pytest.fixture
+def driver():
+    driver = Driver()
+    assert driver.request('connect')[0]
+    yield driver
+    driver.close()
+
+
+def test_front_panel_points_change(driver):
+    assert len(driver.sweep()[2]) == 401
+    driver.simulator.state.points = 201
+    for _ in range(3):
+        mag_data, phase_data, freq_data = driver.sweep()
+        assert len(mag_data) == len(freq_data) == 201
+        np.testing.assert_allclose(freq_data, driver.simulator.state.freq_data(), rtol=1e-6)
+
+
+def test_front_panel_start_change():
+    driver = Driver(settings_check_interval=0)
+    try:
+        assert driver.request('connect')[0]
+        assert driver.sweep()[2][0] == 1e3
+        driver.simulator.state.start = 5e3
+        freq_data = driver.sweep()[2]
+        assert len(freq_data) == 401
+        assert freq_data[0] == 5e3
+    finally:
+        driver.close()
@@ -0,0 +1,132 @@
+import time
+import numpy as np
+
+
+class TraceRingBuffer(object):
+    '''
+    This class is a fixed size ring buffer of recent sweeps. The magnitude,
+    phase and frequency traces are stored in preallocated 2-D arrays with one
+    row per sweep so appending never allocates, once the buffer is full the
+    oldest sweep is overwritten.
+    '''
+    def __init__(self, capacity=100, max_points=401):
+        self.capacity = capacity
+        self.max_points = max_points
+        self.mag_data = np.zeros((capacity, max_points))
+        self.phase_data = np.zeros((capacity, max_points))
+        self.freq_data = np.zeros((capacity, max_points))
+        self.points = np.zeros(capacity, dtype=int)
+        self.timestamps = np.zeros(capacity)
+        self.sequence = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, mag_data, phase_data, freq_data, timestamp=None):
+        '''
+        Copies a sweep into the next slot and returns its sequence number.
+        '''
+        n = len(freq_data)
+        if n > self.max_points:
+            raise ValueError('Sweep of {} points exceeds buffer width of {}'.format(n, self.max_points))
+        row = self.count % self.capacity
+        self.mag_data[row, :n] = mag_data
+        self.phase_data[row, :n] = phase_data
+        self.freq_data[row, :n] = freq_data
+        self.points[row] = n
+        self.timestamps[row] = time.time() if timestamp is None else timestamp
+        self.sequence[row] = self.count
+        self.count += 1
+        return self.count - 1
+
+    def latest(self):
+        '''
+        Returns (sequence, mag, phase, freq) for the newest sweep as views
+        into the buffer, or None if the buffer is empty.
+        '''
+        if self.count == 0:
+            return None
+        row = (self.count - 1) % self.capacity
+        n = self.points[row]
+        return (self.count - 1,
+                self.mag_data[row, :n],
+                self.phase_data[row, :n],
+                self.freq_data[row, :n])
+
+    def rows(self):
+        '''
+        Returns the buffer row indices ordered from oldest to newest sweep.
+        '''
+        if self.count <= self.capacity:
+            return np.arange(self.count)
+        return np.roll(np.arange(self.capacity), -(self.count % self.capacity))
+
+    def snapshot(self):
+        '''
+        Returns copies of the stored sweeps ordered oldest to newest as a dict
+        of 2-D arrays, trimmed to the widest sweep held.
+        '''
+        rows = self.rows()
+        width = int(self.points[rows].max()) if len(rows) else 0
+        return {'mag_data': self.mag_data[rows, :width],
+                'phase_data': self.phase_data[rows, :width],
+                'freq_data': self.freq_data[rows, :width],
+                'points': self.points[rows],
+                'timestamps': self.timestamps[rows],
+                'sequence': self.sequence[rows]}
+
+    def clear(self):
+        self.count = 0
+
+
+class TraceHistory(object):
+    '''
+    This class keeps the most recent sweeps on one frequency axis for
+    display, as 2-D magnitude and phase arrays with one row per sweep. The
+    arrays are allocated for capacity sweeps when the first sweep arrives
+    and the oldest sweep is overwritten once they are full. A sweep on a
+    different frequency axis starts a new history.
+    '''
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.freq_data = None
+        self.mag_data = None
+        self.phase_data = None
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, mag_data, phase_data, freq_data):
+        freq_data = np.asarray(freq_data, dtype=float)
+        if self.freq_data is None or len(freq_data) != len(self.freq_data) or \
+                not np.array_equal(freq_data, self.freq_data):
+            self.freq_data = freq_data.copy()
+            self.mag_data = np.zeros((self.capacity, len(freq_data)))
+            self.phase_data = np.zeros((self.capacity, len(freq_data)))
+            self.count = 0
+        row = self.count % self.capacity
+        self.mag_data[row] = mag_data
+        self.phase_data[row] = phase_data
+        self.count += 1
+
+    def rows(self):
+        '''
+        Returns the row indices ordered from oldest to newest sweep.
+        '''
+        if self.count <= self.capacity:
+            return np.arange(self.count)
+        return np.roll(np.arange(self.capacity), -(self.count % self.capacity))
+
+    def ordered(self, data, newest_first=False):
+        '''
+        Returns a copy of mag_data or phase_data with the rows in sweep order.
+        '''
+        rows = self.rows()
+        if newest_first:
+            rows = rows[::-1]
+        return data[rows]
+
+    def clear(self):
+        self.count = 0
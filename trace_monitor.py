@@ -0,0 +1,216 @@
+'''
+Change-driven publishing of sweeps. A TraceMonitor compares each new sweep
+with a reference sweep and with mask limits, so that during long unattended
+runs only the sweeps that changed, broke a limit or are due as a heartbeat
+are passed on to the display, the archive or the output files, and every
+check that starts or stops failing is reported as an alarm event.
+
+An alarm event is a dict with the wall clock time, the name of the check,
+its state ('raised' or 'cleared'), the worst value, the limit it was
+compared with, the frequency of the worst point and the number of points
+beyond the limit.
+'''
+import time
+import numpy as np
+
+
+CHECKS = ('magnitude deviation', 'phase deviation', 'magnitude mask', 'phase mask')
+UNITS = {'magnitude': 'dB', 'phase': 'deg'}
+
+
+def wrap_phase(phase_data):
+    '''
+    Wraps phase differences into [-180, 180) degrees.
+    '''
+    return (np.asarray(phase_data, dtype=float) + 180) % 360 - 180
+
+
+def limit_line(limit, freq_data):
+    '''
+    Returns a limit at each frequency. The limit is None (no limit), a
+    number, or an array of (frequency, value) points that is interpolated
+    linearly, with no limit outside the frequencies it covers. Points with
+    no limit are NaN.
+    '''
+    freq_data = np.asarray(freq_data, dtype=float)
+    if limit is None:
+        return np.full(len(freq_data), np.nan)
+    points = np.asarray(limit, dtype=float)
+    if points.ndim == 0:
+        return np.full(len(freq_data), float(points))
+    points = points[~np.isnan(points[:, 1])]
+    points = points[np.argsort(points[:, 0], kind='stable')]
+    if len(points) == 0:
+        return np.full(len(freq_data), np.nan)
+    return np.interp(freq_data, points[:, 0], points[:, 1], left=np.nan, right=np.nan)
+
+
+def load_mask(file_name):
+    '''
+    Reads a mask from a CSV file with a frequency, lower limit and upper
+    limit column, lines starting with # are skipped. An empty or NaN limit
+    means no limit at that frequency. Returns the (lower, upper) pair of
+    (frequency, value) point arrays that TraceMonitor takes as a mask.
+    '''
+    table = np.genfromtxt(file_name, delimiter=',', comments='#', dtype=float, ndmin=2)
+    if table.shape[1] != 3:
+        raise ValueError('{} does not have frequency, lower and upper columns'.format(file_name))
+    return table[:, [0, 1]], table[:, [0, 2]]
+
+
+def format_event(event):
+    '''
+    Returns a one line description of an alarm event.
+    '''
+    unit = UNITS[event['check'].split()[0]]
+    if event['check'].endswith('mask'):
+        value = '{:.3g} {} beyond the mask'.format(event['value'], unit)
+    else:
+        value = '{:.3g} {} against a limit of {:.3g} {}'.format(event['value'], unit, event['limit'], unit)
+    return '{} {}: {} at {:.6g} Hz ({} points)'.format(
+        event['check'].capitalize(), event['state'], value, event['frequency'], event['points'])
+
+
+class TraceMonitor(object):
+    '''
+    This class decides which sweeps are worth passing on. Each sweep is
+    compared with a reference sweep, either the last sweep passed on
+    (reference='previous') or the first one or the one given to
+    set_reference (reference='fixed'), and with mask limits. A sweep is
+    passed on when it deviates from the reference by more than
+    mag_threshold dB or phase_threshold degrees, when it is outside a
+    mask, when a check it fails recovers, when its frequency axis changes
+    and, with a heartbeat, at least every heartbeat seconds. The deviation
+    is the largest difference at any point, or the RMS difference over the
+    sweep with statistic='rms'.
+
+    A mask is a (lower, upper) pair of limits, each None, a number or an
+    array of (frequency, value) points, see limit_line.
+
+        monitor = TraceMonitor(mag_threshold=1, mag_mask=(None, -20))
+        publish, events = monitor.check(mag, phase, freq)
+    '''
+    def __init__(self, mag_threshold=None, phase_threshold=None, statistic='max',
+                 mag_mask=None, phase_mask=None, reference='previous', heartbeat=0):
+        if statistic not in ('max', 'rms'):
+            raise ValueError('Unknown statistic: {}'.format(statistic))
+        if reference not in ('previous', 'fixed'):
+            raise ValueError('Unknown reference: {}'.format(reference))
+        self.mag_threshold = mag_threshold
+        self.phase_threshold = phase_threshold
+        self.statistic = statistic
+        self.mag_mask = mag_mask
+        self.phase_mask = phase_mask
+        self.reference = reference
+        self.heartbeat = heartbeat
+        self.checked = 0
+        self.published = 0
+        self.reset()
+
+    def reset(self):
+        '''
+        Forgets the reference sweep and the state of the checks, the next
+        sweep is passed on and becomes the reference.
+        '''
+        self.freq_data = None
+        self.mag_reference = None
+        self.phase_reference = None
+        self.limits = {}
+        self.failing = dict.fromkeys(CHECKS, False)
+        self.last_published = None
+
+    def set_reference(self, mag_data, phase_data, freq_data, fixed=True):
+        '''
+        Makes a sweep the reference, with fixed the sweeps that follow are
+        compared with it until it is replaced.
+        '''
+        freq_data = np.array(freq_data, dtype=float)
+        if self.freq_data is None or not np.array_equal(freq_data, self.freq_data):
+            self.freq_data = freq_data
+            self.limits = {'magnitude mask': self.mask_limits(self.mag_mask, freq_data),
+                           'phase mask': self.mask_limits(self.phase_mask, freq_data)}
+        self.mag_reference = np.array(mag_data, dtype=float)
+        self.phase_reference = np.array(phase_data, dtype=float)
+        self.failing['magnitude deviation'] = False
+        self.failing['phase deviation'] = False
+        if fixed:
+            self.reference = 'fixed'
+
+    def mask_limits(self, mask, freq_data):
+        if mask is None:
+            return None
+        lower, upper = mask
+        return limit_line(lower, freq_data), limit_line(upper, freq_data)
+
+    def check(self, mag_data, phase_data, freq_data, now=None):
+        '''
+        Checks a sweep. Returns whether it should be passed on and the list
+        of alarm events it raised or cleared.
+        '''
+        now = time.monotonic() if now is None else now
+        mag_data = np.asarray(mag_data, dtype=float)
+        phase_data = np.asarray(phase_data, dtype=float)
+        self.checked += 1
+        new_axis = self.freq_data is None or len(freq_data) != len(self.freq_data) or \
+            not np.array_equal(freq_data, self.freq_data)
+        if new_axis:
+            self.set_reference(mag_data, phase_data, freq_data, fixed=False)
+
+        results = {}
+        if self.mag_threshold is not None:
+            results['magnitude deviation'] = self.deviation(mag_data - self.mag_reference,
+                                                            self.mag_threshold)
+        if self.phase_threshold is not None:
+            results['phase deviation'] = self.deviation(wrap_phase(phase_data - self.phase_reference),
+                                                        self.phase_threshold)
+        for name, data in (('magnitude mask', mag_data), ('phase mask', phase_data)):
+            if self.limits[name] is not None:
+                results[name] = self.excess(data, *self.limits[name])
+
+        events = []
+        for name, (failing, value, limit, index, points) in results.items():
+            if failing != self.failing[name]:
+                events.append({'time': time.time(),
+                               'check': name,
+                               'state': 'raised' if failing else 'cleared',
+                               'value': value,
+                               'limit': limit,
+                               'frequency': float(self.freq_data[index]),
+                               'points': points})
+            self.failing[name] = failing
+
+        publish = new_axis or bool(events) or any(self.failing.values()) or \
+            (self.heartbeat > 0 and now - self.last_published >= self.heartbeat)
+        if publish:
+            self.published += 1
+            self.last_published = now
+            if self.reference == 'previous':
+                self.set_reference(mag_data, phase_data, freq_data, fixed=False)
+        return publish, events
+
+    def deviation(self, difference, threshold):
+        '''
+        Returns (failing, value, threshold, index of the worst point, points
+        beyond the threshold) for a difference from the reference.
+        '''
+        difference = np.abs(difference)
+        index = int(np.argmax(difference))
+        if self.statistic == 'rms':
+            value = float(np.sqrt(np.mean(difference ** 2)))
+        else:
+            value = float(difference[index])
+        points = int(np.count_nonzero(difference > threshold))
+        return value > threshold, value, threshold, index, points
+
+    def excess(self, data, lower, upper):
+        '''
+        Returns (failing, value, 0, index of the worst point, points outside
+        the mask) for a sweep checked against its mask, the value is how far
+        the worst point is outside the mask.
+        '''
+        excess = np.fmax(lower - data, data - upper)
+        excess = np.where(np.isnan(excess), -np.inf, excess)
+        index = int(np.argmax(excess))
+        points = int(np.count_nonzero(excess > 0))
+        value = float(max(excess[index], 0))
+        return points > 0, value, 0.0, index, points